@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the PSP authentication daemon (see "psp" directory), speaking
+the same protocol, so authentication can be tested and measured without a
+PSP and a PS3.
+
+Answers come from a cache file, from a script, or are derived from seeds
+(which is enough for an emulated adapter accepting any answer). Latency and
+failures (closed connection, stuck connection, corrupted answer) can be
+injected:
+
+  daemon = FakeAuthenticationDaemon(latency=.2, hang_rate=.1)
+  address = daemon.start()
+  authenticator = SockAuthenticator([address])
+  ...
+  daemon.stop()
+"""
+from hashlib import blake2b
+import random
+import socket
+import threading
+from time import sleep
+from authenticator import (
+    ANSWER_COUNT,
+    ANSWER_FRAME_HEADER,
+    REQUEST_LENGTH,
+    REQUEST_PREFIX,
+    REQUEST_SUFFIX,
+    SEED_LENGTH,
+)
+
+# Sequence numbers of the USB commands carrying each answer (see
+# PlayStationMemoryCardReader.sendAuthPart*).
+ANSWER_SEQUENCE_NUMBER_LIST = (6, 7, 0xb)
+ANSWER_LENGTH = 9
+# What to do with seeds no answer is known for.
+UNKNOWN_DERIVE = 'derive'
+UNKNOWN_CLOSE = 'close'
+UNKNOWN_HANG = 'hang'
+UNKNOWN_LIST = (UNKNOWN_DERIVE, UNKNOWN_CLOSE, UNKNOWN_HANG)
+
+def deriveAnswers(seed):
+    """
+      Arbitrary, but constant, answers for <seed>.
+    """
+    digest = blake2b(seed, digest_size=ANSWER_COUNT * ANSWER_LENGTH).digest()
+    return tuple(
+        digest[x:x + ANSWER_LENGTH]
+        for x in range(0, len(digest), ANSWER_LENGTH)
+    )
+
+def loadScript(path):
+    """
+      Load seeds and answers from a text file: one seed per line, followed
+      by its answers, all in hexadecimal and separated by spaces. Empty
+      lines and lines starting with "#" are ignored.
+    """
+    result = {}
+    with open(path) as script_file:
+        for line_number, line in enumerate(script_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            item_list = [bytes.fromhex(x) for x in line.split()]
+            if len(item_list) != 1 + ANSWER_COUNT or len(item_list[0]) != \
+                    SEED_LENGTH or any(
+                        len(x) != ANSWER_LENGTH for x in item_list[1:]
+                    ):
+                raise ValueError('%s:%i: expected a %i-byte seed and %i '
+                  '%i-byte answers' % (path, line_number, SEED_LENGTH,
+                  ANSWER_COUNT, ANSWER_LENGTH))
+            result[item_list[0]] = tuple(item_list[1:])
+    return result
+
+def _packAnswers(answer_list):
+    return b''.join(
+        ANSWER_FRAME_HEADER + b'\x0e\x00\x81\xf0' +
+        bytes((sequence_number, )) + answer + b'\x00\x00'
+        for sequence_number, answer in zip(
+            ANSWER_SEQUENCE_NUMBER_LIST,
+            answer_list,
+        )
+    )
+
+class FakeAuthenticationDaemon(object):
+    """
+      Authentication daemon, served from a thread.
+      Like the PSP daemon, connections are served one at a time (others wait
+      to be accepted), and requests of a connection in order.
+    """
+    def __init__(self, authentication_dict=None, address=('127.0.0.1', 0),
+            unknown=UNKNOWN_DERIVE, latency=0, jitter=0, close_rate=0,
+            hang_rate=0, garbage_rate=0, concurrent=False,
+            random_seed=None):
+        """
+          authentication_dict (dict-ish, or None)
+            Maps seeds (9 bytes) to answers (3-tuple of 9 bytes).
+          address ((string, int))
+            Address to listen on. Port 0 picks a free one.
+          unknown (string)
+            What to do with seeds missing from authentication_dict:
+            UNKNOWN_DERIVE: answer with deriveAnswers
+            UNKNOWN_CLOSE: close connection
+            UNKNOWN_HANG: never answer on this connection
+          latency (float)
+          jitter (float)
+            Each answer takes latency, plus up to jitter (uniformly
+            distributed), in seconds.
+          close_rate (float)
+          hang_rate (float)
+          garbage_rate (float)
+            Probabilities for a request to get its connection closed, to
+            never get answered (nor any later request on the same
+            connection), and to get answered with corrupted frames.
+          concurrent (bool)
+            Whether to serve several connections at a time.
+          random_seed
+            Seed for latency and failures, for reproducible runs.
+        """
+        if unknown not in UNKNOWN_LIST:
+            raise ValueError('Unknown seed policy must be one of %r: %r' % (
+              UNKNOWN_LIST, unknown))
+        if authentication_dict is None:
+            authentication_dict = {}
+        self._authentication_dict = authentication_dict
+        self._address = address
+        self._unknown = unknown
+        self._latency = latency
+        self._jitter = jitter
+        self._close_rate = close_rate
+        self._hang_rate = hang_rate
+        self._garbage_rate = garbage_rate
+        self._concurrent = concurrent
+        self._random = random.Random(random_seed)
+        self._lock = threading.Lock()
+        self._listen_socket = None
+        self._thread = None
+        self._connection_set = set()
+        self._statistics = {
+            'connection': 0,
+            'request': 0,
+            'answer': 0,
+            'unknown': 0,
+            'close': 0,
+            'hang': 0,
+            'garbage': 0,
+        }
+
+    def getStatistics(self):
+        with self._lock:
+            return dict(self._statistics)
+
+    def _count(self, name):
+        with self._lock:
+            self._statistics[name] += 1
+
+    def start(self):
+        """
+          Start serving. Return the address it listens on.
+        """
+        self._listen_socket = sock = socket.socket(
+            socket.AF_INET,
+            socket.SOCK_STREAM,
+        )
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self._address)
+        # Like the PSP daemon.
+        sock.listen(1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return sock.getsockname()
+
+    def stop(self):
+        listen_socket = self._listen_socket
+        self._listen_socket = None
+        listen_socket.shutdown(socket.SHUT_RDWR)
+        listen_socket.close()
+        with self._lock:
+            for connection in self._connection_set:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self._thread.join()
+
+    def serveForever(self):
+        address = self.start()
+        print('Listening on %s:%i' % address)
+        self._thread.join()
+
+    def _run(self):
+        listen_socket = self._listen_socket
+        while True:
+            try:
+                connection, _ = listen_socket.accept()
+            except OSError:
+                # Closed by stop.
+                break
+            self._count('connection')
+            with self._lock:
+                self._connection_set.add(connection)
+            if self._concurrent:
+                threading.Thread(
+                    target=self._serve,
+                    args=(connection, ),
+                    daemon=True,
+                ).start()
+            else:
+                self._serve(connection)
+
+    def _getBehaviour(self):
+        with self._lock:
+            value = self._random.random()
+            delay = self._latency + self._random.uniform(0, self._jitter)
+        for name, rate in (
+                    ('close', self._close_rate),
+                    ('hang', self._hang_rate),
+                    ('garbage', self._garbage_rate),
+                ):
+            if value < rate:
+                return name, delay
+            value -= rate
+        return None, delay
+
+    def _serve(self, connection):
+        hung = False
+        try:
+            while True:
+                request = b''
+                while len(request) < REQUEST_LENGTH:
+                    data = connection.recv(REQUEST_LENGTH - len(request))
+                    if not data:
+                        return
+                    request += data
+                if hung:
+                    continue
+                self._count('request')
+                if not request.startswith(REQUEST_PREFIX) or \
+                        not request.endswith(REQUEST_SUFFIX):
+                    # Like the PSP daemon, which would not know how to
+                    # answer.
+                    print('Unexpected request, closing connection: %r' % (
+                      request, ))
+                    return
+                seed = request[len(REQUEST_PREFIX):-len(REQUEST_SUFFIX)]
+                behaviour, delay = self._getBehaviour()
+                try:
+                    answer_list = self._authentication_dict[seed]
+                except KeyError:
+                    self._count('unknown')
+                    if self._unknown == UNKNOWN_DERIVE:
+                        answer_list = deriveAnswers(seed)
+                    else:
+                        behaviour = self._unknown
+                if behaviour is not None:
+                    self._count(behaviour)
+                if behaviour == 'close':
+                    return
+                if behaviour == 'hang':
+                    hung = True
+                    continue
+                if delay:
+                    sleep(delay)
+                answer = _packAnswers(answer_list)
+                if behaviour == 'garbage':
+                    answer = bytes(x ^ 0xff for x in answer)
+                connection.sendall(answer)
+                self._count('answer')
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._connection_set.discard(connection)
+            connection.close()
+
+def main(options):
+    authentication_dict = {}
+    if options.auth_cache:
+        from cache import openCache
+        authentication_dict = openCache(options.auth_cache)
+    if options.script:
+        if authentication_dict:
+            # Script entries take precedence.
+            authentication_dict = dict(authentication_dict.items())
+        authentication_dict.update(loadScript(options.script))
+    daemon = FakeAuthenticationDaemon(
+        authentication_dict,
+        address=(options.address, options.port),
+        unknown=options.unknown,
+        latency=options.latency,
+        jitter=options.jitter,
+        close_rate=options.close_rate,
+        hang_rate=options.hang_rate,
+        garbage_rate=options.garbage_rate,
+        concurrent=options.concurrent,
+        random_seed=options.seed,
+    )
+    try:
+        daemon.serveForever()
+    except KeyboardInterrupt:
+        pass
+    print('Statistics: %r' % (daemon.getStatistics(), ))
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option('-a', '--address', default='127.0.0.1',
+      help='Address to listen on.')
+    parser.add_option('-P', '--port', default=20531, type='int',
+      help='Port to listen on.')
+    parser.add_option('-c', '--auth-cache',
+      help='Authentication cache file to answer from.')
+    parser.add_option('-s', '--script',
+      help='Text file of seeds and answers to answer from, one seed per '
+      'line followed by its 3 answers, in hexadecimal.')
+    parser.add_option('-u', '--unknown', default=UNKNOWN_DERIVE,
+      help='What to do with seeds without a known answer: %s.' % (
+        ', '.join(UNKNOWN_LIST), ))
+    parser.add_option('-l', '--latency', default=0, type='float',
+      help='Time, in seconds, each answer takes.')
+    parser.add_option('-j', '--jitter', default=0, type='float',
+      help='Maximum random extra time, in seconds, each answer takes.')
+    parser.add_option('--close-rate', default=0, type='float',
+      help='Probability for a request to get its connection closed.')
+    parser.add_option('--hang-rate', default=0, type='float',
+      help='Probability for a request to get its connection stuck.')
+    parser.add_option('--garbage-rate', default=0, type='float',
+      help='Probability for a request to get a corrupted answer.')
+    parser.add_option('--concurrent', default=False, action='store_true',
+      help='Serve several connections at a time, unlike PSP daemon.')
+    parser.add_option('-r', '--seed', type='int',
+      help='Random seed, for reproducible latency and failures.')
+    (options, args) = parser.parse_args()
+    if options.unknown not in UNKNOWN_LIST:
+        parser.error('Invalid --unknown value: %r' % (options.unknown, ))
+    main(options)
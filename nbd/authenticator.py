@@ -1,30 +1,236 @@
+from collections import deque
+import os
+import select
 import socket
+import threading
 import time
+from time import monotonic
 SEED_LENGTH = 9
+# Requests to authentication daemons: the frame the card sent its seed in.
+REQUEST_PREFIX = b'\x55\x5a\x0e\x00\xff\xff\xff\x2b'
+REQUEST_SUFFIX = b'\xff'
+REQUEST_LENGTH = len(REQUEST_PREFIX) + SEED_LENGTH + len(REQUEST_SUFFIX)
+# Authentication daemons answer each seed with 3 USB frames, each one
+# containing one answer.
+ANSWER_FRAME_LENGTH = 0x12
+ANSWER_COUNT = 3
+ANSWER_FRAME_HEADER = b'\xaa\x42'
+# Time an answer may take, in seconds, before a daemon is considered stuck
+# for this seed. On timeout, authentication starts over with a new seed, and
+# the late answer is still cached when it comes, so this must be well above
+# normal daemon latency: a timeout below it would fail every uncached seed.
+# A shorter timeout, around the time card waits for answers, only saves
+# waiting for answers the card would refuse anyway.
+TIMEOUT = 5
+# Time after which the seed is also sent to the next daemon, in seconds.
+HEDGE_DELAY = 0.25
+# Time after which an unanswered connection is considered stuck, and
+# reconnected.
+STALE_TIMEOUT = 10
+# Delay before reconnecting to a daemon which failed, in seconds. Doubles on
+# each consecutive failure, up to MAX_RECONNECT_DELAY.
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+# Weight of latest answer in daemon latency estimation.
+LATENCY_WEIGHT = 0.25
+
+class AuthenticationError(IOError):
+    pass
+
+class AuthenticationTimeout(AuthenticationError):
+    pass
+
+def parseAddress(address, default_port):
+    """
+      Parse "host" or "host:port" into a (host, port) tuple.
+    """
+    host, separator, port = address.rpartition(':')
+    if not separator or host.endswith(':') or not port.isdigit():
+        # No port, or a bare IPv6 address.
+        return (address, default_port)
+    return (host.strip('[]'), int(port))
+
+class _Daemon(object):
+    """
+      Connection to one authentication daemon, reconnected on failure.
+      Answers are framed: each request gets exactly ANSWER_COUNT frames of
+      ANSWER_FRAME_LENGTH bytes, in request order.
+    """
+    def __init__(self, address):
+        self.address = address
+        self._socket = None
+        self._buffer = b''
+        # Seeds sent and not answered yet, with when they were sent.
+        self._pending = deque()
+        self._failure_count = 0
+        self._retry_after = 0
+        self.latency = None
+        self.statistics = {
+            'request': 0,
+            'answer': 0,
+            'failure': 0,
+            'connect': 0,
+        }
+
+    def fileno(self):
+        """
+          Socket file descriptor, -1 when not connected.
+        """
+        sock = self._socket
+        return -1 if sock is None else sock.fileno()
+
+    def getPendingCount(self):
+        return len(self._pending)
+
+    def isPending(self, seed):
+        """
+          Whether <seed> was sent and not answered yet.
+        """
+        return any(x == seed for x, _ in self._pending)
+
+    def isAvailable(self, now):
+        """
+          Whether a request can be sent, ie. daemon did not fail recently.
+        """
+        return now >= self._retry_after
+
+    def getRetryAfter(self):
+        """
+          When a request can be sent again after a failure.
+        """
+        return self._retry_after
+
+    def isStale(self, now):
+        return bool(self._pending) and \
+          now - self._pending[0][1] > STALE_TIMEOUT
+
+    def send(self, seed, deadline):
+        if self._socket is None:
+            self.statistics['connect'] += 1
+            self._socket = socket.create_connection(
+                self.address,
+                max(deadline - monotonic(), 0.001),
+            )
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Only read when select says so, and requests are small: never
+            # wait for the socket with the authenticator lock held.
+            self._socket.setblocking(False)
+        self._socket.sendall(REQUEST_PREFIX + seed + REQUEST_SUFFIX)
+        self._pending.append((seed, monotonic()))
+        self.statistics['request'] += 1
+
+    def read(self):
+        """
+          Read available data.
+          Return a list of (seed, answer_tuple) for completed requests.
+        """
+        try:
+            data = self._socket.recv(4096)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise AuthenticationError('Connection to %s:%i closed' % (
+              self.address))
+        buf = self._buffer + data
+        result = []
+        answer_length = ANSWER_FRAME_LENGTH * ANSWER_COUNT
+        while len(buf) >= answer_length:
+            if not self._pending:
+                raise AuthenticationError('Unrequested answer from %s:%i' % (
+                  self.address))
+            answer_list = []
+            for offset in range(0, answer_length, ANSWER_FRAME_LENGTH):
+                frame = buf[offset:offset + ANSWER_FRAME_LENGTH]
+                if not frame.startswith(ANSWER_FRAME_HEADER):
+                    raise AuthenticationError('Unexpected frame from %s:%i: '
+                      '%r' % (self.address + (frame, )))
+                answer_list.append(frame[7:-2])
+            buf = buf[answer_length:]
+            seed, sent = self._pending.popleft()
+            latency = monotonic() - sent
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += (latency - self.latency) * LATENCY_WEIGHT
+            self._failure_count = 0
+            self.statistics['answer'] += 1
+            result.append((seed, tuple(answer_list)))
+        self._buffer = buf
+        return result
+
+    def close(self, failed=True):
+        """
+          Drop connection and unanswered requests. If <failed>, wait before
+          reconnecting.
+        """
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._buffer = b''
+        self._pending.clear()
+        if failed:
+            self.statistics['failure'] += 1
+            self._retry_after = monotonic() + min(
+                RECONNECT_DELAY * 2 ** self._failure_count,
+                MAX_RECONNECT_DELAY,
+            )
+            self._failure_count += 1
 
 class SockAuthenticator(object):
     """
-      Class to fetch authentication data through a connection to an
-      authentication server.
+      Class to fetch authentication data through connections to one or more
+      authentication servers.
+      A seed is first sent to the fastest available server. If it did not
+      answer after hedge_delay, the seed is also sent to the next one, and so
+      on. The first answer wins, later ones are only cached. Servers which
+      failed are retried once their reconnection delay is over, within the
+      request timeout.
+      Can be used from several threads, which share connections: while
+      waiting for answers, at most one thread reads them (and caches them)
+      for all others.
     """
-    def __init__(self, ip, port, authentication_cache=None):
+    def __init__(self, address_list, authentication_cache=None,
+            timeout=TIMEOUT, hedge_delay=HEDGE_DELAY):
         """
-          ip (string)
-            Address of the authentication server.
-          port (int)
-            Port of the authentication server.
+          address_list (list of (string, int))
+            Addresses and ports of authentication servers. Each gets one
+            connection, on which requests are pipelined (list an address
+            several times to get several connections to it).
           authentication_cache (dict-ish, or None)
             Used to store and retrieve cached authentication data.
             If None (default), a volatile cache will be used (it will be destroyed
             when the instance is destroyed).
+          timeout (float)
+            Time after which authenticate gives up, in seconds.
+          hedge_delay (float)
+            Time after which a seed is sent to another server, in seconds.
         """
-        self._ip = ip
-        self._port = port
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._connected = False
+        if not address_list:
+            raise ValueError('No authentication server address')
+        self._daemon_list = [_Daemon(x) for x in address_list]
+        self._timeout = timeout
+        self._hedge_delay = hedge_delay
         if authentication_cache is None:
             authentication_cache = {}
         self._authentication_cache = authentication_cache
+        self._request_count = 0
+        self._timeout_count = 0
+        self._hedge_count = 0
+        # Protects all the above. Only held while sending requests and
+        # handling answers, not while waiting for them.
+        self._condition = threading.Condition(threading.Lock())
+        # Whether a thread is waiting for answers, and how to wake it up so
+        # it also waits for requests sent since.
+        self._reading = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+
+    def isCached(self, seed):
+        """
+          Whether answers for <seed> are known without asking server.
+        """
+        with self._condition:
+            return seed in self._authentication_cache
 
     def authenticate(self, seed):
         """
@@ -34,25 +240,180 @@ class SockAuthenticator(object):
 
           Return value: 3-tuple of strings.
         """
+        with self._condition:
+            try:
+                result = self._authentication_cache[seed]
+            except KeyError:
+                if len(seed) != SEED_LENGTH:
+                    raise ValueError('Invalid seed length: %i, expected %i' % (
+                        len(seed), SEED_LENGTH))
+                result = self._request(seed)
+        return result
+
+    def _getNextDaemon(self, now, exclude_list):
+        """
+          Return the fastest available daemon not in <exclude_list>, or None.
+          Idle daemons come first, then daemons which never answered, to get
+          their latency known.
+        """
+        candidate_list = [
+            x for x in self._daemon_list
+            if x not in exclude_list and x.isAvailable(now)
+        ]
+        if not candidate_list:
+            return None
+        return min(
+            candidate_list,
+            key=lambda x: (
+                x.getPendingCount(),
+                -1 if x.latency is None else x.latency,
+            ),
+        )
+
+    def _request(self, seed):
+        """
+          Get answers for <seed> from daemons. Called with lock held.
+        """
+        self._request_count += 1
+        now = monotonic()
+        deadline = now + self._timeout
+        for daemon in self._daemon_list:
+            if daemon.isStale(now):
+                self._close(daemon)
+        daemon_list = self._daemon_list
+        authentication_cache = self._authentication_cache
+        was_pending = False
+        next_send = now
+        while True:
+            try:
+                # Answers are cached by whichever thread read them.
+                return authentication_cache[seed]
+            except KeyError:
+                pass
+            now = monotonic()
+            pending_list = [x for x in daemon_list if x.isPending(seed)]
+            if was_pending and not pending_list:
+                # Daemon(s) failed, resend right away.
+                next_send = now
+            was_pending = bool(pending_list)
+            if now >= deadline:
+                if pending_list:
+                    self._timeout_count += 1
+                    raise AuthenticationTimeout('No authentication answer '
+                      'after %.3fs' % (self._timeout, ))
+                raise AuthenticationError('No authentication server '
+                  'available')
+            if now >= next_send:
+                daemon = self._getNextDaemon(now, pending_list)
+                if daemon is None:
+                    # Wait for a daemon to be retried, unless answered
+                    # before.
+                    next_send = min([
+                        x.getRetryAfter() for x in daemon_list
+                        if x not in pending_list
+                    ] + [deadline])
+                else:
+                    try:
+                        daemon.send(seed, deadline)
+                    except OSError:
+                        self._close(daemon)
+                        # Try next one right away.
+                        continue
+                    if pending_list:
+                        # Still waiting for another daemon.
+                        self._hedge_count += 1
+                    was_pending = True
+                    next_send = now + self._hedge_delay
+                    self._wakeUpReader()
+                    continue
+            self._wait(min(next_send, deadline))
+
+    def _wakeUpReader(self):
+        """
+          Have the thread reading answers, if any, reconsider which
+          connections to read from.
+        """
+        if self._reading:
+            os.write(self._wakeup_write, b'\0')
+
+    def _close(self, daemon):
+        daemon.close()
+        self._wakeUpReader()
+
+    def _wait(self, until):
+        """
+          Wait for answers until <until> at most. Called with lock held.
+        """
+        condition = self._condition
+        if self._reading:
+            # Another thread reads answers, and will notify when it did.
+            condition.wait(max(until - monotonic(), 0))
+            return
+        self._reading = True
+        wakeup_read = self._wakeup_read
+        daemon_dict = {
+            x.fileno(): x for x in self._daemon_list if x.getPendingCount()
+        }
+        condition.release()
         try:
-            result = self._authentication_cache[seed]
-        except KeyError:
-            if len(seed) != SEED_LENGTH:
-                raise ValueError('Invalid seed length: %i, expected %i' % (
-                    len(seed), SEED_LENGTH))
-            sock = self._socket
-            if not self._connected:
-                self._connected = True
-                sock.connect((self._ip, self._port))
-            sock.send('\x55\x5a\x0e\x00\xff\xff\xff\x2b' + seed + '\xff')
-            result = tuple([sock.recv(0x12)[7:-2] for x in range(3)])
-            self._authentication_cache[seed] = result
+            try:
+                readable_list = select.select(
+                    list(daemon_dict) + [wakeup_read],
+                    (),
+                    (),
+                    max(until - monotonic(), 0),
+                )[0]
+            except (OSError, ValueError):
+                # A connection was closed meanwhile.
+                readable_list = ()
+        finally:
+            condition.acquire()
+        try:
+            for fileno in readable_list:
+                if fileno == wakeup_read:
+                    os.read(wakeup_read, 4096)
+                    continue
+                daemon = daemon_dict[fileno]
+                if daemon.fileno() != fileno:
+                    # Closed (and maybe reconnected) meanwhile.
+                    continue
+                try:
+                    answer_list = daemon.read()
+                except (OSError, AuthenticationError):
+                    daemon.close()
+                    continue
+                for answered_seed, answer in answer_list:
+                    # Late and hedged answers are still worth caching.
+                    self._authentication_cache[answered_seed] = answer
+        finally:
+            self._reading = False
+            condition.notify_all()
+
+    def getStatistics(self):
+        """
+          Return per-server statistics, with their latency estimation (in
+          seconds), and the number of uncached seeds, of hedged requests and
+          of timeouts.
+        """
+        with self._condition:
+            result = {
+                'request': self._request_count,
+                'hedge': self._hedge_count,
+                'timeout': self._timeout_count,
+            }
+            for daemon in self._daemon_list:
+                daemon_statistics = dict(daemon.statistics)
+                daemon_statistics['latency'] = daemon.latency
+                result['%s:%i' % daemon.address] = daemon_statistics
         return result
 
 class CachedAuthenticator(object):
     def __init__(self, authentication_cache):
         self._authentication_cache = authentication_cache
 
+    def isCached(self, seed):
+        return seed in self._authentication_cache
+
     def authenticate(self, seed):
         try:
             result = self._authentication_cache[seed]
@@ -60,6 +421,5 @@ class CachedAuthenticator(object):
             # Sleep so auth timeouts
             time.sleep(1)
             # In case it doesn't, provide a dummy default
-            result = ['\x00' * 9] * 3
+            result = [b'\x00' * 9] * 3
         return result
-
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+End-to-end NBD server benchmark.
+
+Serves a card (emulated by default) with NBDServer on a loopback socket, and
+measures throughput and latency of a few workloads as seen by an NBD client.
+"""
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+from time import monotonic
+from auth_daemon import FakeAuthenticationDaemon
+from authenticator import SockAuthenticator
+from block_device import CachedBlockDevice, WriteBackBlockDevice
+from command_trace import CommandTracer
+from emulator import EmulatedAuthenticator, EmulatedMemoryCardAdapter
+from memory_card_reader import (
+    PlayStationMemoryCardReader,
+    PS1_CARD_SIZE,
+    PS2_CARD_SIZE,
+)
+from nbd import (
+    NBDServer,
+    NBD_CMD_DISC,
+    NBD_CMD_FLUSH,
+    NBD_CMD_READ,
+    NBD_CMD_WRITE,
+    NBD_FLAG_C_FIXED_NEWSTYLE,
+    NBD_FLAG_C_NO_ZEROES,
+    NBD_FLAG_SEND_FLUSH,
+    NBD_GREETING_PREFIX,
+    NBD_INFO_EXPORT,
+    NBD_OPT_GO,
+    NBD_OPT_STRUCTURED_REPLY,
+    NBD_REPLY_FLAG_DONE,
+    NBD_REPLY_TYPE_NONE,
+    NBD_REPLY_TYPE_OFFSET_DATA,
+    NBD_REPLY_TYPE_OFFSET_HOLE,
+    NBD_REP_ACK,
+    NBD_REP_INFO,
+    NBD_REQUEST_FORMAT,
+    NBD_REQUEST_MAGIC,
+    NBD_RESPONSE_FORMAT,
+    NBD_RESPONSE_LEN,
+    NBD_RESPONSE_MAGIC,
+    NBD_CLIENT_OPT_MAGIC,
+    NBD_SERVER_OPT_MAGIC,
+    NBD_STRUCTURED_REPLY_FORMAT,
+    NBD_STRUCTURED_REPLY_LEN,
+    NBD_STRUCTURED_REPLY_MAGIC,
+)
+from usb_trace import RecordingUSBDevice, ReplayUSBDevice
+
+class NBDError(Exception):
+    pass
+
+class NBDClient(object):
+    """
+      Minimal NBD client: fixed newstyle handshake, one request at a time.
+    """
+    def __init__(self, address, port, export_name=b'',
+            structured_reply=False):
+        self._sock = sock = socket.create_connection((address, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._handle = 0
+        # When first data of last read was received.
+        self.first_data_time = None
+        if self._recvall(len(NBD_GREETING_PREFIX)) != NBD_GREETING_PREFIX:
+            raise NBDError('Bad greeting')
+        self._recvall(2) # handshake flags
+        sock.sendall(struct.pack(
+            '>I',
+            NBD_FLAG_C_FIXED_NEWSTYLE | NBD_FLAG_C_NO_ZEROES,
+        ))
+        self._structured_reply = structured_reply
+        if structured_reply:
+            self._sendOption(NBD_OPT_STRUCTURED_REPLY)
+            reply_type, _ = self._recvOptionReply()
+            if reply_type != NBD_REP_ACK:
+                raise NBDError('Structured replies refused: %x' % (
+                  reply_type, ))
+        self._sendOption(
+            NBD_OPT_GO,
+            struct.pack('>I', len(export_name)) + export_name +
+              struct.pack('>H', 0),
+        )
+        self.size = self.transmission_flags = None
+        while True:
+            reply_type, data = self._recvOptionReply()
+            if reply_type == NBD_REP_ACK:
+                break
+            if reply_type != NBD_REP_INFO:
+                raise NBDError('Option refused: %x' % (reply_type, ))
+            info_type, = struct.unpack('>H', data[:2])
+            if info_type == NBD_INFO_EXPORT:
+                self.size, self.transmission_flags = struct.unpack(
+                    '>QH',
+                    data[2:],
+                )
+
+    def _sendOption(self, option, value=b''):
+        self._sock.sendall(NBD_CLIENT_OPT_MAGIC + struct.pack(
+            '>II',
+            option,
+            len(value),
+        ) + value)
+
+    def _recvOptionReply(self):
+        magic, _, reply_type, length = struct.unpack(
+            '>8sIII',
+            self._recvall(20),
+        )
+        if magic != NBD_SERVER_OPT_MAGIC:
+            raise NBDError('Bad option reply magic: %r' % (magic, ))
+        return reply_type, self._recvall(length)
+
+    def _recvStructuredRead(self, handle, offset, length):
+        result = bytearray(length)
+        while True:
+            magic, flags, reply_type, reply_handle, chunk_length = \
+              struct.unpack(
+                NBD_STRUCTURED_REPLY_FORMAT,
+                self._recvall(NBD_STRUCTURED_REPLY_LEN),
+            )
+            if magic != NBD_STRUCTURED_REPLY_MAGIC or reply_handle != handle:
+                raise NBDError('Bad structured reply header')
+            data = self._recvall(chunk_length)
+            if reply_type in (
+                        NBD_REPLY_TYPE_OFFSET_DATA,
+                        NBD_REPLY_TYPE_OFFSET_HOLE,
+                    ):
+                if self.first_data_time is None:
+                    self.first_data_time = monotonic()
+                chunk_offset, = struct.unpack('>Q', data[:8])
+                start = chunk_offset - offset
+                if reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+                    result[start:start + chunk_length - 8] = data[8:]
+                else:
+                    hole_length, = struct.unpack('>I', data[8:])
+                    result[start:start + hole_length] = bytes(hole_length)
+            elif reply_type != NBD_REPLY_TYPE_NONE:
+                error, = struct.unpack('>I', data[:4])
+                raise NBDError('Request failed with error %i: %s' % (
+                  error, data[6:6 + struct.unpack('>H', data[4:6])[0]]))
+            if flags & NBD_REPLY_FLAG_DONE:
+                return bytes(result)
+
+    def _recvall(self, length):
+        result = bytearray()
+        while len(result) < length:
+            data = self._sock.recv(length - len(result))
+            if not data:
+                raise NBDError('Connection closed by server')
+            result += data
+        return bytes(result)
+
+    def _request(self, command, offset=0, length=0, data=b'', flags=0):
+        self._handle += 1
+        handle = struct.pack('>Q', self._handle)
+        self._sock.sendall(struct.pack(
+            NBD_REQUEST_FORMAT,
+            NBD_REQUEST_MAGIC,
+            flags,
+            command,
+            handle,
+            offset,
+            length,
+        ) + data)
+        if command == NBD_CMD_DISC:
+            return None
+        self.first_data_time = None
+        if command == NBD_CMD_READ and self._structured_reply:
+            return self._recvStructuredRead(handle, offset, length)
+        magic, error, reply_handle = struct.unpack(
+            NBD_RESPONSE_FORMAT,
+            self._recvall(NBD_RESPONSE_LEN),
+        )
+        if magic != NBD_RESPONSE_MAGIC or reply_handle != handle:
+            raise NBDError('Bad reply header')
+        if error:
+            raise NBDError('Request failed with error %i' % (error, ))
+        if command == NBD_CMD_READ:
+            self.first_data_time = monotonic()
+            return self._recvall(length)
+        return None
+
+    def read(self, offset, length):
+        return self._request(NBD_CMD_READ, offset, length)
+
+    def write(self, offset, data):
+        self._request(NBD_CMD_WRITE, offset, len(data), data)
+
+    def flush(self):
+        if self.transmission_flags & NBD_FLAG_SEND_FLUSH:
+            self._request(NBD_CMD_FLUSH)
+
+    def close(self):
+        try:
+            self._request(NBD_CMD_DISC)
+        finally:
+            self._sock.close()
+
+def serve(listen_sock, device):
+    """
+      Serve NBD clients connecting to <listen_sock> one after another.
+    """
+    while True:
+        try:
+            client_sock, _ = listen_sock.accept()
+        except OSError:
+            # Listening socket closed, benchmark is over.
+            break
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server = NBDServer(sock=client_sock, device=device)
+        if server.greet():
+            while server.handle():
+                pass
+
+def percentile(sorted_value_list, ratio):
+    return sorted_value_list[int(round(ratio * (len(sorted_value_list) - 1)))]
+
+# Workloads: generators of (is_write, offset, length)
+def sequentialRead(size, request_size, request_count):
+    for offset in range(0, min(size, request_size * request_count),
+            request_size):
+        yield False, offset, min(request_size, size - offset)
+
+def randomRead(size, request_size, request_count):
+    for _ in range(request_count):
+        yield False, random.randrange(size // request_size) * request_size, \
+          request_size
+
+def unalignedWrite(size, request_size, request_count):
+    for _ in range(request_count):
+        yield True, random.randrange(1, size - request_size), request_size
+
+def mixed(size, request_size, request_count):
+    for _ in range(request_count):
+        if random.random() < .7:
+            yield False, random.randrange(size // request_size) * \
+              request_size, request_size
+        else:
+            yield True, random.randrange(1, size - request_size), request_size
+
+WORKLOAD_DICT = {
+    'sequential_read': sequentialRead,
+    'random_read': randomRead,
+    'unaligned_write': unalignedWrite,
+    'mixed': mixed,
+}
+
+def runWorkload(client, workload, request_size, request_count,
+        getTransferCount):
+    latency_list = []
+    append = latency_list.append
+    # Time until the first read data is received.
+    first_data_latency_list = []
+    byte_count = 0
+    transfer_count = getTransferCount()
+    start = monotonic()
+    for is_write, offset, length in WORKLOAD_DICT[workload](
+                client.size, request_size, request_count,
+            ):
+        request_start = monotonic()
+        if is_write:
+            client.write(offset, os.urandom(length))
+        else:
+            client.read(offset, length)
+            first_data_latency_list.append(
+                client.first_data_time - request_start,
+            )
+        append(monotonic() - request_start)
+        byte_count += length
+    client.flush()
+    duration = monotonic() - start
+    latency_list.sort()
+    first_data_latency_list.sort()
+    if first_data_latency_list:
+        first_data_p50 = percentile(first_data_latency_list, .5)
+    else:
+        first_data_p50 = None
+    return {
+        'workload': workload,
+        'request_size': request_size,
+        'request_count': len(latency_list),
+        'byte_count': byte_count,
+        'duration': duration,
+        'mb_per_s': byte_count / duration / 1e6,
+        'latency_p50': percentile(latency_list, .5),
+        'latency_p99': percentile(latency_list, .99),
+        'first_data_p50': first_data_p50,
+        'usb_transfers_per_request': (
+            getTransferCount() - transfer_count
+        ) / len(latency_list),
+    }
+
+def compare(result_list, reference_path):
+    with open(reference_path) as reference_file:
+        reference_dict = {
+            (x['workload'], x['request_size']): x
+            for x in json.load(reference_file)['result_list']
+        }
+    for result in result_list:
+        reference = reference_dict.get(
+            (result['workload'], result['request_size']),
+        )
+        if reference is None:
+            continue
+        print('%-16s %8i  MB/s x%.2f  p50 x%.2f  p99 x%.2f' % (
+            result['workload'],
+            result['request_size'],
+            result['mb_per_s'] / reference['mb_per_s'],
+            result['latency_p50'] / reference['latency_p50'],
+            result['latency_p99'] / reference['latency_p99'],
+        ))
+
+def main(options):
+    if options.replay:
+        adapter = ReplayUSBDevice(options.replay, speed=options.replay_speed)
+    else:
+        adapter = getEmulatedAdapter(options)
+    usb_device = adapter
+    trace_file = None
+    if options.record:
+        trace_file = open(options.record, 'wb')
+        usb_device = RecordingUSBDevice(adapter, trace_file)
+    try:
+        _main(options, adapter, usb_device)
+    finally:
+        if trace_file is not None:
+            trace_file.close()
+
+def getEmulatedAdapter(options):
+    if options.image is None:
+        image_file = tempfile.NamedTemporaryFile(suffix='.img')
+        image_file.write(os.urandom({
+            'ps1': PS1_CARD_SIZE,
+            'ps2': PS2_CARD_SIZE,
+        }[options.card_type]))
+        image_file.flush()
+        image_path = image_file.name
+    else:
+        image_path = options.image
+    # Writes are only kept in memory.
+    return EmulatedMemoryCardAdapter(
+        image_path,
+        latency=options.latency,
+        byte_latency=options.byte_latency,
+        command_latency=options.command_latency,
+        loss_rate=options.loss_rate,
+        random_seed=options.seed,
+    )
+
+def _main(options, adapter, usb_device):
+    tracer = CommandTracer() if options.trace else None
+    auth_daemon = None
+    if options.auth_daemon:
+        auth_daemon = FakeAuthenticationDaemon(
+            latency=options.auth_latency,
+            jitter=options.auth_jitter,
+            random_seed=options.seed,
+        )
+        authenticator = SockAuthenticator([auth_daemon.start()])
+    else:
+        authenticator = EmulatedAuthenticator()
+    reader = PlayStationMemoryCardReader(
+        usb_device,
+        authenticator,
+        usb_context=adapter if options.pipeline_depth > 1 else None,
+        pipeline_depth=options.pipeline_depth,
+        tracer=tracer,
+    )
+    device = reader
+    if options.cache_size:
+        device = CachedBlockDevice(device, options.cache_size)
+    if options.write_back:
+        device = WriteBackBlockDevice(
+            device,
+            max_dirty_count=options.write_back,
+            max_dirty_age=options.write_back_age,
+        )
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(1)
+    server_thread = threading.Thread(
+        target=serve,
+        args=(listen_sock, device),
+        daemon=True,
+    )
+    server_thread.start()
+    random.seed(options.seed)
+    result_list = []
+    try:
+        for workload in options.workload.split(','):
+            for request_size in options.request_size.split(','):
+                client = NBDClient(
+                    *listen_sock.getsockname(),
+                    structured_reply=options.structured_reply
+                )
+                try:
+                    result = runWorkload(
+                        client,
+                        workload,
+                        int(request_size),
+                        options.request_count,
+                        lambda: adapter.getStatistics()['transfer'],
+                    )
+                finally:
+                    client.close()
+                result_list.append(result)
+                if tracer is not None:
+                    print(tracer.format())
+                    tracer.reset()
+                line = '%(workload)-16s %(request_size)8i  %(mb_per_s)8.3f ' \
+                  'MB/s  p50 %(latency_p50)8.5fs  p99 %(latency_p99)8.5fs' \
+                  '  %(usb_transfers_per_request)8.1f transfers/request' % \
+                  result
+                if result['first_data_p50'] is not None:
+                    line += '  first data p50 %8.5fs' % (
+                      result['first_data_p50'], )
+                print(line)
+    finally:
+        listen_sock.close()
+        if auth_daemon is not None:
+            auth_daemon.stop()
+    if auth_daemon is not None:
+        print('Authentication: %r' % (authenticator.getStatistics(), ))
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(
+                {
+                    'option_dict': vars(options),
+                    'result_list': result_list,
+                },
+                output_file,
+                indent=2,
+                sort_keys=True,
+            )
+    if options.compare:
+        compare(result_list, options.compare)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option('-i', '--image',
+      help='Card image to serve. Default: random content.')
+    parser.add_option('-t', '--card-type', default='ps2',
+      help='Type of card to generate when no image is given: ps1 or ps2.')
+    parser.add_option('-w', '--workload',
+      default=','.join(sorted(WORKLOAD_DICT)),
+      help='Coma-separated list of workloads to run, among: %s' % (
+        ', '.join(sorted(WORKLOAD_DICT))))
+    parser.add_option('-s', '--request-size', default='4096,65536',
+      help='Coma-separated list of request sizes, in bytes.')
+    parser.add_option('-n', '--request-count', default=64, type='int',
+      help='Number of requests per workload and request size.')
+    parser.add_option('-l', '--latency', default=.001, type='float',
+      help='Emulated latency of each USB transfer, in seconds.')
+    parser.add_option('--byte-latency', default=1e-6, type='float',
+      help='Emulated transfer time per byte, in seconds.')
+    parser.add_option('--command-latency', default=0, type='float',
+      help='Emulated device time per command, in seconds.')
+    parser.add_option('--loss-rate', default=0, type='float',
+      help='Probability for the emulated device to ignore a command.')
+    parser.add_option('-a', '--auth-daemon', default=False,
+      action='store_true',
+      help='Authenticate PS2 cards through a local fake authentication '
+      'daemon, to include its overhead.')
+    parser.add_option('--auth-latency', default=.1, type='float',
+      help='Time, in seconds, the fake authentication daemon takes to '
+      'answer.')
+    parser.add_option('--auth-jitter', default=0, type='float',
+      help='Maximum random extra time, in seconds, the fake authentication '
+      'daemon takes to answer.')
+    parser.add_option('-d', '--pipeline-depth', default=8, type='int',
+      help='Number of read commands in flight. 1 for synchronous reads.')
+    parser.add_option('-C', '--cache-size', default=0, type='int',
+      help='Number of card blocks to keep in memory. 0 to disable.')
+    parser.add_option('-W', '--write-back', default=0, type='int',
+      help='Number of modified blocks to keep in memory. 0 to disable.')
+    parser.add_option('--write-back-age', default=5, type='float',
+      help='Maximum time, in seconds, modified blocks are kept in memory.')
+    parser.add_option('-S', '--structured-reply', default=False,
+      action='store_true',
+      help='Negotiate structured replies, so read data is streamed.')
+    parser.add_option('-T', '--trace', default=False, action='store_true',
+      help='Print per-command latency histograms of each run.')
+    parser.add_option('-R', '--record',
+      help='Record USB transfers to given trace file.')
+    parser.add_option('-p', '--replay',
+      help='Replay USB transfers from given trace file instead of emulating '
+      'a card. Other options must be the same as when recording, except '
+      'for pipeline depth.')
+    parser.add_option('--replay-speed', default=1, type='float',
+      help='How much faster than recorded replayed device responds. 0 to '
+      'respond immediately.')
+    parser.add_option('-r', '--seed', default=0, type='int',
+      help='Random seed, for reproducible workloads.')
+    parser.add_option('-o', '--output',
+      help='Where to save results, as JSON.')
+    parser.add_option('-c', '--compare',
+      help='Results of a previous run to compare with.')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments: %r' % (args, ))
+    sys.exit(main(options))
@@ -0,0 +1,412 @@
+from collections import OrderedDict
+from functools import partial
+from time import monotonic
+
+def _copyBlock(view, skip, block_length, index, data):
+    """
+      Copy the part of <data>, the <index>th block of a read, which belongs in
+      <view>, given <view> starts <skip> bytes after the first block start.
+    """
+    assert len(data) == block_length, len(data)
+    position = index * block_length - skip
+    start = max(0, -position)
+    end = min(block_length, len(view) - position)
+    if start < end:
+        view[position + start:position + end] = data[start:end]
+
+class BlockDevice(object):
+    """
+      Byte-addressed access to a device only accessible by whole blocks.
+
+      Subclasses must implement the following methods:
+        getSize() -> int
+          Size of the underlying storage.
+        getPageSize() -> int
+          Size of one block.
+        readBlocks(block_number, count) -> list of strings
+          Read <count> consecutive blocks starting at <block_number>.
+        writeBlock(block_number, data)
+          Write one block.
+    """
+
+    def read(self, offset, length):
+        """
+          Read data starting at <offset> bytes for <length> bytes.
+
+          offset & length can be of arbitrary values, as long as they fit in
+          device space.
+        """
+        result = bytearray(length)
+        self.readinto(offset, result)
+        return result
+
+    def readinto(self, offset, buf):
+        """
+          Read len(buf) bytes starting at <offset> into <buf>, which must
+          support the writable buffer interface (ex: a bytearray, or a
+          memoryview of one).
+        """
+        length = len(buf)
+        block_length = self.getPageSize()
+        if offset + length > self.getSize():
+            raise ValueError('Trying to read out of card.')
+        current_block, start_offset = divmod(offset, block_length)
+        self.readBlocksInto(
+            current_block,
+            -(-(start_offset + length) // block_length),
+            buf,
+            start_offset,
+        )
+
+    def readChunks(self, offset, length, onChunk):
+        """
+          Read <length> bytes starting at <offset>, calling
+          onChunk(chunk_offset, data) with consecutive parts of them, in
+          order, as soon as they are available.
+          If reading fails, parts before the error were given to onChunk by
+          the time the exception is raised.
+          <data> is only valid during onChunk call.
+        """
+        block_length = self.getPageSize()
+        if offset + length > self.getSize():
+            raise ValueError('Trying to read out of card.')
+        current_block, start_offset = divmod(offset, block_length)
+        end = offset + length
+        def onBlock(index, data):
+            block_offset = (current_block + index) * block_length
+            start = max(offset, block_offset)
+            stop = min(end, block_offset + block_length)
+            onChunk(start, data[start - block_offset:stop - block_offset])
+        self.streamBlocks(
+            current_block,
+            -(-(start_offset + length) // block_length),
+            onBlock,
+        )
+
+    def streamBlocks(self, block_number, count, onBlock):
+        """
+          Read <count> consecutive blocks starting at <block_number>, calling
+          onBlock(index, data) for each of them, in order. <data> may only be
+          valid during onBlock call.
+          Subclasses may override this to call onBlock before all blocks are
+          read.
+        """
+        for index, data in enumerate(self.readBlocks(block_number, count)):
+            onBlock(index, data)
+
+    def readBlocksInto(self, block_number, count, buf, skip=0):
+        """
+          Read <count> consecutive blocks starting at <block_number>, and
+          store them into <buf>, skipping the first <skip> bytes of the first
+          block and stopping at the end of buf.
+          Subclasses may override this to avoid intermediate copies.
+        """
+        copyBlock = partial(_copyBlock, memoryview(buf), skip,
+          self.getPageSize())
+        for index, data in enumerate(self.readBlocks(block_number, count)):
+            copyBlock(index, data)
+
+    def write(self, offset, data):
+        """
+          Write <data> starting at <offset>.
+
+          offset & data length can be of arbitrary values, as long as they fit in
+          device space. This function will take care reading existing block
+          data if write does not start and/or stop on an underlying block boundary.
+        """
+        block_length = self.getPageSize()
+        if offset + len(data) > self.getSize():
+            raise ValueError('Trying to write out of card.')
+        current_block, start_offset = divmod(offset, block_length)
+        if start_offset:
+            data = self.readBlocks(current_block, 1)[0][:start_offset] + data
+        while len(data) >= block_length:
+            to_write, data = data[:block_length], data[block_length:]
+            self.writeBlock(current_block, to_write)
+            current_block += 1
+        data_len = len(data)
+        if data_len:
+            self.writeBlock(
+                current_block,
+                data + self.readBlocks(current_block, 1)[0][data_len:],
+            )
+
+class CachedBlockDevice(BlockDevice):
+    """
+      Keep recently accessed blocks of another block device in memory.
+
+      Blocks are identified by the card they come from (as per
+      getCardIdentity) and their number, so a card change never serves
+      blocks from another card. Writes go through to the underlying device,
+      replacing the cached copy of written blocks.
+    """
+
+    def __init__(self, device, max_block_count):
+        """
+          device (PlayStationMemoryCardReader)
+            Device to cache blocks of. Must implement BlockDevice's block
+            access methods and getCardIdentity() -> object.
+          max_block_count (int)
+            Maximum number of blocks to keep in memory. Least recently used
+            blocks get evicted first.
+        """
+        self._device = device
+        self._max_block_count = max_block_count
+        self._block_dict = OrderedDict()
+        self._hit_count = 0
+        self._miss_count = 0
+        self._eviction_count = 0
+
+    def getSize(self):
+        return self._device.getSize()
+
+    def getPageSize(self):
+        return self._device.getPageSize()
+
+    def getCardIdentity(self):
+        return self._device.getCardIdentity()
+
+    def _store(self, key, data):
+        block_dict = self._block_dict
+        block_dict[key] = data
+        block_dict.move_to_end(key)
+        while len(block_dict) > self._max_block_count:
+            block_dict.popitem(last=False)
+            self._eviction_count += 1
+
+    def readBlocks(self, block_number, count):
+        result = []
+        self.streamBlocks(
+            block_number,
+            count,
+            lambda index, data: result.append(data),
+        )
+        return result
+
+    def streamBlocks(self, block_number, count, onBlock):
+        identity = self._device.getCardIdentity()
+        block_dict = self._block_dict
+        end_block = block_number + count
+        current_block = block_number
+        while current_block < end_block:
+            key = (identity, current_block)
+            data = block_dict.get(key)
+            if data is not None:
+                self._hit_count += 1
+                block_dict.move_to_end(key)
+                onBlock(current_block - block_number, data)
+                current_block += 1
+                continue
+            # Fetch all consecutive missing blocks in a single device access.
+            miss_end_block = current_block + 1
+            while miss_end_block < end_block and \
+                    (identity, miss_end_block) not in block_dict:
+                miss_end_block += 1
+            miss_count = miss_end_block - current_block
+            self._miss_count += miss_count
+            def onMiss(index, data, first_block=current_block):
+                data = bytes(data)
+                self._store((identity, first_block + index), data)
+                onBlock(first_block - block_number + index, data)
+            self._device.streamBlocks(current_block, miss_count, onMiss)
+            current_block = miss_end_block
+
+    def writeBlock(self, block_number, data):
+        identity = self._device.getCardIdentity()
+        key = (identity, block_number)
+        self._block_dict.pop(key, None)
+        self._device.writeBlock(block_number, data)
+        self._store(key, data)
+
+    def getStatistics(self):
+        """
+          Return a dict of cache usage counters.
+        """
+        return {
+            'hit': self._hit_count,
+            'miss': self._miss_count,
+            'eviction': self._eviction_count,
+            'size': len(self._block_dict),
+            'max_size': self._max_block_count,
+        }
+
+def _merge(base, data, mask):
+    """
+      Return a copy of <base> with bytes from <data> where <mask> is non-zero.
+    """
+    result = bytearray(base)
+    start = mask.find(1)
+    while start != -1:
+        end = mask.find(0, start)
+        if end == -1:
+            end = len(mask)
+        result[start:end] = data[start:end]
+        start = mask.find(1, end)
+    return result
+
+class WriteBackBlockDevice(BlockDevice):
+    """
+      Buffer writes to another block device in memory.
+
+      Partial block writes are merged into dirty blocks, which only get read
+      from the underlying device when they are not entirely overwritten by
+      the time they are flushed. Dirty blocks are flushed in ascending block
+      order when flush() is called, when there are too many of them, or when
+      the oldest one is too old.
+    """
+
+    def __init__(self, device, max_dirty_count, max_dirty_age):
+        """
+          device (PlayStationMemoryCardReader)
+            Device to buffer writes for. Must implement BlockDevice's block
+            access methods and getCardIdentity() -> object.
+          max_dirty_count (int)
+            Number of dirty blocks above which all dirty blocks are flushed.
+          max_dirty_age (float)
+            Number of seconds after which a dirty block must be flushed.
+            See also flushIfExpired.
+        """
+        self._device = device
+        self._max_dirty_count = max_dirty_count
+        self._max_dirty_age = max_dirty_age
+        # block_number: (data, mask)
+        # mask is non-zero where data was written to.
+        self._dirty_dict = {}
+        self._dirty_identity = None
+        self._dirty_since = None
+
+    def getSize(self):
+        return self._device.getSize()
+
+    def getPageSize(self):
+        return self._device.getPageSize()
+
+    def getCardIdentity(self):
+        return self._device.getCardIdentity()
+
+    def _checkIdentity(self):
+        identity = self._device.getCardIdentity()
+        if identity != self._dirty_identity:
+            lost_count = len(self._dirty_dict)
+            self._dirty_dict = {}
+            self._dirty_identity = identity
+            self._dirty_since = None
+            if lost_count:
+                raise ValueError('Card changed, %i unflushed blocks lost' % (
+                  lost_count, ))
+
+    def readBlocks(self, block_number, count):
+        self._checkIdentity()
+        if not self._dirty_dict:
+            return self._device.readBlocks(block_number, count)
+        result = []
+        # Note: clean blocks come from the underlying device's streamBlocks,
+        # so they are only valid during the callback.
+        self.streamBlocks(
+            block_number,
+            count,
+            lambda index, data: result.append(bytes(data)),
+        )
+        return result
+
+    def streamBlocks(self, block_number, count, onBlock):
+        self._checkIdentity()
+        dirty_dict = self._dirty_dict
+        end_block = block_number + count
+        current_block = block_number
+        while current_block < end_block:
+            try:
+                data, mask = dirty_dict[current_block]
+            except KeyError:
+                # Fetch all consecutive clean blocks in a single device access.
+                clean_end_block = current_block + 1
+                while clean_end_block < end_block and \
+                        clean_end_block not in dirty_dict:
+                    clean_end_block += 1
+                def onCleanBlock(index, data,
+                        skip=current_block - block_number):
+                    onBlock(skip + index, data)
+                self._device.streamBlocks(
+                    current_block,
+                    clean_end_block - current_block,
+                    onCleanBlock,
+                )
+                current_block = clean_end_block
+                continue
+            if 0 in mask:
+                data = _merge(
+                    self._device.readBlocks(current_block, 1)[0],
+                    data,
+                    mask,
+                )
+            onBlock(current_block - block_number, bytes(data))
+            current_block += 1
+
+    def writeBlock(self, block_number, data):
+        self.write(block_number * self.getPageSize(), data)
+
+    def write(self, offset, data):
+        """
+          Write <data> starting at <offset>.
+
+          Data is only stored in memory, until next flush.
+        """
+        self._checkIdentity()
+        block_length = self.getPageSize()
+        length = len(data)
+        if offset + length > self.getSize():
+            raise ValueError('Trying to write out of card.')
+        dirty_dict = self._dirty_dict
+        if self._dirty_since is None:
+            self._dirty_since = monotonic()
+        data = memoryview(data)
+        position = 0
+        while position < length:
+            block_number, block_offset = divmod(offset + position, block_length)
+            chunk_length = min(block_length - block_offset, length - position)
+            try:
+                block_data, mask = dirty_dict[block_number]
+            except KeyError:
+                block_data = bytearray(block_length)
+                mask = bytearray(block_length)
+                dirty_dict[block_number] = (block_data, mask)
+            block_end = block_offset + chunk_length
+            block_data[block_offset:block_end] = \
+              data[position:position + chunk_length]
+            mask[block_offset:block_end] = b'\x01' * chunk_length
+            position += chunk_length
+        if len(dirty_dict) > self._max_dirty_count:
+            self.flush()
+        else:
+            self.flushIfExpired()
+
+    def flushIfExpired(self):
+        """
+          Flush dirty blocks if the oldest one is older than max_dirty_age.
+          To be called periodically.
+        """
+        dirty_since = self._dirty_since
+        if dirty_since is not None and \
+                monotonic() - dirty_since >= self._max_dirty_age:
+            self.flush()
+
+    def flush(self):
+        """
+          Write all dirty blocks to underlying device, in ascending block order.
+        """
+        self._checkIdentity()
+        dirty_dict = self._dirty_dict
+        device = self._device
+        for block_number in sorted(dirty_dict):
+            data, mask = dirty_dict[block_number]
+            if 0 in mask:
+                data = _merge(device.readBlocks(block_number, 1)[0], data, mask)
+            device.writeBlock(block_number, bytes(data))
+            del dirty_dict[block_number]
+        self._dirty_since = None
+
+    def getDirtyCount(self):
+        """
+          Return the number of blocks waiting to be flushed.
+        """
+        return len(self._dirty_dict)
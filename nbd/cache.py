@@ -1,7 +1,38 @@
-from struct import pack, unpack, calcsize
+from hashlib import blake2b
+import mmap
+import os
+import select
+import socket
+from struct import pack, unpack, calcsize, Struct
+import sys
+import threading
+from time import monotonic
 LEN_FORMAT = '>h'
 LEN_LEN = calcsize(LEN_FORMAT)
 
+# MappedDictCache file format: header (magic, slot count, entry count), then
+# slots: state (SLOT_EMPTY or SLOT_USED), key, answers.
+MAPPED_CACHE_MAGIC = b'PSMCAUTH'
+MAPPED_CACHE_HEADER = Struct('<8sII')
+SLOT_EMPTY = 0
+SLOT_USED = 1
+KEY_LENGTH = 9
+ANSWER_COUNT = 3
+ANSWER_LENGTH = 9
+SLOT_LENGTH = 1 + KEY_LENGTH + ANSWER_COUNT * ANSWER_LENGTH
+INITIAL_SLOT_COUNT = 1024
+
+# Cache service (see cache_server.py) messages: a code, a key, and for
+# SHARED_CACHE_SET and SHARED_CACHE_VALUE, answers.
+SHARED_CACHE_GET = b'G'
+SHARED_CACHE_SET = b'S'
+SHARED_CACHE_VALUE = b'V'
+SHARED_CACHE_NOT_FOUND = b'N'
+SHARED_CACHE_KEY_LENGTH = 1 + KEY_LENGTH
+SHARED_CACHE_VALUE_LENGTH = SHARED_CACHE_KEY_LENGTH + \
+  ANSWER_COUNT * ANSWER_LENGTH
+SHARED_CACHE_TIMEOUT = 0.1
+
 class FileDictCache(object):
     """
       Simple (de)pickler class for a dictionary of the following structure:
@@ -13,9 +44,16 @@ class FileDictCache(object):
       Important note: the file is only appended to, so updating a dictionary
       entry will actualy append the new value to file.
       Also, there is no support for deleting a dict entry.
+
+      Modified entries are written to file in groups, when there are
+      flush_count of them, when flushIfExpired is called and the oldest one
+      is older than flush_interval, and on flush/close. Unwritten entries are
+      lost if the process dies.
+      Can be used from several threads.
     """
 
-    def __init__(self, filename, read_only=True):
+    def __init__(self, filename, read_only=True, flush_count=1,
+            flush_interval=None, fsync=False):
         """
           Fetches data from file to populate in-ram dictionary.
 
@@ -23,8 +61,21 @@ class FileDictCache(object):
             Name of the file containing pickled data.
           read_only (bool)
             Whether this class should be allowed to write to file.
+          flush_count (int)
+            Number of modified entries which triggers a write to file.
+          flush_interval (float, or None)
+            Maximum age, in seconds, of modified entries before
+            flushIfExpired writes them. None to only rely on flush_count.
+          fsync (bool)
+            Whether writes must reach the disk (and not just the OS) before
+            flush returns.
         """
         self._read_only = read_only
+        self._flush_count = flush_count
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._dirty_since = None
         if read_only:
             mode = 'r'
         else:
@@ -82,28 +133,60 @@ class FileDictCache(object):
     def __getitem__(self, key):
         return self._cache[key]
 
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def items(self):
+        return self._cache.items()
+
     def __setitem__(self, key, value):
         if not isinstance(value, tuple):
             raise TypeError('Value must be a tuple: %r (%s)' % (value,
               type(value)))
         for item in value:
-            if not isinstance(item, str):
-                raise TypeError('Value elements must be strings: %r (%s) ' \
+            if not isinstance(item, bytes):
+                raise TypeError('Value elements must be bytes: %r (%s) ' \
                   'for value %r' % (item, type(item), value))
-        self._cache[key] = value
-        if not self._read_only:
-            self._cache_to_save[key] = value
-            self.flush() # XXX
+        with self._lock:
+            self._cache[key] = value
+            if not self._read_only:
+                self._cache_to_save[key] = value
+                if self._dirty_since is None:
+                    self._dirty_since = monotonic()
+                if len(self._cache_to_save) >= self._flush_count:
+                    self._flush()
+
+    def flushIfExpired(self):
+        """
+          Store modified entries in file if the oldest one is older than
+          flush_interval. To be called periodically.
+        """
+        dirty_since = self._dirty_since
+        if self._flush_interval is not None and dirty_since is not None and \
+                monotonic() - dirty_since >= self._flush_interval:
+            self.flush()
 
     def flush(self):
         """
           Store modified entries in file.
+        """
+        with self._lock:
+            self._flush()
 
-          XXX: This is currently always called after a __setitem__. This might
-          change, so better to call it explicitely before destructing an instance
-          of this class, otherwise you will loose unsaved data.
+    def close(self):
+        """
+          Store modified entries in file, and close it.
         """
-        if not self._read_only:
+        with self._lock:
+            self._flush()
+            if not self._read_only:
+                self._cache_file.close()
+
+    def _flush(self):
+        if not self._read_only and self._cache_to_save:
             write = self._cache_file.write
 
             def writeLength(length):
@@ -119,6 +202,473 @@ class FileDictCache(object):
                 for item in value:
                     writeData(item)
             self._cache_file.flush()
+            if self._fsync:
+                os.fsync(self._cache_file.fileno())
 
             self._cache_to_save = {}
+            self._dirty_since = None
+
+
+def _createMappedFile(filename, slot_count):
+    with open(filename, 'wb') as cache_file:
+        cache_file.write(MAPPED_CACHE_HEADER.pack(
+            MAPPED_CACHE_MAGIC,
+            slot_count,
+            0,
+        ))
+        cache_file.truncate(MAPPED_CACHE_HEADER.size + slot_count * SLOT_LENGTH)
+
+class MappedDictCache(object):
+    """
+      Authentication data cache, stored as a memory-mapped hash table of
+      fixed-size records: opening does not read the file, and lookups only
+      touch the few records they probe.
+      Keys must be KEY_LENGTH bytes, values tuples of ANSWER_COUNT strings of
+      ANSWER_LENGTH bytes.
+
+      Updating an entry overwrites it in place. When the table gets half
+      full, it is rewritten (with twice as many slots) to a new file,
+      replacing the previous one.
+      Can be used from several threads, but only by one process at a time:
+      entry count is kept in memory, and other processes would keep using
+      the replaced file after a rewrite. Processes share a cache file through
+      a cache service (see cache_server.py and SharedDictCache).
+      Modified entries are in the file as soon as they are set, so they
+      survive the process. When fsync is enabled, they are forced to disk in
+      groups, when there are flush_count of them, when flushIfExpired is
+      called and the oldest one is older than flush_interval, and on
+      flush/close. Otherwise, the OS writes them back at its own pace.
+    """
+
+    def __init__(self, filename, read_only=True, flush_count=1,
+            flush_interval=None, fsync=False):
+        """
+          filename (string)
+            Name of the file containing cached data. Created if missing and
+            not read_only.
+          read_only (bool)
+            Whether this class should be allowed to write to file. If not,
+            new entries are only kept in memory.
+          flush_count (int)
+            Number of modified entries which triggers forcing them to disk.
+          flush_interval (float, or None)
+            Maximum age, in seconds, of modified entries before
+            flushIfExpired forces them to disk. None to only rely on
+            flush_count.
+          fsync (bool)
+            Whether modified entries must be forced to disk at all, following
+            flush_count and flush_interval.
+        """
+        self._filename = filename
+        self._read_only = read_only
+        self._flush_count = flush_count
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        # Also protects mapping from being used while _grow replaces it.
+        self._lock = threading.Lock()
+        # Entries which could not be stored because of read_only.
+        self._volatile_dict = {}
+        # Number of entries modified since last flush, and since when.
+        self._dirty_count = 0
+        self._dirty_since = None
+        if not read_only and (
+                    not os.path.exists(filename) or
+                    not os.path.getsize(filename)
+                ):
+            _createMappedFile(filename, INITIAL_SLOT_COUNT)
+        self._open()
+
+    def _open(self):
+        read_only = self._read_only
+        with open(self._filename, 'rb' if read_only else 'r+b') as cache_file:
+            self._mmap = mmap.mmap(
+                cache_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE,
+            )
+        magic, self._slot_count, self._entry_count = \
+          MAPPED_CACHE_HEADER.unpack_from(self._mmap)
+        if magic != MAPPED_CACHE_MAGIC or len(self._mmap) != \
+                MAPPED_CACHE_HEADER.size + self._slot_count * SLOT_LENGTH:
+            self._mmap.close()
+            raise ValueError('%s is not a mapped cache file' % (
+              self._filename, ))
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._mmap.close()
+
+    def _find(self, key):
+        """
+          Return the offset of the slot containing <key>, or of the empty slot
+          where it would go, and whether key was found.
+        """
+        data = self._mmap
+        slot_count = self._slot_count
+        slot = int.from_bytes(
+            blake2b(key, digest_size=8).digest(),
+            'little',
+        ) % slot_count
+        while True:
+            offset = MAPPED_CACHE_HEADER.size + slot * SLOT_LENGTH
+            if data[offset] == SLOT_EMPTY:
+                return offset, False
+            if data[offset + 1:offset + 1 + KEY_LENGTH] == key:
+                return offset, True
+            slot = (slot + 1) % slot_count
+
+    def __getitem__(self, key):
+        try:
+            return self._volatile_dict[key]
+        except KeyError:
+            pass
+        if len(key) != KEY_LENGTH:
+            raise KeyError(key)
+        with self._lock:
+            offset, found = self._find(key)
+            if not found:
+                raise KeyError(key)
+            offset += 1 + KEY_LENGTH
+            return tuple(
+                self._mmap[offset + x:offset + x + ANSWER_LENGTH]
+                for x in range(0, ANSWER_COUNT * ANSWER_LENGTH, ANSWER_LENGTH)
+            )
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return self._entry_count + len(self._volatile_dict)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, bytes) or len(key) != KEY_LENGTH:
+            raise TypeError('Key must be %i bytes: %r' % (KEY_LENGTH, key))
+        if not isinstance(value, tuple) or len(value) != ANSWER_COUNT:
+            raise TypeError('Value must be a %i-tuple: %r (%s)' % (
+              ANSWER_COUNT, value, type(value)))
+        for item in value:
+            if not isinstance(item, bytes) or len(item) != ANSWER_LENGTH:
+                raise TypeError('Value elements must be %i bytes: %r (%s) '
+                  'for value %r' % (ANSWER_LENGTH, item, type(item), value))
+        if self._read_only:
+            self._volatile_dict[key] = value
+            return
+        with self._lock:
+            offset, found = self._find(key)
+            if not found:
+                if (self._entry_count + 1) * 2 > self._slot_count:
+                    self._grow()
+                    offset, _ = self._find(key)
+                self._entry_count += 1
+                MAPPED_CACHE_HEADER.pack_into(
+                    self._mmap,
+                    0,
+                    MAPPED_CACHE_MAGIC,
+                    self._slot_count,
+                    self._entry_count,
+                )
+            self._mmap[offset:offset + SLOT_LENGTH] = bytes((SLOT_USED, )) + \
+              key + b''.join(value)
+            if self._dirty_since is None:
+                self._dirty_since = monotonic()
+            self._dirty_count += 1
+            if self._dirty_count >= self._flush_count:
+                self._flush()
+
+    def _grow(self):
+        temp_filename = self._filename + '.tmp'
+        _createMappedFile(temp_filename, self._slot_count * 2)
+        new = MappedDictCache(
+            temp_filename,
+            read_only=False,
+            # Only force entries to disk once, on close.
+            flush_count=self._entry_count + 1,
+            fsync=self._fsync,
+        )
+        for key, value in self._iterItems():
+            new[key] = value
+        new.close()
+        self._mmap.close()
+        os.replace(temp_filename, self._filename)
+        self._open()
+
+    def items(self):
+        """
+          Return a list of (key, value) pairs.
+        """
+        with self._lock:
+            return list(self._iterItems())
+
+    def _iterItems(self):
+        yield from self._volatile_dict.items()
+        data = self._mmap
+        for offset in range(
+                    MAPPED_CACHE_HEADER.size,
+                    len(data),
+                    SLOT_LENGTH,
+                ):
+            if data[offset] == SLOT_USED:
+                key_end = offset + 1 + KEY_LENGTH
+                yield data[offset + 1:key_end], tuple(
+                    data[x:x + ANSWER_LENGTH]
+                    for x in range(key_end, offset + SLOT_LENGTH,
+                      ANSWER_LENGTH)
+                )
+
+    def flushIfExpired(self):
+        """
+          Force modified entries to disk if the oldest one is older than
+          flush_interval. To be called periodically.
+        """
+        dirty_since = self._dirty_since
+        if self._flush_interval is not None and dirty_since is not None and \
+                monotonic() - dirty_since >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+          Force modified entries to disk.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._dirty_count:
+            if self._fsync:
+                self._mmap.flush()
+            self._dirty_count = 0
+            self._dirty_since = None
+
+class SharedDictCache(object):
+    """
+      Client of an authentication cache service (see cache_server.py), so
+      several processes share what any of them learns.
+      Entries are kept in memory once known, so repeated lookups do not leave
+      the process. Entries learnt by other clients are pushed by the service,
+      and picked up on next lookup miss (or flushIfExpired).
+      If the service cannot be reached, lookups miss and new entries are only
+      kept in memory, until a later lookup reconnects.
+      Can be used from several threads.
+    """
+    def __init__(self, socket_path, timeout=SHARED_CACHE_TIMEOUT):
+        """
+          socket_path (string)
+            Path of the service's unix socket.
+          timeout (float)
+            Time, in seconds, after which an unanswered lookup is a miss.
+        """
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._known_dict = {}
+        self._socket = None
+        self._buffer = b''
+        # Only report the first of consecutive connection failures.
+        self._unavailable = False
+        self._connect()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._socket_path)
+        except OSError as exc:
+            sock.close()
+            if not self._unavailable:
+                self._unavailable = True
+                print('Authentication cache service unavailable: %s' % (
+                  exc, ))
+            return
+        self._socket = sock
+        self._buffer = b''
+        self._unavailable = False
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _receive(self, blocking):
+        """
+          Process messages from service.
+          If not <blocking>, only what was already received.
+        """
+        sock = self._socket
+        if not blocking and not select.select((sock, ), (), (), 0)[0]:
+            return set()
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionResetError('Authentication cache service closed '
+              'connection')
+        buf = self._buffer + data
+        answered_set = set()
+        known_dict = self._known_dict
+        while buf:
+            code = buf[:1]
+            if code == SHARED_CACHE_VALUE:
+                length = SHARED_CACHE_VALUE_LENGTH
+            elif code == SHARED_CACHE_NOT_FOUND:
+                length = SHARED_CACHE_KEY_LENGTH
+            else:
+                raise ValueError('Unexpected message from authentication '
+                  'cache service: %r' % (buf[:SHARED_CACHE_VALUE_LENGTH], ))
+            if len(buf) < length:
+                break
+            key = buf[1:1 + KEY_LENGTH]
+            if code == SHARED_CACHE_VALUE:
+                known_dict[key] = unpackAnswers(buf[1 + KEY_LENGTH:length])
+            answered_set.add(key)
+            buf = buf[length:]
+        self._buffer = buf
+        return answered_set
+
+    def __getitem__(self, key):
+        try:
+            return self._known_dict[key]
+        except KeyError:
+            pass
+        if len(key) != KEY_LENGTH:
+            raise KeyError(key)
+        with self._lock:
+            if self._socket is None:
+                self._connect()
+            if self._socket is not None:
+                try:
+                    # Maybe another client just learnt it.
+                    if key not in self._receive(False) and \
+                            key not in self._known_dict:
+                        self._socket.sendall(SHARED_CACHE_GET + key)
+                        while key not in self._receive(True):
+                            pass
+                except (OSError, ValueError) as exc:
+                    print('Authentication cache service lookup failed: %s' % (
+                      exc, ))
+                    self._disconnect()
+        return self._known_dict[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._known_dict)
+
+    def items(self):
+        return self._known_dict.items()
+
+    def __setitem__(self, key, value):
+        message = SHARED_CACHE_SET + packEntry(key, value)
+        with self._lock:
+            self._known_dict[key] = value
+            if self._socket is None:
+                self._connect()
+            if self._socket is not None:
+                try:
+                    self._socket.sendall(message)
+                except OSError as exc:
+                    print('Authentication cache service update failed: %s' % (
+                      exc, ))
+                    self._disconnect()
+
+    def flushIfExpired(self):
+        """
+          Pick up entries pushed by service. To be called periodically, so
+          they do not pile up.
+        """
+        with self._lock:
+            if self._socket is not None:
+                try:
+                    while self._receive(False):
+                        pass
+                except (OSError, ValueError):
+                    self._disconnect()
+
+    def flush(self):
+        # Service is in charge of writing entries to disk.
+        pass
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+def packEntry(key, value):
+    """
+      Check and serialise a (key, value) cache entry, as exchanged with cache
+      service.
+    """
+    if not isinstance(key, bytes) or len(key) != KEY_LENGTH:
+        raise TypeError('Key must be %i bytes: %r' % (KEY_LENGTH, key))
+    if not isinstance(value, tuple) or len(value) != ANSWER_COUNT:
+        raise TypeError('Value must be a %i-tuple: %r (%s)' % (
+          ANSWER_COUNT, value, type(value)))
+    for item in value:
+        if not isinstance(item, bytes) or len(item) != ANSWER_LENGTH:
+            raise TypeError('Value elements must be %i bytes: %r (%s) '
+              'for value %r' % (ANSWER_LENGTH, item, type(item), value))
+    return key + b''.join(value)
+
+def unpackAnswers(data):
+    return tuple(
+        data[x:x + ANSWER_LENGTH]
+        for x in range(0, ANSWER_COUNT * ANSWER_LENGTH, ANSWER_LENGTH)
+    )
+
+def openCache(filename, read_only=True, **kw):
+    """
+      Open authentication cache file, whichever its format. New files are
+      created as MappedDictCache.
+      Extra arguments are write policy parameters (flush_count,
+      flush_interval, fsync), see FileDictCache and MappedDictCache.
+    """
+    try:
+        with open(filename, 'rb') as cache_file:
+            magic = cache_file.read(len(MAPPED_CACHE_MAGIC))
+    except FileNotFoundError:
+        magic = b''
+    if magic == MAPPED_CACHE_MAGIC or (not magic and not read_only):
+        return MappedDictCache(filename, read_only=read_only, **kw)
+    return FileDictCache(filename, read_only=read_only, **kw)
+
+def main(output_filename, input_filename_list):
+    """
+      Merge entries from all input caches (either format) into a new
+      MappedDictCache. Entries from later inputs take precedence.
+    """
+    temp_filename = output_filename + '.tmp'
+    slot_count = INITIAL_SLOT_COUNT
+    cache_list = [openCache(x) for x in input_filename_list]
+    # Size table for all entries upfront, so it does not have to grow.
+    total = sum(len(x) for x in cache_list)
+    while total * 2 > slot_count:
+        slot_count *= 2
+    _createMappedFile(temp_filename, slot_count)
+    output = MappedDictCache(
+        temp_filename,
+        read_only=False,
+        # Only force entries to disk once, on close, before replacing output.
+        flush_count=total + 1,
+        fsync=True,
+    )
+    for input_filename, cache in zip(input_filename_list, cache_list):
+        count = 0
+        for key, value in cache.items():
+            output[key] = value
+            count += 1
+        print('%s: %i entries' % (input_filename, count))
+    print('%s: %i distinct entries' % (output_filename, len(output)))
+    output.close()
+    os.replace(temp_filename, output_filename)
 
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('Usage: %s OUTPUT INPUT [INPUT...]\n'
+          'Compact and merge authentication cache files.' % (sys.argv[0], ))
+    main(sys.argv[1], sys.argv[2:])
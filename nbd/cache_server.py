@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Authentication cache service, so several NBD daemons (and dump.py runs)
+share their authentication answers.
+
+Clients (cache.SharedDictCache) connect to a unix socket. This process is
+the only one writing to the cache file, and pushes every new entry to all
+other clients, so an authentication done through one adapter warms the cache
+of all the others.
+"""
+import errno
+import os
+import select
+import signal
+import socket
+from cache import (
+    KEY_LENGTH,
+    SHARED_CACHE_GET,
+    SHARED_CACHE_KEY_LENGTH,
+    SHARED_CACHE_NOT_FOUND,
+    SHARED_CACHE_SET,
+    SHARED_CACHE_VALUE,
+    SHARED_CACHE_VALUE_LENGTH,
+    openCache,
+    packEntry,
+    unpackAnswers,
+)
+
+# Entries pushed to a client which does not read them are dropped beyond this
+# many pending bytes. It will ask for them when it needs them.
+MAX_PUSH_BUFFER_LENGTH = 1 << 20
+
+class _Client(object):
+    def __init__(self, sock):
+        self.socket = sock
+        self.input = b''
+        self.output = b''
+
+class CacheServer(object):
+    """
+      Serve entries of <cache> on a unix socket at <socket_path>.
+    """
+    def __init__(self, cache, socket_path, flush_interval=None):
+        self._cache = cache
+        self._socket_path = socket_path
+        self._flush_interval = flush_interval
+        self._client_dict = {}
+        self._epoll = select.epoll()
+        self._statistics = {
+            'hit': 0,
+            'miss': 0,
+            'set': 0,
+            'push': 0,
+            'dropped_push': 0,
+        }
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except FileNotFoundError:
+            pass
+        except ConnectionRefusedError:
+            # Left by a dead server.
+            os.unlink(socket_path)
+        else:
+            sock.close()
+            raise ValueError('%s is already served' % (socket_path, ))
+        sock.close()
+        self._listen_socket = sock = socket.socket(
+            socket.AF_UNIX,
+            socket.SOCK_STREAM,
+        )
+        sock.bind(socket_path)
+        sock.listen(16)
+        sock.setblocking(False)
+        self._epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def getStatistics(self):
+        result = dict(self._statistics)
+        result['client'] = len(self._client_dict)
+        result['size'] = len(self._cache)
+        return result
+
+    def _accept(self):
+        try:
+            sock, _ = self._listen_socket.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        self._client_dict[sock.fileno()] = _Client(sock)
+        self._epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def _removeClient(self, client):
+        fileno = client.socket.fileno()
+        self._epoll.unregister(fileno)
+        del self._client_dict[fileno]
+        client.socket.close()
+
+    def _send(self, client, data, push=False):
+        if push and len(client.output) > MAX_PUSH_BUFFER_LENGTH:
+            self._statistics['dropped_push'] += 1
+            return
+        was_empty = not client.output
+        client.output += data
+        if was_empty:
+            self._write(client)
+
+    def _write(self, client):
+        try:
+            sent = client.socket.send(client.output)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._removeClient(client)
+            return
+        client.output = client.output[sent:]
+        self._epoll.modify(
+            client.socket.fileno(),
+            select.EPOLLIN | select.EPOLLOUT if client.output else
+              select.EPOLLIN,
+        )
+
+    def _read(self, client):
+        try:
+            data = client.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._removeClient(client)
+            return
+        buf = client.input + data
+        cache = self._cache
+        statistics = self._statistics
+        while buf:
+            code = buf[:1]
+            if code == SHARED_CACHE_GET:
+                length = SHARED_CACHE_KEY_LENGTH
+            elif code == SHARED_CACHE_SET:
+                length = SHARED_CACHE_VALUE_LENGTH
+            else:
+                print('Unexpected message, disconnecting client: %r' % (
+                  buf[:SHARED_CACHE_VALUE_LENGTH], ))
+                self._removeClient(client)
+                return
+            if len(buf) < length:
+                break
+            key = buf[1:1 + KEY_LENGTH]
+            if code == SHARED_CACHE_GET:
+                try:
+                    value = cache[key]
+                except KeyError:
+                    statistics['miss'] += 1
+                    self._send(client, SHARED_CACHE_NOT_FOUND + key)
+                else:
+                    statistics['hit'] += 1
+                    self._send(
+                        client,
+                        SHARED_CACHE_VALUE + packEntry(key, tuple(value)),
+                    )
+            else:
+                value = unpackAnswers(buf[1 + KEY_LENGTH:length])
+                try:
+                    known = tuple(cache[key]) == value
+                except KeyError:
+                    known = False
+                if not known:
+                    statistics['set'] += 1
+                    cache[key] = value
+                    message = SHARED_CACHE_VALUE + buf[1:length]
+                    for other in list(self._client_dict.values()):
+                        if other is not client:
+                            statistics['push'] += 1
+                            self._send(other, message, push=True)
+            buf = buf[length:]
+            if client.socket.fileno() not in self._client_dict:
+                # Disconnected while answering.
+                return
+        client.input = buf
+
+    def run(self):
+        listen_fileno = self._listen_socket.fileno()
+        client_dict = self._client_dict
+        flushIfExpired = self._cache.flushIfExpired
+        poll_timeout = self._flush_interval
+        if poll_timeout is None:
+            poll_timeout = -1
+        print('Serving authentication cache on %s' % (self._socket_path, ))
+        try:
+            while True:
+                try:
+                    event_list = self._epoll.poll(poll_timeout)
+                except InterruptedError:
+                    event_list = ()
+                for fileno, event in event_list:
+                    if fileno == listen_fileno:
+                        self._accept()
+                        continue
+                    client = client_dict.get(fileno)
+                    if client is not None and event & select.EPOLLOUT:
+                        self._write(client)
+                    client = client_dict.get(fileno)
+                    if client is not None and event & (
+                                select.EPOLLIN | select.EPOLLERR |
+                                select.EPOLLHUP
+                            ):
+                        self._read(client)
+                flushIfExpired()
+        finally:
+            for client in list(client_dict.values()):
+                self._removeClient(client)
+            self._epoll.close()
+            self._listen_socket.close()
+            try:
+                os.unlink(self._socket_path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+
+def main(options):
+    cache = openCache(
+        options.auth_cache,
+        read_only=options.auth_cache_read_only,
+        flush_count=options.auth_cache_flush_count,
+        flush_interval=options.auth_cache_flush_interval,
+        fsync=options.auth_cache_fsync,
+    )
+    # Exit cleanly (flushing cache) on SIGTERM too.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server = CacheServer(
+            cache,
+            options.socket,
+            flush_interval=options.auth_cache_flush_interval,
+        )
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+        print('Authentication cache service statistics: %r' % (
+          server.getStatistics(), ))
+    finally:
+        cache.close()
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option('-s', '--socket', default='auth_cache.sock',
+      help='Unix socket path clients connect to.')
+    parser.add_option('-c', '--auth-cache', default='auth_cache.bin',
+      help='File containing authentication data from previous sessions.')
+    parser.add_option('-r', '--auth-cache-read-only', default=False,
+      action='store_true',
+      help='Don\'t store authentication information generated by clients '
+      'in file (it is still shared until exit).')
+    parser.add_option('--auth-cache-flush-count', default=16, type='int',
+      help='Number of new authentication answers which triggers a write to '
+      'cache file.')
+    parser.add_option('--auth-cache-flush-interval', default=10, type='float',
+      help='Maximum time, in seconds, new authentication answers are kept '
+      'in memory before being written to cache file.')
+    parser.add_option('--auth-cache-fsync', default=False,
+      action='store_true',
+      help='Make sure cache file writes reach the disk. Memory-mapped '
+      'cache files are only forced to disk with this option, following '
+      '--auth-cache-flush-count and --auth-cache-flush-interval.')
+    (options, args) = parser.parse_args()
+    main(options)
@@ -0,0 +1,157 @@
+"""
+Per-command USB latency tracing.
+
+Commands sent to the adapter are identified by their opcode (first 2 bytes of
+command payload, plus the sequence number for authentication steps), and
+each completed command is recorded with its size, start time and duration.
+"""
+from collections import deque
+import threading
+from memory_card_reader import COMMAND_TYPE_LONG, hexdump
+
+# Number of most recent commands kept by default.
+RECORD_COUNT = 4096
+# Authentication steps sharing an opcode, and told apart by the byte after it.
+SEQUENCED_OPCODE_SET = (b'\x81\xf0', )
+
+def getOpcode(command):
+    """
+      Return a printable opcode for <command>, as sent to device.
+    """
+    command = bytes(command[:7])
+    if command[1:2] == COMMAND_TYPE_LONG:
+        payload = command[4:]
+    else:
+        payload = command[1:]
+    opcode = payload[:2]
+    if opcode in SEQUENCED_OPCODE_SET:
+        opcode = payload[:3]
+    return hexdump(opcode)
+
+def _getBucket(duration):
+    # Bucket n holds durations from 2**(n-1) (excluded) to 2**n (included)
+    # microseconds.
+    return (int(duration * 1e6) - 1).bit_length() if duration > 1e-6 else 0
+
+def _formatDuration(duration):
+    if duration < 1e-3:
+        return '%.0fus' % (duration * 1e6, )
+    if duration < 1:
+        return '%.1fms' % (duration * 1e3, )
+    return '%.2fs' % (duration, )
+
+class CommandTracer(object):
+    """
+      Keep the most recent commands in a ring buffer, and latency histograms
+      of all commands, per opcode.
+      Can be used from several threads, and from a signal handler.
+    """
+    def __init__(self, record_count=RECORD_COUNT):
+        """
+          record_count (int)
+            Number of most recent commands to keep.
+        """
+        # Reentrant, so a signal handler interrupting record() can dump.
+        self._lock = threading.RLock()
+        self._record_deque = deque(maxlen=record_count)
+        # opcode: [count, byte count, total duration, max duration,
+        #   bucket list]
+        self._histogram_dict = {}
+
+    def record(self, command, byte_count, start, duration):
+        """
+          Record a completed command.
+          command (bytes)
+            Command as sent to device.
+          byte_count (int)
+            Number of bytes transferred, command and response included.
+          start (float)
+            When command started being sent, as per time.monotonic.
+          duration (float)
+            Time, in seconds, until the last byte of response was received.
+        """
+        opcode = getOpcode(command)
+        with self._lock:
+            self._record_deque.append((start, opcode, byte_count, duration))
+            try:
+                histogram = self._histogram_dict[opcode]
+            except KeyError:
+                histogram = self._histogram_dict[opcode] = [0, 0, 0, 0, []]
+            histogram[0] += 1
+            histogram[1] += byte_count
+            histogram[2] += duration
+            histogram[3] = max(histogram[3], duration)
+            bucket_list = histogram[4]
+            bucket = _getBucket(duration)
+            if bucket >= len(bucket_list):
+                bucket_list.extend([0] * (bucket + 1 - len(bucket_list)))
+            bucket_list[bucket] += 1
+
+    def getRecordList(self):
+        """
+          Return the most recent commands, oldest first, as a list of
+          (start, opcode, byte_count, duration) tuples.
+        """
+        with self._lock:
+            return list(self._record_deque)
+
+    def getHistogramDict(self):
+        """
+          Return a dict of latency statistics, by opcode. Each value is a
+          dict with the following keys:
+            count, byte_count, total (seconds), max (seconds)
+            bucket_list: number of commands which took up to 2**index
+              microseconds (and more than half of that).
+        """
+        with self._lock:
+            return {
+                opcode: {
+                    'count': count,
+                    'byte_count': byte_count,
+                    'total': total,
+                    'max': max_duration,
+                    'bucket_list': list(bucket_list),
+                }
+                for opcode, (count, byte_count, total, max_duration,
+                  bucket_list) in self._histogram_dict.items()
+            }
+
+    def reset(self):
+        """
+          Forget all recorded commands.
+        """
+        with self._lock:
+            self._record_deque.clear()
+            self._histogram_dict.clear()
+
+    def format(self):
+        """
+          Return a human-readable summary of latency histograms, opcodes
+          taking the most total time first.
+        """
+        line_list = []
+        append = line_list.append
+        histogram_dict = self.getHistogramDict()
+        grand_total = sum(x['total'] for x in histogram_dict.values()) or 1
+        for opcode, histogram in sorted(
+                    histogram_dict.items(),
+                    key=lambda x: x[1]['total'],
+                    reverse=True,
+                ):
+            count = histogram['count']
+            append('%-8s %8i commands %10i bytes %9s total (%4.1f%%) '
+              '%9s mean %9s max' % (
+                opcode,
+                count,
+                histogram['byte_count'],
+                _formatDuration(histogram['total']),
+                histogram['total'] * 100 / grand_total,
+                _formatDuration(histogram['total'] / count),
+                _formatDuration(histogram['max']),
+            ))
+            append('  ' + '  '.join(
+                '<=%s: %i' % (_formatDuration((1 << bucket) / 1e6), value)
+                for bucket, value in enumerate(histogram['bucket_list'])
+                if value
+            ))
+        return '\n'.join(line_list)
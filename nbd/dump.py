@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Stream a whole memory card to an image file, or an image file to a card.
+
+Progress is regularly saved to a checkpoint file, so an interrupted transfer
+resumes where it stopped when the same command is run again.
+
+A hash index of card content is saved along with the image. The sync
+operation uses it to only write blocks which differ from the image, reading
+back from the card only blocks missing from the index. As the index describes
+a card, not an image, a sample of indexed blocks is read back first to check
+it matches the card being synced.
+"""
+import json
+import os
+import random
+import signal
+import sys
+from time import monotonic
+from authenticator import (
+    HEDGE_DELAY,
+    SockAuthenticator,
+    TIMEOUT,
+    parseAddress,
+)
+from cache import SharedDictCache, openCache
+from command_trace import CommandTracer
+from memory_card_reader import DIGEST_LENGTH, PlayStationMemoryCardReader
+from usb_trace import RecordingUSBDevice, ReplayUSBDevice
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+INDEX_SUFFIX = '.index'
+OPERATION_LIST = ('dump', 'restore', 'sync')
+# Index entry for blocks whose content is unknown.
+UNKNOWN_DIGEST = b'\x00' * DIGEST_LENGTH
+# Number of indexed blocks read back from card to check index belongs to it.
+INDEX_CHECK_COUNT = 16
+
+class Checkpoint(object):
+    """
+      Persistent record of how far a transfer went, and of which card: the
+      digests of the first and last transferred blocks, to be checked
+      against the card before resuming.
+    """
+    def __init__(self, path, operation, card_type, block_count, image_path):
+        self._path = path
+        self._state = {
+            'operation': operation,
+            'card_type': card_type,
+            'block_count': block_count,
+            'image_path': os.path.abspath(image_path),
+            'next_block': 0,
+            'first_digest': None,
+            'last_digest': None,
+        }
+
+    def load(self):
+        """
+          Load previous progress, if any and compatible with current transfer.
+          Return the first block to transfer.
+        """
+        try:
+            with open(self._path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return 0
+        for key in ('operation', 'card_type', 'block_count', 'image_path'):
+            if state.get(key) != self._state[key]:
+                raise ValueError('Checkpoint %s does not match current '
+                  'transfer (%s: %r != %r), remove it to start over' % (
+                  self._path, key, state.get(key), self._state[key]))
+        for key in ('next_block', 'first_digest', 'last_digest'):
+            self._state[key] = state.get(key)
+        return state['next_block']
+
+    def checkCard(self, reader):
+        """
+          Read back the first and last transferred blocks, and raise
+          ValueError if they differ from when checkpoint was saved, ie. when
+          another card was inserted since.
+        """
+        state = self._state
+        next_block = state['next_block']
+        if not next_block:
+            return
+        for block_number, key in (
+                    (0, 'first_digest'),
+                    (next_block - 1, 'last_digest'),
+                ):
+            reader.readBlocks(block_number, 1)
+            digest = reader.getBlockDigests()[block_number].hex()
+            if digest != state[key]:
+                raise ValueError('Checkpoint %s was made with another card '
+                  '(block %i differs), insert it or remove checkpoint to '
+                  'start over' % (self._path, block_number))
+
+    def save(self, next_block, digest_dict):
+        """
+          Record that blocks before <next_block> are transferred.
+          digest_dict must contain digests of card blocks 0 and
+          next_block - 1.
+        """
+        state = self._state
+        state['next_block'] = next_block
+        state['first_digest'] = digest_dict[0].hex()
+        state['last_digest'] = digest_dict[next_block - 1].hex()
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(self._state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_path, self._path)
+
+    def remove(self):
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+def loadIndex(path, block_count):
+    """
+      Load block digests from index file at <path>.
+      Return a dict of digests by block number, of blocks with known content.
+    """
+    try:
+        with open(path, 'rb') as index_file:
+            index = index_file.read()
+    except FileNotFoundError:
+        return {}
+    if len(index) != block_count * DIGEST_LENGTH:
+        raise ValueError('Index %s does not match card size, remove it to '
+          'start over' % (path, ))
+    result = {}
+    for block_number in range(block_count):
+        digest = index[
+            block_number * DIGEST_LENGTH:(block_number + 1) * DIGEST_LENGTH
+        ]
+        if digest != UNKNOWN_DIGEST:
+            result[block_number] = digest
+    return result
+
+def checkIndex(reader, path, digest_dict, check_count):
+    """
+      Read back <check_count> blocks picked at random from <digest_dict>, and
+      raise ValueError if any differs from its indexed digest: the index was
+      made from another card, or the card was modified since, so trusting it
+      would skip needed writes.
+    """
+    sample = random.sample(
+        sorted(digest_dict),
+        min(check_count, len(digest_dict)),
+    )
+    for block_number in sorted(sample):
+        reader.readBlocks(block_number, 1)
+    known_digest_dict = reader.getBlockDigests()
+    for block_number in sorted(sample):
+        if known_digest_dict[block_number] != digest_dict[block_number]:
+            raise ValueError('Index %s does not match card content (block '
+              '%i differs), remove it to start over' % (path, block_number))
+
+def saveIndex(path, block_count, digest_dict):
+    """
+      Atomically save block digests from <digest_dict> to index file at
+      <path>.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(b''.join(
+            digest_dict.get(block_number, UNKNOWN_DIGEST)
+            for block_number in range(block_count)
+        ))
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(temp_path, path)
+
+class Progress(object):
+    def __init__(self, block_count, block_length, first_block):
+        self._block_count = block_count
+        self._block_length = block_length
+        self._first_block = first_block
+        self._start = monotonic()
+
+    def report(self, next_block, final=False):
+        elapsed = monotonic() - self._start
+        done = (next_block - self._first_block) * self._block_length
+        rate = done / elapsed if elapsed else 0
+        if rate:
+            remaining = '%.0fs' % (
+                (self._block_count - next_block) * self._block_length / rate,
+            )
+        else:
+            remaining = '?'
+        sys.stderr.write('\r%i/%i blocks (%.1f%%), %.1f kB/s, %s left ' % (
+            next_block,
+            self._block_count,
+            next_block * 100. / self._block_count,
+            rate / 1000,
+            remaining,
+        ))
+        if final:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+def readUnknownBlocks(reader, known_block_set, block_number, end_block):
+    """
+      Read blocks from <block_number> to <end_block> (excluded) which are not
+      in <known_block_set>, so reader learns their content.
+    """
+    while block_number < end_block:
+        if block_number in known_block_set:
+            block_number += 1
+            continue
+        # Read all consecutive unknown blocks in a single card access.
+        unknown_end_block = block_number + 1
+        while unknown_end_block < end_block and \
+                unknown_end_block not in known_block_set:
+            unknown_end_block += 1
+        reader.readBlocks(block_number, unknown_end_block - block_number)
+        block_number = unknown_end_block
+
+def transfer(reader, operation, image_path, checkpoint_path, index_path,
+        chunk_length, checkpoint_interval, index_check_count=INDEX_CHECK_COUNT):
+    """
+      Dump card to image_path, or restore image_path to card, depending on
+      <operation> ('dump' or 'restore').
+      For 'sync', image_path is restored to card, but only blocks known from
+      <index_path> to differ, or read from card and found to differ, are
+      written. <index_check_count> indexed blocks are first read back to
+      check the index matches the card.
+      In all cases, known card content is saved to <index_path>.
+    """
+    card_type = reader.getCardType()
+    block_length = reader.getPageSize()
+    block_count = reader.getSize() // block_length
+    checkpoint = Checkpoint(checkpoint_path, operation, card_type,
+      block_count, image_path)
+    first_block = checkpoint.load()
+    if first_block:
+        checkpoint.checkCard(reader)
+        # Blocks transferred before interruption are only known from the
+        # index saved then.
+        index_dict = loadIndex(index_path, block_count)
+    else:
+        index_dict = {}
+    if operation == 'sync':
+        digest_dict = loadIndex(index_path, block_count)
+        checkIndex(reader, index_path, digest_dict, index_check_count)
+        reader.setBlockDigests(digest_dict)
+        known_block_set = set(reader.getBlockDigests())
+    if operation == 'dump':
+        image_file = open(image_path, 'r+b' if first_block else 'wb')
+    else:
+        image_file = open(image_path, 'rb')
+        image_file.seek(0, os.SEEK_END)
+        if image_file.tell() != block_count * block_length:
+            raise ValueError('Image size does not match card size (%i)' % (
+              block_count * block_length, ))
+    progress = Progress(block_count, block_length, first_block)
+    with image_file:
+        image_file.seek(first_block * block_length)
+        current_block = last_checkpoint = first_block
+        while current_block < block_count:
+            count = min(chunk_length, block_count - current_block)
+            if operation == 'dump':
+                for data in reader.readBlocks(current_block, count):
+                    image_file.write(data)
+            else:
+                end_block = current_block + count
+                if operation == 'sync':
+                    readUnknownBlocks(reader, known_block_set, current_block,
+                      end_block)
+                for block_number in range(current_block, end_block):
+                    reader.writeBlock(
+                        block_number,
+                        image_file.read(block_length),
+                    )
+            current_block += count
+            if current_block - last_checkpoint >= checkpoint_interval:
+                if operation == 'dump':
+                    # Checkpoint must not claim more than what is on disk.
+                    image_file.flush()
+                    os.fsync(image_file.fileno())
+                digest_dict = reader.getBlockDigests()
+                index_dict.update(digest_dict)
+                saveIndex(index_path, block_count, index_dict)
+                checkpoint.save(current_block, digest_dict)
+                last_checkpoint = current_block
+                progress.report(current_block)
+    progress.report(current_block, final=True)
+    index_dict.update(reader.getBlockDigests())
+    saveIndex(index_path, block_count, index_dict)
+    checkpoint.remove()
+    if operation != 'dump':
+        sys.stderr.write('%i identical blocks not rewritten\n' % (
+          reader.getSkippedWriteCount(), ))
+
+def printTrace(tracer):
+    sys.stderr.write('\nCommand latency:\n%s\n' % (tracer.format(), ))
+    sys.stderr.flush()
+
+def main(options, operation, image_path):
+    checkpoint_path = options.checkpoint or image_path + CHECKPOINT_SUFFIX
+    index_path = options.index or image_path + INDEX_SUFFIX
+    tracer = None
+    if options.trace:
+        tracer = CommandTracer(options.trace)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: printTrace(tracer))
+    # Write authentication cache on SIGTERM too.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    def run(usb_device, authenticator, usb_context):
+        if options.record:
+            trace_file = open(options.record, 'wb')
+            usb_device = RecordingUSBDevice(usb_device, trace_file)
+        try:
+            reader = PlayStationMemoryCardReader(
+                usb_device,
+                authenticator,
+                usb_context=usb_context,
+                tracer=tracer,
+                reroll_count=options.auth_reroll,
+            )
+            transfer(reader, operation, image_path, checkpoint_path,
+              index_path, options.chunk_length, options.checkpoint_interval,
+              options.index_check_count)
+            seed_statistics = reader.getSeedStatistics()
+            if seed_statistics['draw']:
+                sys.stderr.write('Authentication seed statistics: %r\n' % (
+                  seed_statistics, ))
+        finally:
+            if options.record:
+                trace_file.close()
+            if tracer is not None:
+                printTrace(tracer)
+
+    if options.replay or options.emulate:
+        from emulator import EmulatedAuthenticator, EmulatedMemoryCardAdapter
+        if options.replay:
+            adapter = ReplayUSBDevice(options.replay,
+              speed=options.replay_speed)
+        else:
+            adapter = EmulatedMemoryCardAdapter(options.emulate,
+              writable=True)
+        run(adapter, EmulatedAuthenticator(), adapter)
+        return
+    import usb1
+    if options.auth_cache_server:
+        authentication_cache = SharedDictCache(options.auth_cache_server)
+    else:
+        authentication_cache = openCache(
+            options.auth_cache,
+            read_only=options.auth_cache_read_only,
+            flush_count=options.auth_cache_flush_count,
+            fsync=options.auth_cache_fsync,
+        )
+    authenticator = SockAuthenticator(
+        [
+            parseAddress(x, options.auth_port)
+            for x in options.auth_address or ('127.0.0.1', )
+        ],
+        authentication_cache,
+        timeout=options.auth_timeout,
+        hedge_delay=options.auth_hedge_delay,
+    )
+    try:
+        with usb1.USBContext() as usb_context:
+            usb_device = usb_context.openByVendorIDAndProductID(
+                0x054c,
+                0x02ea,
+                skip_on_error=True,
+            )
+            if usb_device is None:
+                sys.exit("Could not open the ps3 adapter usb device")
+            with usb_device.claimInterface(0):
+                run(usb_device, authenticator, usb_context)
+    finally:
+        authentication_cache.close()
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] dump|restore|sync IMAGE')
+    parser.add_option('-k', '--checkpoint',
+      help='Checkpoint file. Default: IMAGE' + CHECKPOINT_SUFFIX)
+    parser.add_option('-x', '--index',
+      help='Hash index of card content. Must only be shared by operations on '
+      'the same card. Default: IMAGE' + INDEX_SUFFIX)
+    parser.add_option('--index-check-count', default=INDEX_CHECK_COUNT,
+      type='int',
+      help='Number of indexed blocks read back from card before a sync, to '
+      'check the index belongs to this card. 0 to trust the index.')
+    parser.add_option('-i', '--checkpoint-interval', default=256, type='int',
+      help='Number of blocks between checkpoints.')
+    parser.add_option('-l', '--chunk-length', default=64, type='int',
+      help='Number of blocks per card access.')
+    parser.add_option('-c', '--auth-cache', default='auth_cache.bin',
+      help='File containing authentication data from previous sessions.')
+    parser.add_option('-r', '--auth-cache-read-only', default=False,
+      action='store_true',
+      help='Don\'t store authentication information generated during this run.')
+    parser.add_option('--auth-cache-flush-count', default=16, type='int',
+      help='Number of new authentication answers which triggers a write to '
+      'cache file. Remaining ones are written when done.')
+    parser.add_option('--auth-cache-fsync', default=False,
+      action='store_true',
+      help='Make sure cache file writes reach the disk. Memory-mapped '
+      'cache files are only forced to disk with this option, following '
+      '--auth-cache-flush-count.')
+    parser.add_option('-S', '--auth-cache-server',
+      help='Unix socket of an authentication cache service (cache_server.py) '
+      'to use instead of a cache file, to share authentication data with '
+      'other processes.')
+    parser.add_option('--auth-reroll', default=0, type='int',
+      help='Number of times PS2 authentication may restart to get a seed '
+      'with a cached answer, before asking authentication daemon.')
+    parser.add_option('-P', '--auth-port', default=20531, type='int',
+      help='Port used to contact authentication daemons, unless given in '
+      'address.')
+    parser.add_option('-A', '--auth-address', action='append',
+      help='Address (host or host:port) used to contact an authentication '
+      'daemon. Can be repeated to use several daemons. Default: 127.0.0.1')
+    parser.add_option('--auth-timeout', default=TIMEOUT, type='float',
+      help='Time, in seconds, after which authentication daemons are given '
+      'up on for a seed, and authentication restarts with another seed. '
+      'Must be longer than daemon latency, as late answers only get cached.')
+    parser.add_option('--auth-hedge-delay', default=HEDGE_DELAY,
+      type='float',
+      help='Time, in seconds, after which a seed is also sent to the next '
+      'authentication daemon.')
+    parser.add_option('-T', '--trace', default=0, type='int',
+      help='Number of most recent USB commands to record, with latency '
+      'histograms printed on SIGUSR1 and when done. 0 to disable.')
+    parser.add_option('-R', '--record',
+      help='Record USB transfers to given trace file.')
+    parser.add_option('-p', '--replay',
+      help='Replay USB transfers from given trace file, recorded with the '
+      'same operation, instead of using USB device.')
+    parser.add_option('--replay-speed', default=1, type='float',
+      help='How much faster than recorded replayed device responds. 0 to '
+      'respond immediately.')
+    parser.add_option('-e', '--emulate',
+      help='Use an emulated adapter, with given card image, instead of USB '
+      'device.')
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or args[0] not in OPERATION_LIST:
+        parser.error('Expected operation (%s) and image path.' % (
+          ', '.join(OPERATION_LIST), ))
+    main(options, *args)
@@ -0,0 +1,549 @@
+"""
+Software emulation of Sony's PS3 memory card adapter, backed by a card image.
+
+PlayStationMemoryCardReader only uses a small part of the usb1 API, which is
+implemented here so an emulated adapter can be given instead of an actual
+device handle (and as USB context, for pipelined reads):
+
+  adapter = EmulatedMemoryCardAdapter('card.img', latency=.001)
+  reader = PlayStationMemoryCardReader(adapter, authenticator,
+    usb_context=adapter)
+"""
+import random
+from struct import pack, unpack
+from time import monotonic, sleep
+from memory_card_reader import (
+    BULK_READ_LENGTH,
+    PAGE_LENGTH,
+    FRAME_LENGTH,
+    PS1_CARD_TYPE,
+    PS1_CARD_SIZE,
+    PS2_CARD_TYPE,
+    PS2_CARD_SIZE,
+    TRANSFER_COMPLETED,
+    TRANSFER_TIMED_OUT,
+)
+
+# libusb_transfer_status values
+TRANSFER_CANCELLED = 3
+TRANSFER_OVERFLOW = 6
+
+NO_CARD_TYPE = 0
+IMAGE_SIZE_CARD_TYPE_DICT = {
+    PS1_CARD_SIZE: PS1_CARD_TYPE,
+    PS2_CARD_SIZE: PS2_CARD_TYPE,
+}
+
+RESPONSE_FAILURE = b'\x55\xaf'
+# Arbitrary, but constant, values returned by unidentified commands.
+ADAPTER_SERIAL = (b'\x01' * 9, b'\x02' * 9)
+DEVICE_AUTH = (b'\x03' * 9, b'\x04' * 9, b'\x05' * 9)
+# Maximum delay between seed emission and its answers (in seconds of
+# emulated time).
+AUTH_TIMEOUT = 1
+
+class EmulatorError(Exception):
+    """
+      Host did something the emulated device would not react to, like reading
+      a response which will never come.
+    """
+
+def _frameChecksum(frame_number_data, data):
+    result = 0
+    for byte in frame_number_data + data:
+        result ^= byte
+    return result
+
+class EmulatedAuthenticator(object):
+    """
+      Authenticator answering from the same table as an emulated adapter.
+    """
+    def __init__(self, authentication_dict=None):
+        """
+          authentication_dict (dict-ish, or None)
+            See EmulatedMemoryCardAdapter. If None, answer with dummy values.
+        """
+        self._authentication_dict = authentication_dict
+
+    def isCached(self, seed):
+        return self._authentication_dict is None or \
+          seed in self._authentication_dict
+
+    def authenticate(self, seed):
+        if self._authentication_dict is None:
+            return (b'\x00' * 9, ) * 3
+        return self._authentication_dict[seed]
+
+class EmulatedTransfer(object):
+    """
+      Subset of usb1.USBTransfer API.
+    """
+    def __init__(self, adapter):
+        self._adapter = adapter
+        self._submitted = False
+        self._endpoint = None
+        self._buffer = None
+        self._callback = None
+        self._user_data = None
+        self._status = None
+        self._actual_length = 0
+        # Set by adapter when scheduling.
+        self.submit_time = None
+        self.completion_time = None
+        self.result = None
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None,
+            timeout=0):
+        if self._submitted:
+            raise ValueError('Cannot alter a submitted transfer')
+        if isinstance(buffer_or_len, int):
+            buffer_or_len = bytearray(buffer_or_len)
+        self._endpoint = endpoint
+        self._buffer = buffer_or_len
+        self._callback = callback
+        self._user_data = user_data
+        self._timeout = timeout
+
+    def isIn(self):
+        return bool(self._endpoint & 0x80)
+
+    def submit(self):
+        if self._submitted:
+            raise ValueError('Cannot submit a submitted transfer')
+        self._submitted = True
+        self._status = None
+        self.completion_time = None
+        self._adapter._submit(self)
+
+    def cancel(self):
+        if not self._submitted:
+            raise EmulatorError('Transfer not submitted')
+        self._adapter._cancel(self)
+
+    def close(self):
+        if self._submitted:
+            raise ValueError('Cannot close a submitted transfer')
+
+    def isSubmitted(self):
+        return self._submitted
+
+    def getStatus(self):
+        return self._status
+
+    def getActualLength(self):
+        return self._actual_length
+
+    def getBuffer(self):
+        return self._buffer
+
+    def getUserData(self):
+        return self._user_data
+
+    def _complete(self, status, actual_length):
+        self._submitted = False
+        self._status = status
+        self._actual_length = actual_length
+        if self._callback is not None:
+            self._callback(self)
+
+class EmulatedMemoryCardAdapter(object):
+    """
+      Emulate a memory card adapter, with a card whose content is read from
+      (and optionally written to) an image file.
+
+      Timing model: the device handles transfers one at a time, in
+      submission order. Each transfer completes no sooner than <latency>
+      seconds after it was submitted, and occupies the device for
+      <byte_latency> seconds per transferred byte, plus <command_latency>
+      seconds when it carries a command. So synchronous transfers pay
+      <latency> each, while transfers submitted together overlap it.
+      A response transfer with a timeout, submitted while no response is
+      pending, times out.
+    """
+
+    def __init__(self, image_path=None, writable=False, authentication_dict=None,
+            latency=0, byte_latency=0, command_latency=0, seed_list=None,
+            auth_timeout=AUTH_TIMEOUT, loss_rate=0, random_seed=None):
+        """
+          image_path (string, or None)
+            Card image file. Card type is deduced from its size.
+            If None, there is no card in the adapter.
+          writable (bool)
+            Whether writes to card must be saved to image file. Otherwise,
+            they are only kept in memory.
+          authentication_dict (dict-ish, or None)
+            Maps seeds (9 bytes) to expected answers (3-tuple of 9 bytes).
+            If None, any answer is accepted.
+          latency (float)
+          byte_latency (float)
+          command_latency (float)
+            See timing model in class docstring. In seconds.
+          seed_list (list of strings, or None)
+            Seeds to pick from when host asks for one. Seeds are picked at
+            random when None, or if authentication_dict is None.
+            Default: keys of authentication_dict.
+          auth_timeout (float)
+            Maximum time between seed emission and receiving answers.
+          loss_rate (float)
+            Probability for a command to be ignored by the device, to
+            emulate a flaky connection.
+          random_seed
+            Seed for command loss and authentication seeds, for reproducible
+            runs.
+        """
+        self._latency = latency
+        self._byte_latency = byte_latency
+        self._command_latency = command_latency
+        self._authentication_dict = authentication_dict
+        if seed_list is None and authentication_dict is not None:
+            seed_list = list(authentication_dict.keys())
+        self._seed_list = seed_list
+        self._auth_timeout = auth_timeout
+        self._loss_rate = loss_rate
+        self._random = random.Random(random_seed)
+        self._busy_until = 0
+        self._response_packet_list = []
+        self._submitted_list = []
+        self._authenticated = False
+        self._seed = None
+        self._seed_time = None
+        self._answer_list = [None, None, None]
+        self._image_file = None
+        self._image = None
+        self._card_type = NO_CARD_TYPE
+        self.command_count = 0
+        self.lost_command_count = 0
+        self.transfer_count = 0
+        self.transfer_byte_count = 0
+        self.insertCard(image_path, writable=writable)
+
+    def insertCard(self, image_path, writable=False):
+        """
+          Replace inserted card with one backed by <image_path>, or remove it
+          if image_path is None.
+          Authentication is lost.
+        """
+        self.removeCard()
+        if image_path is None:
+            return
+        with open(image_path, 'rb') as image_file:
+            image = bytearray(image_file.read())
+        try:
+            card_type = IMAGE_SIZE_CARD_TYPE_DICT[len(image)]
+        except KeyError:
+            raise ValueError('Unknown card image size: %i' % (len(image), ))
+        if writable:
+            self._image_file = open(image_path, 'r+b')
+        self._image = image
+        self._card_type = card_type
+
+    def removeCard(self):
+        if self._image_file is not None:
+            self._image_file.close()
+            self._image_file = None
+        self._image = None
+        self._card_type = NO_CARD_TYPE
+        self._authenticated = False
+
+    def close(self):
+        self.removeCard()
+
+    def getImage(self):
+        """
+          Return current card content.
+        """
+        return bytes(self._image)
+
+    # usb1.USBDeviceHandle API
+    def bulkWrite(self, endpoint, data, timeout=0):
+        transfer = EmulatedTransfer(self)
+        transfer.setBulk(endpoint & 0x7f, data, timeout=timeout)
+        self._runSynchronously(transfer)
+        return transfer.getActualLength()
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        transfer = EmulatedTransfer(self)
+        transfer.setBulk(endpoint | 0x80, length, timeout=timeout)
+        self._runSynchronously(transfer)
+        return transfer.getBuffer()[:transfer.getActualLength()]
+
+    def getTransfer(self, iso_packets=0, short_is_error=False,
+            add_zero_packet=False):
+        return EmulatedTransfer(self)
+
+    # usb1.USBContext API
+    def handleEvents(self):
+        """
+          Wait for the next transfer to complete, and complete all transfers
+          which are done by then.
+        """
+        submitted_list = self._submitted_list
+        if not submitted_list:
+            return
+        scheduled_list = [
+            x for x in submitted_list if x.completion_time is not None
+        ]
+        if not scheduled_list:
+            raise EmulatorError('Waiting for a response to no command')
+        self._sleepUntil(min(x.completion_time for x in scheduled_list))
+        now = monotonic()
+        for transfer in scheduled_list:
+            if transfer.completion_time <= now:
+                submitted_list.remove(transfer)
+                self._finish(transfer)
+
+    # Transfer scheduling
+    def _runSynchronously(self, transfer):
+        transfer.submit()
+        if transfer.completion_time is None:
+            self._submitted_list.remove(transfer)
+            raise EmulatorError('Waiting for a response to no command')
+        self._sleepUntil(transfer.completion_time)
+        self._submitted_list.remove(transfer)
+        self._finish(transfer)
+        if transfer.getStatus() != TRANSFER_COMPLETED:
+            raise EmulatorError('Transfer failed with status %i' % (
+              transfer.getStatus(), ))
+
+    @staticmethod
+    def _sleepUntil(deadline):
+        delay = deadline - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def _submit(self, transfer):
+        self._submitted_list.append(transfer)
+        transfer.submit_time = monotonic()
+        self._schedule()
+
+    def _cancel(self, transfer):
+        self._submitted_list.remove(transfer)
+        transfer._complete(TRANSFER_CANCELLED, 0)
+
+    def _schedule(self):
+        """
+          Process submitted transfers which can be processed, in submission
+          order, and decide when they complete.
+        """
+        for transfer in self._submitted_list:
+            if transfer.completion_time is not None:
+                continue
+            if transfer.isIn():
+                if not self._response_packet_list:
+                    if transfer._timeout:
+                        # No response can arrive before this times out.
+                        transfer.result = (TRANSFER_TIMED_OUT, 0)
+                        transfer.completion_time = transfer.submit_time + \
+                          transfer._timeout / 1000.
+                    # Otherwise, wait for a command (maybe on a later
+                    # transfer).
+                    continue
+                command = False
+            else:
+                command = True
+            start = max(transfer.submit_time + self._latency, self._busy_until)
+            if command:
+                transfer.result = (TRANSFER_COMPLETED, len(transfer.getBuffer()))
+                if self._loss_rate and self._random.random() < self._loss_rate:
+                    self.lost_command_count += 1
+                else:
+                    self._handleCommand(bytes(transfer.getBuffer()), start)
+                length = len(transfer.getBuffer())
+            else:
+                transfer.result = self._fillReadBuffer(transfer.getBuffer())
+                length = transfer.result[1]
+            self._busy_until = transfer.completion_time = start + \
+              length * self._byte_latency + \
+              (self._command_latency if command else 0)
+            self.transfer_count += 1
+            self.transfer_byte_count += length
+
+    def _finish(self, transfer):
+        transfer._complete(*transfer.result)
+
+    def _fillReadBuffer(self, buf):
+        """
+          Copy response packets into <buf> until a short packet is received or
+          buffer is full.
+        """
+        packet_list = self._response_packet_list
+        length = 0
+        while packet_list:
+            packet = packet_list[0]
+            packet_length = len(packet)
+            if length + packet_length > len(buf):
+                if length:
+                    break
+                return TRANSFER_OVERFLOW, 0
+            del packet_list[0]
+            buf[length:length + packet_length] = packet
+            length += packet_length
+            if packet_length < BULK_READ_LENGTH:
+                break
+        return TRANSFER_COMPLETED, length
+
+    def _respond(self, response):
+        self._response_packet_list.extend(
+            response[x:x + BULK_READ_LENGTH]
+            for x in range(0, len(response), BULK_READ_LENGTH)
+        )
+
+    def _longRespond(self, data):
+        self._respond(b'\x55\x5a' + pack('<h', len(data)) + data)
+
+    def _stuffedRespond(self, length, tail):
+        self._longRespond(b'\xff' * (length - len(tail)) + tail)
+
+    # Device behaviour
+    def _handleCommand(self, command, now):
+        self.command_count += 1
+        if command[0:1] != b'\xaa':
+            raise EmulatorError('Not a command: %r' % (command, ))
+        opcode = command[1:2]
+        if opcode == b'\x40':
+            self._respond(b'\x55' + bytes((self._card_type, )))
+        elif opcode == b'\x42':
+            length, = unpack('<h', command[2:4])
+            payload = command[4:]
+            if len(payload) != length:
+                raise EmulatorError('Long command length mismatch: %r' % (
+                  command, ))
+            self._handleLongCommand(payload, now)
+        elif command[1:3] == b'\x52\x03':
+            page_number, = unpack('<I', command[3:7])
+            if not self._checkPS2(page_number):
+                self._respond(RESPONSE_FAILURE)
+                return
+            offset = page_number * PAGE_LENGTH
+            self._longRespond(bytes(self._image[offset:offset + PAGE_LENGTH]))
+        elif command[1:3] == b'\x57\x03':
+            page_number, = unpack('<I', command[3:7])
+            data = command[7:-2]
+            if not self._checkPS2(page_number) or len(data) != PAGE_LENGTH:
+                self._respond(RESPONSE_FAILURE)
+                return
+            self._writeImage(page_number * PAGE_LENGTH, data)
+            self._respond(b'\x55\x5a')
+        else:
+            raise EmulatorError('Unknown command: %r' % (command, ))
+
+    def _checkPS2(self, page_number):
+        return self._card_type == PS2_CARD_TYPE and self._authenticated and \
+          page_number < PS2_CARD_SIZE // PAGE_LENGTH
+
+    def _writeImage(self, offset, data):
+        self._image[offset:offset + len(data)] = data
+        image_file = self._image_file
+        if image_file is not None:
+            image_file.seek(offset)
+            image_file.write(data)
+            image_file.flush()
+
+    def _handleLongCommand(self, payload, now):
+        opcode = payload[:2]
+        length = len(payload)
+        if opcode == b'\x81\x52':
+            frame_number_data = payload[4:6]
+            frame_number, = unpack('>H', frame_number_data)
+            if self._card_type != PS1_CARD_TYPE or \
+                    frame_number >= PS1_CARD_SIZE // FRAME_LENGTH:
+                self._respond(RESPONSE_FAILURE)
+                return
+            offset = frame_number * FRAME_LENGTH
+            data = bytes(self._image[offset:offset + FRAME_LENGTH])
+            self._longRespond(
+                b'\xff\x00\x5a\x5d\x00\x00\x5c\x5d' + frame_number_data +
+                data + bytes((_frameChecksum(frame_number_data, data), )) +
+                b'\x47'
+            )
+        elif opcode == b'\x81\x57':
+            frame_number_data = payload[4:6]
+            frame_number, = unpack('>H', frame_number_data)
+            data = payload[6:6 + FRAME_LENGTH]
+            if self._card_type != PS1_CARD_TYPE or \
+                    frame_number >= PS1_CARD_SIZE // FRAME_LENGTH:
+                self._respond(RESPONSE_FAILURE)
+                return
+            self._writeImage(frame_number * FRAME_LENGTH, data)
+            self._longRespond(
+                b'\xff\x00\x5a\x5d\x00' + frame_number_data + data +
+                b'\x5c\x5d\x47'
+            )
+        elif opcode == b'\x81\x11':
+            if self._authenticated:
+                self._stuffedRespond(length, b'\x2b\x55')
+            else:
+                self._respond(RESPONSE_FAILURE)
+        elif opcode in (b'\x81\xf3', b'\x81\xf7'):
+            self._stuffedRespond(length, b'\x2b\xff')
+        elif opcode == b'\x81\xf0':
+            self._handleAuthStep(payload[2], payload[3:], now)
+        elif opcode == b'\x81\x28':
+            self._stuffedRespond(length, b'\x2b\xff\xff')
+        elif opcode == b'\x81\x27':
+            self._stuffedRespond(length, b'\x2b\x55')
+        elif opcode == b'\x81\x26':
+            self._authenticated = self._card_type != NO_CARD_TYPE and \
+              self._checkAnswers()
+            self._stuffedRespond(length, b'\x2b' + b'\x00' * 9 + b'\x55')
+        elif opcode == b'\x81\x58':
+            self._respond(RESPONSE_FAILURE)
+        else:
+            raise EmulatorError('Unknown long command: %r' % (payload, ))
+
+    def _handleAuthStep(self, seq_number, data, now):
+        length = len(data) + 3
+        if seq_number == 0:
+            self._authenticated = False
+            self._seed = None
+            self._answer_list = [None, None, None]
+        if seq_number in (1, 2):
+            self._stuffedRespond(length,
+              b'\x2b' + ADAPTER_SERIAL[seq_number - 1] + b'\xff')
+        elif seq_number == 4:
+            seed_list = self._seed_list
+            if seed_list:
+                seed = seed_list[self._random.randrange(len(seed_list))]
+            else:
+                seed = bytes(self._random.getrandbits(8) for _ in range(9))
+            self._seed = seed
+            self._seed_time = now
+            self._stuffedRespond(length, b'\x2b' + seed + b'\xff')
+        elif seq_number == 5:
+            if self._seed is None or now - self._seed_time > self._auth_timeout:
+                self._respond(RESPONSE_FAILURE)
+                return
+            self._stuffedRespond(length, b'\x2b\xff')
+        elif seq_number in (6, 7, 0xb):
+            self._answer_list[(6, 7, 0xb).index(seq_number)] = bytes(data[:9])
+            self._stuffedRespond(length, b'\x2b\xff')
+        elif seq_number in (0xf, 0x11, 0x13):
+            self._stuffedRespond(length,
+              b'\x2b' + DEVICE_AUTH[(0xf, 0x11, 0x13).index(seq_number)] +
+              b'\xff')
+        else:
+            self._stuffedRespond(length, b'\x2b\xff')
+
+    def _checkAnswers(self):
+        if self._seed is None:
+            return False
+        authentication_dict = self._authentication_dict
+        if authentication_dict is None:
+            return True
+        try:
+            expected = authentication_dict[self._seed]
+        except KeyError:
+            return False
+        return tuple(expected) == tuple(self._answer_list)
+
+    # Statistics
+    def getStatistics(self):
+        """
+          Return a dict of counters of USB activity since instance creation.
+        """
+        return {
+            'command': self.command_count,
+            'lost_command': self.lost_command_count,
+            'transfer': self.transfer_count,
+            'transfer_byte': self.transfer_byte_count,
+        }
@@ -1,80 +1,642 @@
 #!/usr/bin/env python3
+from collections import deque
 from functools import partial
 import os
+from queue import Empty, Queue
 import select
+import signal
 import socket
 import sys
+import threading
+import time
+from traceback import print_exc
 import usb1
 from nbd import NBDServer
-from cache import FileDictCache
-from authenticator import SockAuthenticator
-from memory_card_reader import PlayStationMemoryCardReader
+from block_device import CachedBlockDevice, WriteBackBlockDevice
+from cache import SharedDictCache, openCache
+from authenticator import (
+    HEDGE_DELAY,
+    SockAuthenticator,
+    TIMEOUT,
+    parseAddress,
+)
+from command_trace import CommandTracer
+from usb_trace import RecordingUSBDevice
+from memory_card_reader import (
+    PlayStationMemoryCardReader,
+    PS1_CARD_TYPE,
+    PS2_CARD_TYPE,
+)
+
+ADAPTER_VENDOR_ID = 0x054c
+ADAPTER_PRODUCT_ID = 0x02ea
+# How often, in seconds, idle adapters are checked for card changes.
+CARD_POLL_INTERVAL = 1
+# Queued to an adapter worker to have it check for card changes.
+POLL_CARD = 'poll card'
+# Queued to an adapter worker, with an USB handle, to have it start using it.
+ATTACH = 'attach'
+# Queued to an adapter worker to have it stop using its USB handle.
+DETACH = 'detach'
+
+CARD_TYPE_NAME_DICT = {
+    0: 'no card',
+    PS1_CARD_TYPE: 'PS1 card',
+    PS2_CARD_TYPE: 'PS2 card',
+}
+
+class NoAdapterError(IOError):
+    pass
+
+def getAdapterName(usb_device):
+    """
+      Name an adapter after the USB port it is plugged in, so it stays the same
+      across restarts and replugs in the same port.
+    """
+    return '%i-%s' % (
+        usb_device.getBusNumber(),
+        '.'.join(str(x) for x in usb_device.getPortNumberList()),
+    )
+
+class AdapterDevice(object):
+    """
+      Device stack (reader, cache, write-back) of an adapter, which can be
+      unplugged and plugged again while clients use it: while unplugged, all
+      accesses fail with NoAdapterError.
+      Accesses are serialised, as they come from several threads.
+    """
+    def __init__(self, name, options, authenticator, usb_context):
+        self.name = name
+        self._options = options
+        self._authenticator = authenticator
+        self._usb_context = usb_context
+        self._lock = threading.Lock()
+        self._usb_handle = None
+        self._trace_file = None
+        self._reader = None
+        self._cached_device = None
+        self._write_back_device = None
+        self._device = None
+        self._card_identity = None
+        # Kept across replugs, so histograms cover the whole run.
+        self.tracer = CommandTracer(options.trace) if options.trace else None
+        if options.write_back:
+            self.flush = partial(self._call, 'flush')
+            self.flushIfExpired = partial(self._call, 'flushIfExpired')
+
+    def attach(self, usb_handle):
+        """
+          Start using <usb_handle>, with its interface already claimed.
+        """
+        options = self._options
+        with self._lock:
+            self._detach()
+            reader_handle = usb_handle
+            if options.record:
+                trace_path = os.path.join(options.record, '%s-%s.trace' % (
+                  self.name, time.strftime('%Y%m%d-%H%M%S')))
+                self._trace_file = open(trace_path, 'wb')
+                reader_handle = RecordingUSBDevice(usb_handle,
+                  self._trace_file)
+                print('%s: recording USB transfers to %s' % (
+                  self.name, trace_path))
+            reader = PlayStationMemoryCardReader(
+                reader_handle,
+                self._authenticator,
+                usb_context=self._usb_context,
+                card_type_poll_interval=options.card_type_poll_interval,
+                tracer=self.tracer,
+                reroll_count=options.auth_reroll,
+            )
+            device = reader
+            if options.cache_size:
+                device = self._cached_device = CachedBlockDevice(
+                    device,
+                    options.cache_size,
+                )
+            if options.write_back:
+                device = self._write_back_device = WriteBackBlockDevice(
+                    device,
+                    max_dirty_count=options.write_back,
+                    max_dirty_age=options.write_back_age,
+                )
+            self._usb_handle = usb_handle
+            self._reader = reader
+            self._device = device
+            self._card_identity = None
+        print('%s: adapter plugged' % (self.name, ))
+
+    def detach(self):
+        """
+          Stop using current adapter, if any.
+        """
+        with self._lock:
+            self._detach()
+
+    def _detach(self):
+        if self._usb_handle is None:
+            return
+        if self._write_back_device is not None:
+            dirty_count = self._write_back_device.getDirtyCount()
+            if dirty_count:
+                print('%s: %i unflushed blocks lost' % (self.name, dirty_count))
+        self._printStatistics()
+        try:
+            self._usb_handle.close()
+        except usb1.USBError:
+            pass
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+        self._usb_handle = self._reader = self._cached_device = \
+          self._write_back_device = self._device = None
+        print('%s: adapter released' % (self.name, ))
+
+    def _printStatistics(self):
+        print('%s: Unchanged block writes skipped: %i' % (
+          self.name, self._reader.getSkippedWriteCount()))
+        seed_statistics = self._reader.getSeedStatistics()
+        if seed_statistics['draw']:
+            print('%s: Authentication seed statistics: %r' % (
+              self.name, seed_statistics))
+        if self._cached_device is not None:
+            print('%s: Block cache statistics: %r' % (
+              self.name, self._cached_device.getStatistics()))
+
+    def close(self):
+        """
+          Flush modified blocks and stop using current adapter.
+        """
+        with self._lock:
+            if self._write_back_device is not None:
+                try:
+                    self._write_back_device.flush()
+                except Exception:
+                    print_exc()
+            self._detach()
+
+    def _call(self, method_id, *args):
+        with self._lock:
+            device = self._device
+            if device is None:
+                raise NoAdapterError('Adapter %s is unplugged' % (self.name, ))
+            return getattr(device, method_id)(*args)
+
+    def getSize(self):
+        return self._call('getSize')
+
+    def getPageSize(self):
+        return self._call('getPageSize')
+
+    def read(self, offset, length):
+        return self._call('read', offset, length)
+
+    def readinto(self, offset, buf):
+        return self._call('readinto', offset, buf)
+
+    def readChunks(self, offset, length, onChunk):
+        return self._call('readChunks', offset, length, onChunk)
+
+    def write(self, offset, data):
+        return self._call('write', offset, data)
+
+    def pollCard(self):
+        """
+          Check for card changes, so they are noticed even without client
+          activity. Newly inserted PS2 cards get authenticated right away, so
+          clients do not wait for it on first access.
+        """
+        with self._lock:
+            reader = self._reader
+            if reader is None:
+                return
+            try:
+                card_identity = reader.getCardIdentity()
+            except Exception as exc:
+                reader.invalidateCardType()
+                print('%s: could not get card type: %s' % (self.name, exc))
+                return
+            if card_identity != self._card_identity:
+                self._card_identity = card_identity
+                card_type = card_identity[0]
+                print('%s: %s' % (
+                  self.name,
+                  CARD_TYPE_NAME_DICT.get(
+                    card_type,
+                    'unknown card type %02x' % (card_type, ),
+                  ),
+                ))
+                try:
+                    if reader.preAuthenticate():
+                        print('%s: authenticated' % (self.name, ))
+                except Exception as exc:
+                    # Will be retried on first access.
+                    print('%s: could not authenticate: %s' % (self.name, exc))
+
+class AdapterWorker(threading.Thread):
+    """
+      Execute NBD requests on one adapter, in their own thread so slow card
+      operations do not hold back network I/O nor other adapters.
+    """
+    def __init__(self, device, poll_timeout, onReply):
+        """
+          device (AdapterDevice)
+          poll_timeout (float)
+            How long, in seconds, worker may stay idle before checking for
+            card change and expired modified blocks.
+          onReply (callable)
+            Called with nbd_server, reply data, and whether connection can
+            continue, for each executed request.
+        """
+        super().__init__(name=device.name, daemon=True)
+        self.device = device
+        self._poll_timeout = poll_timeout
+        self._onReply = onReply
+        self._queue = Queue()
+
+    def submit(self, nbd_server, request):
+        """
+          Queue a request received by <nbd_server> for execution.
+          Can be called from any thread.
+        """
+        self._queue.put((nbd_server, request))
+
+    def poll(self):
+        """
+          Ask worker to check for card changes once queued requests are
+          executed.
+        """
+        self._queue.put(POLL_CARD)
+
+    def attach(self, usb_handle):
+        """
+          Ask worker to start using <usb_handle> once queued requests are
+          executed.
+          Device is only (un)plugged by worker, as it has to wait for any
+          card operation in progress, which may take seconds.
+        """
+        self._queue.put((ATTACH, usb_handle))
+
+    def detach(self):
+        """
+          Ask worker to stop using its USB handle once queued requests are
+          executed (they fail if adapter is gone).
+        """
+        self._queue.put(DETACH)
+
+    def stop(self):
+        """
+          Ask worker to flush and exit once queued requests are executed.
+        """
+        self._queue.put(None)
+
+    def run(self):
+        device = self.device
+        flushIfExpired = getattr(device, 'flushIfExpired', lambda: None)
+        get = self._queue.get
+        poll_timeout = self._poll_timeout
+        onReply = self._onReply
+        try:
+            while True:
+                try:
+                    item = get(timeout=poll_timeout)
+                except Empty:
+                    device.pollCard()
+                else:
+                    if item is None:
+                        break
+                    if item is POLL_CARD:
+                        device.pollCard()
+                    elif item is DETACH:
+                        device.detach()
+                    elif item[0] is ATTACH:
+                        try:
+                            device.attach(item[1])
+                        except Exception:
+                            print_exc()
+                    else:
+                        nbd_server, request = item
+                        onReply(nbd_server, *nbd_server.execute(
+                            request,
+                            # Streamed read data.
+                            lambda data: onReply(nbd_server, data, True),
+                        ))
+                try:
+                    flushIfExpired()
+                except NoAdapterError:
+                    pass
+                except Exception:
+                    print_exc()
+        finally:
+            device.close()
+
+class EventLoop(object):
+    """
+      Single non-blocking loop handling USB events (including adapter
+      hotplug), NBD client connections, request reception and reply sending.
+      Requests are executed by adapter workers, NBD handshakes by short-lived
+      threads.
+    """
+    def __init__(self, options, nbd_sock, usb_context, authenticator,
+            authentication_cache, worker_list):
+        self._options = options
+        self._nbd_sock = nbd_sock
+        self._usb_context = usb_context
+        self._authenticator = authenticator
+        # Written to disk from this thread, off authentication's path.
+        self._authentication_cache = authentication_cache
+        self._worker_list = worker_list
+        if options.write_back:
+            self._poll_timeout = min(options.write_back_age, CARD_POLL_INTERVAL)
+        else:
+            self._poll_timeout = CARD_POLL_INTERVAL
+        self._epoll = select.epoll()
+        # Also handles USB events when libusb file descriptors are ready.
+        self._poller = usb1.USBPoller(usb_context, self._epoll)
+        # Calls from other threads, to be run in loop thread.
+        self._call_queue = deque()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        # Only modified in loop thread, but read from handshake threads.
+        self._export_dict = {}
+        self._worker_dict = {}
+        # fileno: nbd_server
+        self._client_dict = {}
+        # nbd_server: (fileno, worker)
+        self._client_info_dict = {}
+        # Clients to disconnect once their pending replies are sent.
+        self._closing_set = set()
+        self._callback_handle = None
+
+    def _callSoon(self, func, *args):
+        """
+          Have <func> called in loop thread. Can be called from any thread.
+        """
+        self._call_queue.append((func, args))
+        os.write(self._wakeup_write, b'\0')
+
+    def _onHotplug(self, usb_context, usb_device, event):
+        # Callback must not do any USB I/O, and can be called from any thread
+        # handling USB events.
+        if event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED:
+            self._callSoon(self._onArrived, usb_device)
+        else:
+            self._callSoon(self._onLeft, usb_device)
+        return False
+
+    def _onArrived(self, usb_device):
+        name = getAdapterName(usb_device)
+        export_name = name.encode('utf-8')
+        try:
+            usb_handle = usb_device.open()
+            usb_handle.claimInterface(0)
+        except usb1.USBError as exc:
+            print('%s: could not open adapter: %s' % (name, exc))
+            return
+        worker_dict = self._worker_dict
+        export_dict = self._export_dict
+        try:
+            worker = worker_dict[export_name]
+        except KeyError:
+            device = AdapterDevice(
+                name,
+                self._options,
+                self._authenticator,
+                self._usb_context,
+            )
+            worker = AdapterWorker(
+                device,
+                self._poll_timeout,
+                partial(self._callSoon, self._onReply),
+            )
+            self._worker_list.append(worker)
+            worker.start()
+            worker_dict[export_name] = worker
+            export_dict[export_name] = device
+            print('Exporting adapter %s' % (name, ))
+            if len(self._worker_list) == 1:
+                # Let clients not bother about export names.
+                export_dict[b''] = device
+                worker_dict[b''] = worker
+            else:
+                export_dict.pop(b'', None)
+                worker_dict.pop(b'', None)
+        worker.attach(usb_handle)
+        # Notice inserted card (and authenticate) before any client asks.
+        worker.poll()
+
+    def _onDumpTrace(self, signum, frame):
+        for export_name, worker in sorted(self._worker_dict.items()):
+            if export_name:
+                sys.stderr.write('%s: command latency:\n%s\n' % (
+                  worker.device.name, worker.device.tracer.format()))
+        sys.stderr.flush()
+
+    def _onLeft(self, usb_device):
+        worker = self._worker_dict.get(
+            getAdapterName(usb_device).encode('utf-8'),
+        )
+        if worker is not None:
+            worker.detach()
+
+    def _greet(self, nbd_client_sock, addr):
+        # Runs in its own thread, as handshake is a blocking conversation
+        # with client, which may also need to access the device.
+        nbd_server = NBDServer(
+            sock=nbd_client_sock,
+            export_dict=self._export_dict,
+        )
+        try:
+            greeted = nbd_server.greet()
+        except Exception:
+            print_exc()
+            nbd_server.close()
+            return
+        if greeted:
+            export_name = nbd_server.getExportName()
+            print('Client connected %s:%i to export %r' % (
+              addr + (export_name, )))
+            self._callSoon(self._addClient, nbd_server, export_name)
+
+    def _accept(self):
+        (nbd_client_sock, addr) = self._nbd_sock.accept()
+        # Replies are sent in several parts, do not wait for client
+        # acknowledgement between them.
+        nbd_client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(
+            target=self._greet,
+            args=(nbd_client_sock, addr),
+            daemon=True,
+        ).start()
+
+    def _addClient(self, nbd_server, export_name):
+        worker = self._worker_dict.get(export_name)
+        if worker is None:
+            nbd_server.close()
+            return
+        fileno = nbd_server.fileno()
+        nbd_server.setblocking(False)
+        self._client_dict[fileno] = nbd_server
+        self._client_info_dict[nbd_server] = (fileno, worker)
+        self._epoll.register(fileno, select.EPOLLIN)
+
+    def _removeClient(self, nbd_server):
+        fileno, _ = self._client_info_dict.pop(nbd_server)
+        del self._client_dict[fileno]
+        self._closing_set.discard(nbd_server)
+        try:
+            self._epoll.unregister(fileno)
+        except OSError:
+            # Already closed by NBDServer, which removed it from epoll.
+            pass
+        nbd_server.close()
+
+    def _onReply(self, nbd_server, reply, keep_open):
+        try:
+            fileno, _ = self._client_info_dict[nbd_server]
+        except KeyError:
+            # Client went away while its request was executed.
+            return
+        if not keep_open:
+            self._closing_set.add(nbd_server)
+        if nbd_server.send(reply):
+            if not keep_open:
+                self._removeClient(nbd_server)
+        else:
+            self._epoll.modify(fileno, select.EPOLLIN | select.EPOLLOUT)
+
+    def _onClientEvent(self, fileno, nbd_server, event):
+        if event & select.EPOLLOUT:
+            if nbd_server.send():
+                if nbd_server in self._closing_set:
+                    self._removeClient(nbd_server)
+                    return
+                self._epoll.modify(fileno, select.EPOLLIN)
+        if event & select.EPOLLIN:
+            request_list = nbd_server.receive()
+            if request_list is None:
+                self._removeClient(nbd_server)
+                return
+            _, worker = self._client_info_dict[nbd_server]
+            for request in request_list:
+                worker.submit(nbd_server, request)
+        elif event & (select.EPOLLHUP | select.EPOLLERR):
+            self._removeClient(nbd_server)
+
+    def run(self):
+        usb_context = self._usb_context
+        epoll = self._epoll
+        nbd_sock_fileno = self._nbd_sock.fileno()
+        wakeup_read = self._wakeup_read
+        epoll.register(nbd_sock_fileno, select.EPOLLIN)
+        epoll.register(wakeup_read, select.EPOLLIN)
+        if usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            # Also enumerates already-plugged adapters.
+            self._callback_handle = usb_context.hotplugRegisterCallback(
+                self._onHotplug,
+                vendor_id=ADAPTER_VENDOR_ID,
+                product_id=ADAPTER_PRODUCT_ID,
+            )
+        else:
+            print('USB hotplug not supported, only using adapters plugged '
+              'now')
+            for usb_device in usb_context.getDeviceIterator(skip_on_error=True):
+                if usb_device.getVendorID() == ADAPTER_VENDOR_ID and \
+                        usb_device.getProductID() == ADAPTER_PRODUCT_ID:
+                    self._onArrived(usb_device)
+        if self._options.trace:
+            signal.signal(signal.SIGUSR1, self._onDumpTrace)
+        print('Waiting for client...')
+        self._nbd_sock.listen(5)
+        client_dict = self._client_dict
+        call_queue = self._call_queue
+        flushIfExpired = self._authentication_cache.flushIfExpired
+        poll_timeout = self._options.auth_cache_flush_interval
+        try:
+            while True:
+                try:
+                    flushIfExpired()
+                except Exception:
+                    # Retried on next iteration, and on exit.
+                    print_exc()
+                for fd, event in self._poller.poll(poll_timeout):
+                    if fd == wakeup_read:
+                        os.read(wakeup_read, 4096)
+                    elif fd == nbd_sock_fileno:
+                        self._accept()
+                    else:
+                        nbd_server = client_dict.get(fd)
+                        if nbd_server is not None:
+                            self._onClientEvent(fd, nbd_server, event)
+                while call_queue:
+                    func, args = call_queue.popleft()
+                    try:
+                        func(*args)
+                    except Exception:
+                        print_exc()
+        finally:
+            if self._callback_handle is not None:
+                usb_context.hotplugDeregisterCallback(self._callback_handle)
+            for nbd_server in list(client_dict.values()):
+                self._removeClient(nbd_server)
+            epoll.close()
+            os.close(wakeup_read)
+            os.close(self._wakeup_write)
 
 def main(options):
     nbd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     nbd_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     nbd_sock.bind((options.nbd_address, options.nbd_port))
-    authentication_cache = FileDictCache(options.auth_cache,
-      read_only=options.auth_cache_read_only)
-    authenticator = SockAuthenticator(options.auth_address, options.auth_port,
-      authentication_cache)
-    socket_dict = {}
-    # TODO: refactor to support non-blocking IO
+    if options.auth_cache_server:
+        authentication_cache = SharedDictCache(options.auth_cache_server)
+    else:
+        authentication_cache = openCache(
+            options.auth_cache,
+            read_only=options.auth_cache_read_only,
+            flush_count=options.auth_cache_flush_count,
+            flush_interval=options.auth_cache_flush_interval,
+            fsync=options.auth_cache_fsync,
+        )
+    # Shared by all adapters.
+    authenticator = SockAuthenticator(
+        [
+            parseAddress(x, options.auth_port)
+            for x in options.auth_address or ('127.0.0.1', )
+        ],
+        authentication_cache,
+        timeout=options.auth_timeout,
+        hedge_delay=options.auth_hedge_delay,
+    )
+    worker_list = []
+    # Exit cleanly (flushing cache and modified blocks) on SIGTERM too.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
         with usb1.USBContext() as usb_context:
-            usb_device = usb_context.openByVendorIDAndProductID(
-                0x054c,
-                0x02ea,
-                skip_on_error=True,
-            )
-            if usb_device is None:
-                sys.exit("Could not open the ps3 adapter usb device")
-            with usb_device.claimInterface(0):
-                reader = PlayStationMemoryCardReader(usb_device, authenticator)
-                print('Waiting for client...')
-                epoll = select.epoll()
-                def accept():
-                    (nbd_client_sock, addr) = nbd_sock.accept()
-                    fileno = nbd_client_sock.fileno()
-                    print('Client connected %s:%i' % addr)
-                    nbd_server = NBDServer(sock=nbd_client_sock, device=reader)
-                    if nbd_server.greet():
-                        socket_dict[fileno] = nbd_server
-                        handler_dict[nbd_server] = nbd_server.handle
-                        epoll.register(
-                            fileno,
-                            select.EPOLLIN | select.EPOLLHUP,
-                        )
-
-                nbd_sock_fileno = nbd_sock.fileno()
-                socket_dict[nbd_sock_fileno] = nbd_sock
-                handler_dict = {
-                    nbd_sock: accept,
-                }
-                epoll.register(nbd_sock_fileno, select.EPOLLIN)
-                try:
-                    nbd_sock.listen(1)
-                    while True:
-                        for fd, event in epoll.poll():
-                            print(fd, event)
-                            sock = socket_dict[fd]
-                            if event == select.EPOLLIN:
-                                handler_dict[sock]()
-                            else:
-                                epoll.unregister(sock.fileno())
-                                del socket_dict[sock.fileno()]
-                                del handler_dict[sock]
-                                sock.close()
-                finally:
-                    nbd_sock.shutdown(socket.SHUT_RDWR)
-                    del socket_dict[nbd_sock_fileno]
+            try:
+                EventLoop(
+                    options,
+                    nbd_sock,
+                    usb_context,
+                    authenticator,
+                    authentication_cache,
+                    worker_list,
+                ).run()
+            finally:
+                # Workers must be done with their adapters before USB
+                # context gets closed.
+                for worker in worker_list:
+                    if worker.is_alive():
+                        worker.stop()
+                        worker.join()
     except KeyboardInterrupt:
         pass
     finally:
         nbd_sock.close()
-        for sock in socket_dict.values():
-            # ...actually NBDServer objects
-            sock.close()
+        authentication_cache.close()
+        authenticator_statistics = authenticator.getStatistics()
+        if authenticator_statistics['request']:
+            print('Authentication daemon statistics: %r' % (
+              authenticator_statistics, ))
 
 if __name__ == '__main__':
     # TODO: argparse, move in main()
@@ -90,10 +652,56 @@ if __name__ == '__main__':
     parser.add_option('-r', '--auth-cache-read-only', default=False,
       action='store_true',
       help='Don\'t store authentication information generated during this run.')
+    parser.add_option('--auth-cache-flush-count', default=16, type='int',
+      help='Number of new authentication answers which triggers a write to '
+      'cache file.')
+    parser.add_option('--auth-cache-flush-interval', default=10, type='float',
+      help='Maximum time, in seconds, new authentication answers are kept '
+      'in memory before being written to cache file.')
+    parser.add_option('--auth-cache-fsync', default=False,
+      action='store_true',
+      help='Make sure cache file writes reach the disk. Memory-mapped '
+      'cache files are only forced to disk with this option, following '
+      '--auth-cache-flush-count and --auth-cache-flush-interval.')
+    parser.add_option('-S', '--auth-cache-server',
+      help='Unix socket of an authentication cache service (cache_server.py) '
+      'to use instead of a cache file, to share authentication data with '
+      'other processes.')
     parser.add_option('-P', '--auth-port', default=20531, type='int',
-      help='Port used to contact authentication daemon.')
-    parser.add_option('-A', '--auth-address', default='127.0.0.1',
-      help='Address used to contact authentication daemon.')
+      help='Port used to contact authentication daemons, unless given in '
+      'address.')
+    parser.add_option('-A', '--auth-address', action='append',
+      help='Address (host or host:port) used to contact an authentication '
+      'daemon. Can be repeated to use several daemons. Default: 127.0.0.1')
+    parser.add_option('--auth-timeout', default=TIMEOUT, type='float',
+      help='Time, in seconds, after which authentication daemons are given '
+      'up on for a seed, and authentication restarts with another seed. '
+      'Must be longer than daemon latency, as late answers only get cached.')
+    parser.add_option('--auth-hedge-delay', default=HEDGE_DELAY,
+      type='float',
+      help='Time, in seconds, after which a seed is also sent to the next '
+      'authentication daemon.')
+    parser.add_option('--auth-reroll', default=0, type='int',
+      help='Number of times PS2 authentication may restart to get a seed '
+      'with a cached answer, before asking authentication daemon.')
+    parser.add_option('-t', '--card-type-poll-interval', default=1,
+      type='float',
+      help='How long, in seconds, card type is trusted before asking device '
+      'again.')
+    parser.add_option('-C', '--cache-size', default=1024, type='int',
+      help='Number of card blocks to keep in memory. 0 to disable.')
+    parser.add_option('-w', '--write-back', default=0, type='int',
+      help='Number of modified card blocks to keep in memory before writing '
+      'them to card. 0 to write immediately.')
+    parser.add_option('-W', '--write-back-age', default=5, type='float',
+      help='Maximum time, in seconds, modified card blocks can be kept in '
+      'memory.')
+    parser.add_option('-T', '--trace', default=0, type='int',
+      help='Number of most recent USB commands to record per adapter, with '
+      'latency histograms dumped on SIGUSR1. 0 to disable.')
+    parser.add_option('-R', '--record',
+      help='Directory where to record USB transfers of each adapter, to be '
+      'replayed with usb_trace.ReplayUSBDevice.')
     (options, args) = parser.parse_args()
     main(options)
 
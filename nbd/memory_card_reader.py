@@ -1,9 +1,43 @@
+from collections import Counter, deque
+from functools import partial
+from hashlib import blake2b
 from struct import pack, unpack
+from time import monotonic, sleep
+from authenticator import AuthenticationError
+from block_device import BlockDevice, _copyBlock
 
 BULK_WRITE_ENDPOINT = 0x2
 BULK_READ_ENDPOINT = 0x1
 BULK_READ_LENGTH = 64
 
+# Number of read commands kept in flight by pipelined reads.
+PIPELINE_DEPTH = 8
+# Maximum age, in seconds, of cached card type before device is queried again.
+CARD_TYPE_POLL_INTERVAL = 1
+# libusb_transfer_status values for a successfuly completed transfer, and
+# for one which timed out.
+TRANSFER_COMPLETED = 0
+TRANSFER_TIMED_OUT = 2
+# Length of digests used to identify known block content.
+DIGEST_LENGTH = 16
+# Bounds and initial value of transfer timeouts, in seconds. Timeouts follow
+# measured response latency between these bounds.
+MIN_TIMEOUT = .2
+MAX_TIMEOUT = 5
+INITIAL_TIMEOUT = 1
+# Number of times failed idempotent commands are retried, and delay before
+# the first retry (doubled on each retry), in seconds.
+RETRY_COUNT = 3
+RETRY_DELAY = .05
+# Maximum number of stale response packets discarded before a retry.
+MAX_DRAIN_PACKET_COUNT = 256
+# Maximum time, in seconds, spent waiting for USB events at once during
+# pipelined reads, in case another thread handled them meanwhile.
+HANDLE_EVENTS_TIMEOUT = .1
+# Number of times authentication restarts to get a seed with a cached answer,
+# before asking authenticator for an uncached one.
+REROLL_COUNT = 0
+
 COMMAND_CODE = b'\xaa'
 COMMAND_TYPE_LONG = b'\x42'
 
@@ -20,6 +54,13 @@ PS1_CARD_SIZE = 0x20000
 
 PS1_COMMAND_TAIL = b'\x00' * 0x86 # 0x36 + 0x40 + 0x16
 
+# Long response: response code, status, length, data.
+# Data length is the same as the command's.
+PS1_READ_RESPONSE_LENGTH = 4 + 0xa + FRAME_LENGTH + 2
+# Page read is a short command, with a long response: response code, status,
+# length, data.
+PS2_READ_RESPONSE_LENGTH = 4 + PAGE_LENGTH
+
 CARD_SIZE_DICT = {
     PS1_CARD_TYPE: PS1_CARD_SIZE,
     PS2_CARD_TYPE: PS2_CARD_SIZE,
@@ -30,6 +71,14 @@ CARD_PAGE_DICT = {
     PS2_CARD_TYPE: PAGE_LENGTH,
 }
 
+class CardReaderError(IOError):
+    """
+      Device did not respond, or responded unexpectedly.
+    """
+
+class NoCardError(CardReaderError):
+    pass
+
 def hexdump(data):
     return ' '.join('%02x' % x for x in data)
 
@@ -38,52 +87,433 @@ def _padCommand(command, padding=2):
 
 def _stripResponse(response, padding=2):
     stuffing = response[:-padding]
-    assert stuffing == b'\xff' * len(stuffing), hexdump(stuffing)
+    if stuffing != b'\xff' * len(stuffing):
+        raise CardReaderError('Unexpected response stuffing: %s' % (
+          hexdump(stuffing), ))
     return response[-padding:]
 
-class PlayStationMemoryCardReader(object):
-    def __init__(self, usb_device, authenticator):
+def _expect(value, expected):
+    if value != expected:
+        raise CardReaderError('Unexpected response: %s, expected %s' % (
+          hexdump(value), hexdump(expected)))
+
+def _command(data):
+    return COMMAND_CODE + data
+
+def _longCommand(data):
+    return _command(COMMAND_TYPE_LONG + pack('<h', len(data)) + data)
+
+def _splitLongResponse(response):
+    """
+      Split a complete long response, as received from device, into its
+      response code and data.
+    """
+    if response[0:1] != RESPONSE_CODE:
+        raise CardReaderError('Received data is not a valid response: %s' % (
+          hexdump(response), ))
+    response_code = bytes(response[1:2])
+    data = b''
+    if response_code == RESPONSE_STATUS_SUCCES:
+        response_length = unpack('<h', response[2:4])[0]
+        data = response[4:4 + response_length]
+        if len(data) != response_length:
+            raise CardReaderError('Short response: %i bytes, expected %i' % (
+              len(data), response_length))
+    return response_code, data
+
+def _digest(data):
+    return blake2b(data, digest_size=DIGEST_LENGTH).digest()
+
+class PlayStationMemoryCardReader(BlockDevice):
+    def __init__(self, usb_device, authenticator, usb_context=None,
+          pipeline_depth=PIPELINE_DEPTH,
+          card_type_poll_interval=CARD_TYPE_POLL_INTERVAL,
+          retry_count=RETRY_COUNT, tracer=None, reroll_count=REROLL_COUNT):
+        """
+          usb_device (usb1.USBDeviceHandle)
+            Handle of the card reader, with its interface claimed.
+          authenticator
+            Instance implementing authenticate(seed) -> 3-tuple of strings.
+          usb_context (usb1.USBContext, or None)
+            Context usb_device was opened from. When provided, multi-block
+            reads keep several commands in flight using asynchronous
+            transfers. Otherwise, they are done one synchronous command at a
+            time.
+          pipeline_depth (int)
+            Maximum number of read commands in flight.
+          card_type_poll_interval (float)
+            How long, in seconds, a card type obtained from device can be
+            trusted. 0 to query it on every access.
+          retry_count (int)
+            Number of times failed idempotent commands (card type and
+            authentication status queries, reads) are retried, and of
+            consecutive authenticator failures (ex: answer timeouts) after
+            which authentication is given up.
+          tracer (command_trace.CommandTracer, or None)
+            Where to record completed commands and their latency.
+          reroll_count (int)
+            Number of times authentication may restart to draw another seed
+            when authenticator has no cached answer for the current one, as
+            device generates few distinct seeds. Only effective if
+            authenticator implements isCached(seed) -> bool.
+        """
         self._usb_device = usb_device
         self._authenticator = authenticator
+        self._usb_context = usb_context
+        self._pipeline_depth = pipeline_depth
+        self._card_type_poll_interval = card_type_poll_interval
+        self._retry_count = retry_count
+        # Smoothed response latency and its variation, in seconds.
+        self._latency = None
+        self._latency_variation = None
+        self._timeout = INITIAL_TIMEOUT
+        self._tracer = tracer
+        # Command being traced, its start time, and number of bytes
+        # transferred so far.
+        self._trace_command = None
+        self._trace_start = None
+        self._trace_byte_count = 0
+        self._card_type = None
+        self._card_type_expiration = None
+        self._card_generation = 0
+        self._authenticated = False
+        # Digest of known block content, to skip rewriting identical data.
+        self._block_digest_dict = {}
+        self._skipped_write_count = 0
+        self._reroll_count = reroll_count
+        # Number of times each seed was drawn by device.
+        self._seed_counter = Counter()
+        self._seed_hit_count = 0
+        self._seed_miss_count = 0
+        self._reroll_total = 0
 
     # Read/write command helpers
-    def _usbRead(self):
-        result = self._usb_device.bulkRead(BULK_READ_ENDPOINT, BULK_READ_LENGTH)
-        #print '<', hexdump(result)
+    def _usbRead(self, measure=True):
+        """
+          Receive one response packet.
+          measure (bool)
+            Whether transfer duration is representative of device response
+            latency (ie: packet is the first of a response).
+        """
+        start = monotonic()
+        try:
+            result = self._usb_device.bulkRead(
+                BULK_READ_ENDPOINT,
+                BULK_READ_LENGTH,
+                timeout=self._getTimeoutMs(),
+            )
+        except Exception as exc:
+            self._onTimeout()
+            raise CardReaderError('Response transfer failed: %r' % (exc, ))
+        if measure:
+            self._recordLatency(monotonic() - start)
+        self._trace_byte_count += len(result)
         return result
 
     def _responseRead(self):
         result = self._usbRead()
         if result[0:1] != RESPONSE_CODE:
-            raise ValueError('Received data is not a valid response: %s' % (
+            raise CardReaderError(
+              'Received data is not a valid response: %s' % (
               hexdump(result), ))
+        self._traceResponse()
         return result[1:]
 
     def _longResponseRead(self):
-        result = []
-        append = result.append
-        response = self._responseRead()
-        response_code = response[0:1]
-        if response_code == RESPONSE_STATUS_SUCCES:
-            response_length = unpack('<h', response[1:3])[0]
-            data = response[3:]
-            data_length = len(data)
-            append(data)
-            while data_length < response_length:
-                response = self._usbRead()
-                data_length += len(response)
-                append(response)
-        return response_code, b''.join(result)
+        """
+          Receive a long response.
+          Return its response code, and data as a memoryview.
+        """
+        response = memoryview(self._usbRead())
+        if response[0:1] != RESPONSE_CODE:
+            raise CardReaderError(
+              'Received data is not a valid response: %s' % (
+              hexdump(response), ))
+        response_code = response[1:2].tobytes()
+        if response_code != RESPONSE_STATUS_SUCCES:
+            self._traceResponse()
+            return response_code, memoryview(b'')
+        response_length = unpack('<h', response[2:4])[0]
+        result = memoryview(bytearray(response_length))
+        data = response[4:]
+        data_length = len(data)
+        result[:data_length] = data
+        while data_length < response_length:
+            data = self._usbRead(measure=False)
+            result[data_length:data_length + len(data)] = data
+            data_length += len(data)
+        self._traceResponse()
+        return response_code, result
 
     def _usbWrite(self, data):
-        #print '>', hexdump(data)
-        self._usb_device.bulkWrite(BULK_WRITE_ENDPOINT, data)
+        if self._tracer is not None:
+            self._trace_command = data
+            self._trace_start = monotonic()
+            self._trace_byte_count = len(data)
+        try:
+            self._usb_device.bulkWrite(
+                BULK_WRITE_ENDPOINT,
+                data,
+                timeout=self._getTimeoutMs(),
+            )
+        except Exception as exc:
+            self._onTimeout()
+            raise CardReaderError('Command transfer failed: %r' % (exc, ))
+
+    def _drain(self):
+        """
+          Discard response packets device may still send for commands which
+          were given up on, so they are not mistaken for responses to later
+          commands.
+        """
+        for _ in range(MAX_DRAIN_PACKET_COUNT):
+            try:
+                self._usb_device.bulkRead(
+                    BULK_READ_ENDPOINT,
+                    BULK_READ_LENGTH,
+                    timeout=int(MIN_TIMEOUT * 1000),
+                )
+            except Exception:
+                break
+
+    def _traceResponse(self):
+        """
+          Record command sent by last _usbWrite call, now that its response
+          was entirely received.
+        """
+        command = self._trace_command
+        if command is not None:
+            self._trace_command = None
+            self._tracer.record(
+                command,
+                self._trace_byte_count,
+                self._trace_start,
+                monotonic() - self._trace_start,
+            )
+
+    # Timeouts & retries
+    def _recordLatency(self, latency):
+        # Same estimator as TCP retransmission timeout (RFC 6298).
+        if self._latency is None:
+            self._latency = latency
+            self._latency_variation = latency / 2
+        else:
+            self._latency_variation = .75 * self._latency_variation + \
+              .25 * abs(self._latency - latency)
+            self._latency = .875 * self._latency + .125 * latency
+        self._timeout = min(MAX_TIMEOUT, max(MIN_TIMEOUT,
+          self._latency + 4 * self._latency_variation))
+
+    def _onTimeout(self):
+        # Device may just be slower than measured so far.
+        self._timeout = min(MAX_TIMEOUT, self._timeout * 2)
+
+    def _getTimeoutMs(self):
+        return int(self._timeout * 1000)
+
+    def getTimeout(self):
+        """
+          Return current transfer timeout, in seconds.
+        """
+        return self._timeout
+
+    def _retry(self, func, *args, getProgress=None):
+        """
+          Call func(*args), retrying with exponential backoff when it fails
+          with a CardReaderError other than NoCardError.
+          func must be idempotent.
+          If given, getProgress() must return a value which changes when func
+          made some progress before failing, in which case retry count and
+          delay start over.
+        """
+        delay = RETRY_DELAY
+        retry_count = 0
+        while retry_count < self._retry_count:
+            if getProgress is not None:
+                progress = getProgress()
+            try:
+                return func(*args)
+            except NoCardError:
+                raise
+            except CardReaderError as exc:
+                if getProgress is not None and getProgress() != progress:
+                    delay = RETRY_DELAY
+                    retry_count = 0
+                print('%s, retrying in %.2fs' % (exc, delay))
+            retry_count += 1
+            self._drain()
+            # Also detects card changes.
+            self.invalidateCardType()
+            sleep(delay)
+            delay *= 2
+        return func(*args)
 
     def _commandWrite(self, data):
-        self._usbWrite(COMMAND_CODE + data)
+        self._usbWrite(_command(data))
 
     def _longCommandWrite(self, data):
-        self._commandWrite(COMMAND_TYPE_LONG + pack('<h', len(data)) + data)
+        self._usbWrite(_longCommand(data))
+
+    def _pipelinedRead(self, command_list, response_length, onResponse):
+        """
+          Send all commands from <command_list> and receive their responses,
+          keeping up to pipeline_depth commands in flight.
+          Each response is expected to be <response_length> bytes long, and is
+          given, in command order, to onResponse(index, response_code, data).
+          data is a memoryview on a buffer reused for later responses, so it
+          must be copied by onResponse if needed after it returns.
+        """
+        # Round up to a whole number of packets, so the device cannot overflow
+        # the buffer. Transfer still ends on response's short packet.
+        buffer_length = -(-response_length // BULK_READ_LENGTH) * \
+          BULK_READ_LENGTH
+        error_list = []
+        submitted_set = set()
+        command_iterator = enumerate(command_list)
+        write_timeout = self._getTimeoutMs()
+        # Responses come one after the other, so the last one submitted
+        # waits for all others in flight.
+        read_timeout = write_timeout * min(self._pipeline_depth,
+          len(command_list))
+        last_completion = None
+        next_index = 0
+        tracer = self._tracer
+        # Completed transfers, with their callback and completion time.
+        # Transfer callbacks may be called by any thread handling USB events
+        # (ex: NBD server main loop), so they only queue transfers, which are
+        # then processed in this thread: reader state is only touched by the
+        # thread using it.
+        completed = deque()
+
+        def queueWrite(write_transfer):
+            completed.append((onWrite, write_transfer, None))
+
+        def queueRead(read_transfer):
+            completed.append((onRead, read_transfer, monotonic()))
+
+        def submitRead(write_transfer, read_transfer, read_buffer):
+            # Note: the buffer given to setBulk is not copied, so libusb
+            # writes responses directly into read_buffer.
+            for index, command in command_iterator:
+                break
+            else:
+                return
+            write_transfer.setBulk(
+                BULK_WRITE_ENDPOINT,
+                command,
+                callback=queueWrite,
+                timeout=write_timeout,
+            )
+            read_transfer.setBulk(
+                BULK_READ_ENDPOINT | 0x80,
+                read_buffer,
+                callback=queueRead,
+                user_data=(index, write_transfer, read_buffer, monotonic()),
+                timeout=read_timeout,
+            )
+            write_transfer.submit()
+            submitted_set.add(write_transfer)
+            read_transfer.submit()
+            submitted_set.add(read_transfer)
+
+        def onWrite(write_transfer, _):
+            submitted_set.discard(write_transfer)
+            status = write_transfer.getStatus()
+            if status != TRANSFER_COMPLETED:
+                if status == TRANSFER_TIMED_OUT:
+                    self._onTimeout()
+                error_list.append(CardReaderError(
+                  'Command transfer failed with status %i' % (status, )))
+
+        def onRead(read_transfer, now):
+            nonlocal last_completion, next_index
+            submitted_set.discard(read_transfer)
+            index, write_transfer, read_buffer, submit_time = \
+              read_transfer.getUserData()
+            status = read_transfer.getStatus()
+            if status != TRANSFER_COMPLETED:
+                if status == TRANSFER_TIMED_OUT:
+                    self._onTimeout()
+                error_list.append(CardReaderError(
+                  'Response transfer failed with status %i' % (status, )))
+                return
+            # Time device spent on this command, excluding time spent
+            # waiting for previous ones.
+            if last_completion is not None and last_completion > submit_time:
+                submit_time = last_completion
+            last_completion = now
+            self._recordLatency(now - submit_time)
+            if tracer is not None:
+                command = write_transfer.getBuffer()
+                tracer.record(
+                    command,
+                    len(command) + read_transfer.getActualLength(),
+                    submit_time,
+                    now - submit_time,
+                )
+            if error_list:
+                return
+            if index != next_index:
+                # An earlier command is still pending: giving this response
+                # would leave a hole in what onResponse received.
+                error_list.append(CardReaderError(
+                  'Response %i received while expecting %i' % (
+                    index, next_index)))
+                return
+            next_index += 1
+            try:
+                onResponse(index, *_splitLongResponse(
+                  read_buffer[:read_transfer.getActualLength()]
+                ))
+            except Exception as exc:
+                error_list.append(exc)
+            else:
+                if not error_list:
+                    submitRead(write_transfer, read_transfer, read_buffer)
+
+        usb_device = self._usb_device
+        transfer_list = [
+            usb_device.getTransfer()
+            for _ in range(2 * min(self._pipeline_depth, len(command_list)))
+        ]
+        try:
+            for index in range(0, len(transfer_list), 2):
+                submitRead(
+                    transfer_list[index],
+                    transfer_list[index + 1],
+                    memoryview(bytearray(buffer_length)),
+                )
+            usb_context = self._usb_context
+            try:
+                handleEvents = partial(
+                    usb_context.handleEventsTimeout,
+                    HANDLE_EVENTS_TIMEOUT,
+                )
+            except AttributeError:
+                # Emulated and replayed devices: events only come from here.
+                handleEvents = usb_context.handleEvents
+            cancelled = False
+            while submitted_set:
+                if error_list and not cancelled:
+                    # No point in waiting for responses to commands already
+                    # sent, but all transfers must be done before returning.
+                    cancelled = True
+                    for transfer in list(submitted_set):
+                        try:
+                            transfer.cancel()
+                        except Exception:
+                            pass
+                if not completed:
+                    handleEvents()
+                while completed:
+                    callback, transfer, completion_time = completed.popleft()
+                    callback(transfer, completion_time)
+        finally:
+            for transfer in transfer_list:
+                if not transfer.isSubmitted():
+                    transfer.close()
+        if error_list:
+            raise error_list[0]
 
     # Identified commands
     def getCardType(self):
@@ -93,10 +523,46 @@ class PlayStationMemoryCardReader(object):
            1: PS1 card
            2: PS2 card
         """
+        return self._retry(self._getCardTypeOnce)
+
+    def _getCardTypeOnce(self):
         self._commandWrite(b'\x40')
         response = self._responseRead()
-        assert len(response) == 1, hexdump(response)
-        return response[0]
+        if len(response) != 1:
+            raise CardReaderError('Unexpected response length: %s' % (
+              hexdump(response), ))
+        card_type = response[0]
+        if card_type != self._card_type:
+            self._card_type = card_type
+            self._card_generation += 1
+            self._authenticated = False
+            self._block_digest_dict = {}
+        self._card_type_expiration = monotonic() + \
+          self._card_type_poll_interval
+        return card_type
+
+    def getCachedCardType(self):
+        """
+          Same as getCardType, but only query device if cached value was
+          invalidated or is too old.
+        """
+        expiration = self._card_type_expiration
+        if expiration is None or expiration <= monotonic():
+            return self.getCardType()
+        return self._card_type
+
+    def invalidateCardType(self):
+        """
+          Forget cached card type, so device gets queried on next access.
+        """
+        self._card_type_expiration = None
+
+    def getCardIdentity(self):
+        """
+          Return a value identifying inserted card, which changes whenever a
+          card change was detected.
+        """
+        return (self.getCachedCardType(), self._card_generation)
 
     def isAuthenticated(self):
         """
@@ -104,15 +570,17 @@ class PlayStationMemoryCardReader(object):
             False: Card reader is in limited mode (PS1 cards only).
             True: Card reader allows full access (PS1 & PS2 card access).
         """
+        return self._retry(self._isAuthenticatedOnce)
+
+    def _isAuthenticatedOnce(self):
         self._longCommandWrite(_padCommand(b'\x81\x11'))
         response_code, data = self._longResponseRead()
         if response_code == b'\xaf':
             result = False
         else:
-            assert response_code == RESPONSE_STATUS_SUCCES, hexdump(
-              response_code)
+            _expect(response_code, RESPONSE_STATUS_SUCCES)
             response = _stripResponse(data)
-            assert response == b'\x2b\x55', hexdump(response)
+            _expect(response, b'\x2b\x55')
             result = True
         return result
 
@@ -121,13 +589,60 @@ class PlayStationMemoryCardReader(object):
         """
           Read a frame from PS1 card.
         """
+        self._usbWrite(self._getReadFrameCommand(frame_number))
+        return bytes(self._checkFrame(*self._longResponseRead()))
+
+    def readFrames(self, frame_number, count):
+        """
+          Read <count> consecutive frames from PS1 card, starting at
+          <frame_number>.
+          Return a list of frames.
+        """
+        result = [None] * count
+        def onFrame(index, data):
+            result[index] = bytes(data)
+        self._readFrames(frame_number, count, onFrame)
+        return result
+
+    def _readFrames(self, frame_number, count, onFrame):
+        """
+          Read <count> consecutive frames from PS1 card, starting at
+          <frame_number>, and give them in order to onFrame(index, data).
+          data is only valid until onFrame returns.
+        """
+        self._readBlockList(
+            [self._getReadFrameCommand(x)
+              for x in range(frame_number, frame_number + count)],
+            PS1_READ_RESPONSE_LENGTH,
+            self._checkFrame,
+            onFrame,
+        )
+
+    def _readBlockList(self, command_list, response_length, check, onBlock):
+        if self._usb_context is None or len(command_list) < 2:
+            for index, command in enumerate(command_list):
+                self._usbWrite(command)
+                onBlock(index, check(*self._longResponseRead()))
+        else:
+            self._pipelinedRead(
+                command_list,
+                response_length,
+                lambda index, response_code, data: onBlock(
+                    index,
+                    check(response_code, data),
+                ),
+            )
+
+    @staticmethod
+    def _getReadFrameCommand(frame_number):
         # TODO:
         # - check frame number
-        encoded_frame_number = pack('>H', frame_number)
-        self._longCommandWrite(b'\x81\x52\x00\x00' + \
-          encoded_frame_number + PS1_COMMAND_TAIL)
-        response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        return _longCommand(b'\x81\x52\x00\x00' + pack('>H', frame_number) + \
+          PS1_COMMAND_TAIL)
+
+    @staticmethod
+    def _checkFrame(response_code, data):
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         #data_header = data[:0xa]
         #assert data_header == b'\xff\x00\x5a\x5d\x00\x00\x5c\x5d' + \
         #  encoded_frame_number, hexdump(data_header)
@@ -135,7 +650,9 @@ class PlayStationMemoryCardReader(object):
         #   encoded_frame_number
         #data_tail = data[-2:] # Unknown content (checksum ?)
         data = data[0xa:-2]
-        assert len(data) == FRAME_LENGTH, '%i: %s' % (len(data), hexdump(data))
+        if len(data) != FRAME_LENGTH:
+            raise CardReaderError('Unexpected frame length %i: %s' % (
+              len(data), hexdump(data)))
         return data
 
     def writeFrame(self, frame_number, data):
@@ -146,7 +663,7 @@ class PlayStationMemoryCardReader(object):
         # TODO:
         # - check frame number
         encoded_frame_number = pack('>H', frame_number)
-        self._longCommandWrite(''.join((
+        self._longCommandWrite(b''.join((
           b'\x81\x57\x5a\x5d',
           encoded_frame_number,
           data,
@@ -155,13 +672,11 @@ class PlayStationMemoryCardReader(object):
           b'\x5c\x5d\x47',
         )))
         response_code, response_data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
-        assert response_data[:4] == b'\xff\x00\x5a\x5d',  hexdump(response_data[:4])
-        assert response_data[4] == 0x00, hexdump(response_data[4:5])
-        assert response_data[5:7] == encoded_frame_number, \
-          hexdump(response_data[5:6])
-        assert response_data[7:-3] == data, (hexdump(response_data[7:-3]), \
-          hexdump(data))
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
+        _expect(response_data[:4], b'\xff\x00\x5a\x5d')
+        _expect(response_data[4:5], b'\x00')
+        _expect(response_data[5:7], encoded_frame_number)
+        _expect(response_data[7:-3], data)
         # XXX: the last byte of response changes from refernce dumps.
         # This is probably because of the incorrect checksum.
         #assert response_data[-3:] == '\x5c\x5d\x47', hexdump(
@@ -172,13 +687,50 @@ class PlayStationMemoryCardReader(object):
         """
           Read a page from PS2 card.
         """
+        self._authenticateOnce()
+        self._usbWrite(self._getReadPageCommand(page_number))
+        return bytes(self._checkPage(*self._longResponseRead()))
+
+    def readPages(self, page_number, count):
+        """
+          Read <count> consecutive pages from PS2 card, starting at
+          <page_number>.
+          Return a list of pages.
+        """
+        result = [None] * count
+        def onPage(index, data):
+            result[index] = bytes(data)
+        self._readPages(page_number, count, onPage)
+        return result
+
+    def _readPages(self, page_number, count, onPage):
+        """
+          Read <count> consecutive pages from PS2 card, starting at
+          <page_number>, and give them in order to onPage(index, data).
+          data is only valid until onPage returns.
+        """
+        self._authenticateOnce()
+        self._readBlockList(
+            [self._getReadPageCommand(x)
+              for x in range(page_number, page_number + count)],
+            PS2_READ_RESPONSE_LENGTH,
+            self._checkPage,
+            onPage,
+        )
+
+    @staticmethod
+    def _getReadPageCommand(page_number):
         # TODO:
         # - check page number
-        self.authenticate()
-        self._commandWrite(b'\x52\x03' + pack('<I', page_number) + b'\x55\x2b')
-        response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
-        assert len(data) == PAGE_LENGTH, '%i: %s' % (len(data), hexdump(data))
+        return _command(b'\x52\x03' + pack('<I', page_number) + b'\x55\x2b')
+
+    def _checkPage(self, response_code, data):
+        if response_code != RESPONSE_STATUS_SUCCES:
+            self._authenticated = False
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
+        if len(data) != PAGE_LENGTH:
+            raise CardReaderError('Unexpected page length %i: %s' % (
+              len(data), hexdump(data)))
         return data
 
     def writePage(self, page_number, data):
@@ -188,16 +740,17 @@ class PlayStationMemoryCardReader(object):
         assert len(data) == PAGE_LENGTH
         # TODO:
         # - check page number
-        self.authenticate()
-        self._commandWrite(''.join((
+        self._authenticateOnce()
+        self._commandWrite(b''.join((
           b'\x57\x03',
           pack('<I', page_number),
           data,
           b'\x55\x2b'
         )))
         response = self._responseRead()
-        assert len(response) == 1, hexdump(response)
-        assert response == RESPONSE_STATUS_SUCCES, hexdump(response)
+        if response != RESPONSE_STATUS_SUCCES:
+            self._authenticated = False
+        _expect(response, RESPONSE_STATUS_SUCCES)
 
     def getRandomNumber(self, seq_number=4):
         """
@@ -233,7 +786,7 @@ class PlayStationMemoryCardReader(object):
         result = response_code == RESPONSE_STATUS_SUCCES
         if result:
             response = _stripResponse(data)
-            assert response == b'\x2b\xff', hexdump(response)
+            _expect(response, b'\x2b\xff')
         return result
 
     def __recv_81f0(self, seq_number, length):
@@ -241,144 +794,254 @@ class PlayStationMemoryCardReader(object):
         self._longCommandWrite(_padCommand(b'\x81\xf0' + pack('b', seq_number),
           padding=padding))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data, padding)
-        assert response[0] == 0x2b and response[-1] == 0xff, hexdump(
-          response)
-        return response[1:-1]
+        if response[0] != 0x2b or response[-1] != 0xff:
+            raise CardReaderError('Unexpected response: %s' % (
+              hexdump(response), ))
+        return bytes(response[1:-1])
 
     def __send_81f0(self, seq_number, data):
         assert len(data) == 9, hexdump(data)
         self._longCommandWrite(_padCommand(b'\x81\xf0' + pack('b',
           seq_number) + data))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data)
-        assert response == b'\x2b\xff', hexdump(response)
+        _expect(response, b'\x2b\xff')
 
     def __8128(self):
         self._longCommandWrite(_padCommand(b'\x81\x28', padding=3))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data, padding=3)
-        assert response == b'\x2b\xff\xff', hexdump(response)
+        _expect(response, b'\x2b\xff\xff')
 
     def __8127(self):
         self._longCommandWrite(_padCommand(b'\x81\x27\x55'))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data)
-        assert response == b'\x2b\x55', hexdump(response)
+        _expect(response, b'\x2b\x55')
 
     def __8126(self):
         self._longCommandWrite(_padCommand(b'\x81\x26', padding=11))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data, padding=11)
-        assert response[0] == 0x2b and response[-1] == 0x55, hexdump(
-          response)
-        return response[1:-1]
+        if response[0] != 0x2b or response[-1] != 0x55:
+            raise CardReaderError('Unexpected response: %s' % (
+              hexdump(response), ))
+        return bytes(response[1:-1])
 
     def __8158(self):
         self._longCommandWrite(b'\x81\x58\x00\x00\x00')
         response_code, data = self._longResponseRead()
-        assert response_code == b'\xaf', hexdump(response_code)
+        _expect(response_code, b'\xaf')
 
     def __81f3(self):
         self._longCommandWrite(_padCommand(b'\x81\xf3\x00'))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data)
-        assert response == b'\x2b\xff', hexdump(response)
+        _expect(response, b'\x2b\xff')
 
     def __81f7(self):
         self._longCommandWrite(_padCommand(b'\x81\xf7\x01'))
         response_code, data = self._longResponseRead()
-        assert response_code == RESPONSE_STATUS_SUCCES, hexdump(response_code)
+        _expect(response_code, RESPONSE_STATUS_SUCCES)
         response = _stripResponse(data)
-        assert response == b'\x2b\xff', hexdump(response)
+        _expect(response, b'\x2b\xff')
 
     # IO helpers
-    def read(self, offset, length):
+    def _getCardType(self):
+        card_type = self.getCachedCardType()
+        if card_type not in CARD_PAGE_DICT:
+            if not card_type:
+                raise NoCardError('No card')
+            raise CardReaderError('Unknown card (%02x)' % (card_type, ))
+        return card_type
+
+    def readBlocks(self, block_number, count):
+        """
+          Read <count> consecutive frames or pages, depending on card type,
+          starting at <block_number>.
         """
-          Read data starting at <offset> bytes for <length> bytes.
+        result = [None] * count
+        def onBlock(index, data):
+            result[index] = bytes(data)
+        self._readBlocks(block_number, count, onBlock)
+        return result
 
-          offset & length can be of arbitrary values, as long as they fit in
-          memory card space.
+    def streamBlocks(self, block_number, count, onBlock):
         """
-        card_type = self.getCardType()
-        if card_type == 1:
-            read = self.readFrame
-        elif card_type == 2:
-            read = self.readPage
-        else:
-            raise ValueError('No/unknown card (%02x)' % (card_type, ))
-        block_length = self._getPageSize(card_type)
-        max_length = self._getSize(card_type)
-        if offset + length > max_length:
-            raise ValueError('Trying to read out of card.')
-        result = []
-        append = result.append
-        current_block, start_offset = divmod(offset, block_length)
-        result_len = -start_offset
-        while result_len < length:
-            data = read(current_block)
-            assert len(data) == block_length, len(data)
-            result_len += block_length
-            append(data)
-            current_block += 1
-        result[0] = result[0][start_offset:]
-        if result_len > length:
-            result[-1] = result[-1][:length - result_len]
-        return b''.join(result)
-
-    def write(self, offset, data):
-        """
-          Write <data> starting at <offset>.
-
-          offset & data length can be of arbitrary values, as long as they fit in
-          memory card space. This function will take care reading existing block
-          data if write does not start and/or stop on an underlying block boundary.
-        """
-        card_type = self.getCardType()
-        if card_type == 1:
-            read = self.readFrame
-            write = self.writeFrame
-        elif card_type == 2:
-            read = self.readPage
-            write = self.writePage
-        else:
-            raise ValueError('No/unknown card (%02x)' % (card_type, ))
-        block_length = self._getPageSize(card_type)
-        max_length = self._getSize(card_type)
-        if offset + len(data) > max_length:
-            raise ValueError('Trying to write out of card.')
-        current_block, start_offset = divmod(offset, block_length)
-        if start_offset:
-            data = read(current_block)[:start_offset] + data
-        while len(data) >= block_length:
-            to_write, data = data[:block_length], data[block_length:]
-            write(current_block, to_write)
-            current_block += 1
-        data_len = len(data)
-        if data_len:
-            write(current_block, data + read(current_block)[data_len:])
+          Call onBlock for each block as soon as it is received.
+          See BlockDevice.streamBlocks . <data> is only valid during onBlock
+          call.
+        """
+        self._readBlocks(block_number, count, onBlock)
+
+    def readBlocksInto(self, block_number, count, buf, skip=0):
+        """
+          Read blocks directly into <buf>.
+          See BlockDevice.readBlocksInto .
+        """
+        self._readBlocks(
+            block_number,
+            count,
+            partial(_copyBlock, memoryview(buf), skip, self.getPageSize()),
+        )
+
+    def _readBlocks(self, block_number, count, onBlock):
+        # Number of blocks already given to onBlock, so a retry resumes
+        # after them.
+        done = 0
+        # Value of done when current attempt started.
+        first = 0
+        def onBlockWrapper(index, data):
+            nonlocal done
+            index += first
+            # Note: card type check may have replaced the digest dict.
+            self._block_digest_dict[block_number + index] = _digest(data)
+            onBlock(index, data)
+            done = index + 1
+        # Card generation blocks given to onBlock so far came from.
+        card_generation = None
+        def readRemaining():
+            nonlocal first, card_generation
+            if self._getCardType() == PS1_CARD_TYPE:
+                read = self._readFrames
+            else:
+                read = self._readPages
+            if done and self._card_generation != card_generation:
+                # Blocks already given to onBlock came from another card.
+                raise NoCardError('Card changed during read')
+            card_generation = self._card_generation
+            first = done
+            read(block_number + first, count - first, onBlockWrapper)
+        try:
+            self._retry(readRemaining, getProgress=lambda: done)
+        except Exception:
+            self.invalidateCardType()
+            self.invalidateAuthentication()
+            raise
+
+    def writeBlock(self, block_number, data):
+        """
+          Write a frame or a page, depending on card type.
+          Writing is skipped if block is known to already contain <data>.
+        """
+        digest = _digest(data)
+        try:
+            # Note: checks for card change, which forgets known blocks.
+            card_type = self._getCardType()
+            block_digest_dict = self._block_digest_dict
+            if block_digest_dict.get(block_number) == digest:
+                self._skipped_write_count += 1
+                return
+            # Block content is unknown until write succeeds.
+            block_digest_dict.pop(block_number, None)
+            if card_type == PS1_CARD_TYPE:
+                self.writeFrame(block_number, data)
+            else:
+                self.writePage(block_number, data)
+        except Exception:
+            self.invalidateCardType()
+            self.invalidateAuthentication()
+            raise
+        block_digest_dict[block_number] = digest
+
+    def getBlockDigests(self):
+        """
+          Return a dict of digests of known block content, by block number,
+          for current card.
+        """
+        self._getCardType()
+        return self._block_digest_dict.copy()
+
+    def setBlockDigests(self, digest_dict):
+        """
+          Declare current card content as known, from a dict of block digests
+          (as returned by getBlockDigests) by block number.
+          Writes of identical data to these blocks will be skipped, so
+          caller is responsible for <digest_dict> being accurate.
+        """
+        # Note: checks for card change, which forgets known blocks.
+        self._getCardType()
+        self._block_digest_dict.update(digest_dict)
+
+    def getSkippedWriteCount(self):
+        """
+          Return the number of block writes skipped because block already
+          contained the data to write.
+        """
+        return self._skipped_write_count
 
     @staticmethod
     def _getSize(card_type):
         return CARD_SIZE_DICT.get(card_type)
 
     def getSize(self):
-        return self._getSize(self.getCardType())
+        return self._getSize(self._getCardType())
 
     @staticmethod
     def _getPageSize(card_type):
         return CARD_PAGE_DICT.get(card_type)
 
     def getPageSize(self):
-        return self._getPageSize(self.getCardType())
+        return self._getPageSize(self._getCardType())
 
     # Authentication
+    def _authenticateOnce(self):
+        """
+          Authenticate, unless already done since last card change or error.
+        """
+        if not self._authenticated:
+            self.authenticate()
+
+    def preAuthenticate(self):
+        """
+          Authenticate now if a PS2 card is inserted, so the first access to
+          it does not have to wait for authentication.
+          Return whether the card needed authentication.
+        """
+        if self._getCardType() != PS2_CARD_TYPE or self._authenticated:
+            return False
+        self.authenticate()
+        return True
+
+    def getSeedStatistics(self):
+        """
+          Return a dict of counters about seeds drawn by device during
+          authentication:
+            draw: number of seeds drawn
+            hit, miss: how many had a cached answer, or not (only when
+              authenticator implements isCached)
+            reroll: number of times authentication restarted on a miss
+            distinct: number of distinct seeds
+            top: list of (seed as hex, count) for the most frequent seeds
+        """
+        seed_counter = self._seed_counter
+        return {
+            'draw': sum(seed_counter.values()),
+            'hit': self._seed_hit_count,
+            'miss': self._seed_miss_count,
+            'reroll': self._reroll_total,
+            'distinct': len(seed_counter),
+            'top': [
+                (hexdump(seed), count)
+                for seed, count in seed_counter.most_common(4)
+            ],
+        }
+
+    def invalidateAuthentication(self):
+        """
+          Forget about current authentication state, so it gets checked on
+          next PS2 card access.
+          To be called when device state becomes unknown (ex: replug).
+        """
+        self._authenticated = False
+
     def authenticate(self):
         """
           Authentication scenario.
@@ -406,7 +1069,12 @@ class PlayStationMemoryCardReader(object):
             auth success.
           - Sadly, the PRNG is seeded upon replugging, so it's not possible to
             go off with a 2-entry rainbow table.
+          So when authenticator has no cached answer for a seed, the sequence
+          is restarted to draw another one, up to reroll_count times.
         """
+        isCached = getattr(self._authenticator, 'isCached', None)
+        reroll_count = self._reroll_count if isCached is not None else 0
+        failure_count = 0
         while not self.isAuthenticated():
             # ?
             self.__81f3()
@@ -419,7 +1087,27 @@ class PlayStationMemoryCardReader(object):
             self.__81f0(3)
             # Random value
             seed = self.getRandomNumber()
-            answer_list = self._authenticator.authenticate(seed)
+            self._seed_counter[seed] += 1
+            if isCached is not None:
+                if isCached(seed):
+                    self._seed_hit_count += 1
+                else:
+                    self._seed_miss_count += 1
+                    if reroll_count:
+                        reroll_count -= 1
+                        self._reroll_total += 1
+                        continue
+            try:
+                answer_list = self._authenticator.authenticate(seed)
+            except AuthenticationError as exc:
+                # A late answer still gets cached by authenticator, so this
+                # seed may succeed when drawn again.
+                failure_count += 1
+                if failure_count > self._retry_count:
+                    raise
+                print('%s, retrying...' % (exc, ))
+                continue
+            failure_count = 0
             # ?
             if not self.__81f0(5):
                 print('Auth timeout, retrying...')
@@ -451,5 +1139,6 @@ class PlayStationMemoryCardReader(object):
             self.__8126()
             # Now, we must be authenticated
             if not self.isAuthenticated():
-                raise ValueError('Authentication went to the end, but we ' \
-                  'are not authenticated !')
+                raise CardReaderError('Authentication went to the end, but '
+                  'we are not authenticated !')
+        self._authenticated = True
@@ -1,6 +1,8 @@
+from collections import deque
 import errno
 import socket
 import struct
+import sys
 from traceback import print_exc
 
 NBD_GREETING_SUFFIX     = b'\0' * 124
@@ -29,7 +31,7 @@ NBD_REP_SERVER              = 2
 NBD_REP_INFO                = 3
 NBD_REP_META_CONTEXT        = 4
 NBD_REP_ERR_UNSUP           = 2**31 + 1
-NBD_REP_ERR_POLICY          = 2++31 + 2
+NBD_REP_ERR_POLICY          = 2**31 + 2
 NBD_REP_ERR_INVALID         = 2**31 + 3
 NBD_REP_ERR_PLATFORM        = 2**31 + 4
 NBD_REP_ERR_TLS_REQD        = 2**31 + 5
@@ -63,6 +65,13 @@ NBD_CMD_FLAG_UNKNOWN_MASK = (2**16 - 1) ^ (
 
 NBD_REPLY_FLAG_DONE     = 1 << 0
 
+NBD_REPLY_TYPE_NONE         = 0
+NBD_REPLY_TYPE_OFFSET_DATA  = 1
+NBD_REPLY_TYPE_OFFSET_HOLE  = 2
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR        = 2**15 + 1
+NBD_REPLY_TYPE_ERROR_OFFSET = 2**15 + 2
+
 NBD_EPERM       = 1
 NBD_EIO         = 5
 NBD_ENOMEM      = 12
@@ -73,8 +82,13 @@ NBD_ENOTSUP     = 95
 NBD_ESHUTDOWN   = 108
 
 NBD_RESPONSE_FORMAT = '>4sI8s'
+NBD_RESPONSE_LEN    = struct.calcsize(NBD_RESPONSE_FORMAT)
 NBD_RESPONSE_MAGIC  = b'\x67\x44\x66\x98'
 
+NBD_STRUCTURED_REPLY_FORMAT = '>4sHH8sI'
+NBD_STRUCTURED_REPLY_LEN    = struct.calcsize(NBD_STRUCTURED_REPLY_FORMAT)
+NBD_STRUCTURED_REPLY_MAGIC  = b'\x66\x8e\x33\xef'
+
 NBD_FLAG_HAS_FLAGS          = 1 << 0
 NBD_FLAG_READ_ONLY          = 1 << 1
 NBD_FLAG_SEND_FLUSH         = 1 << 2
@@ -110,6 +124,9 @@ NBD_INFO_BLOCK_SIZE     = 3
 
 MAX_OPT_SIZE    = 2**10 # way over any standard OPT request's payload length
 MAX_BLOCK_SIZE  = 2**25 # 32M, value recommended in spec
+# Streamed reads send data as soon as this much is available.
+STREAM_CHUNK_SIZE = 2**12
+MAX_ERROR_MESSAGE_SIZE = 2**12
 
 COMMAND_ALLOWED_FLAG_DICT = {
     NBD_CMD_READ:           NBD_CMD_FLAG_FUA | NBD_CMD_FLAG_DF,
@@ -123,6 +140,17 @@ COMMAND_ALLOWED_FLAG_DICT = {
     NBD_CMD_RESIZE:         NBD_CMD_FLAG_FUA,
 }
 
+def _printDeviceError():
+    """
+      Report device exception being handled. Environment errors (ex: no card,
+      unplugged device) are expected, and only get a one-line message.
+    """
+    exc = sys.exc_info()[1]
+    if isinstance(exc, EnvironmentError):
+        print('Device error: %s: %s' % (exc.__class__.__name__, exc))
+    else:
+        print_exc()
+
 class NBDServer(object):
     """
       Python implementation of NBD protocol.
@@ -130,7 +158,7 @@ class NBDServer(object):
       Socket handling & event loop must be done outside of this class.
     """
 
-    def __init__(self, sock, device, read_only=False):
+    def __init__(self, sock, device=None, read_only=False, export_dict=None):
         """
           sock (socket)
             Network socket, with an established connection with a client.
@@ -138,33 +166,82 @@ class NBDServer(object):
             Instance implementing the following methods:
               getSize() -> int
                 Size of the underlying storage.
+              getPageSize() -> int
+                Preferred request alignment.
               write(offset, data)
                 Write <data> starting at <offset>.
               read(offset, length) -> string
                 Read <length> bytes starting at <offset>.
+              readinto(offset, buffer) (optional)
+                Read len(buffer) bytes starting at <offset> into <buffer>.
+                When available, it is used instead of read, to receive data
+                directly in the reply buffer.
+              readChunks(offset, length, onChunk) (optional)
+                Read <length> bytes starting at <offset>, calling
+                onChunk(chunk_offset, data) with consecutive parts as soon as
+                they are available. When available and client accepts
+                structured replies, read data is sent as it arrives.
+              flush() (optional)
+                Make previous writes persistent. When available, clients are
+                told they may send flush and FUA requests, and it is called
+                before disconnecting.
+            Exported with an empty name.
           read_only (bool)
             Whether the device should be advertised as allowing writes.
             This is enforced within this class, so that a client ignoring this
             information will be refused to write anyway.
+          export_dict (dict)
+            Export name (bytes) to device, to let client choose among several
+            devices. Replaces <device>.
         """
         self._sock = sock
-        self._device = device
+        if export_dict is None:
+            export_dict = {b'': device}
+        self._export_dict = export_dict
+        self._export_name = None
+        self._device = None
         self._read_only = read_only
-        self._buffer = buffer = bytearray(MAX_BLOCK_SIZE)
-        self._buffer_view = memoryview(buffer)
-        self._buffer_len = 0
-        self._buffer_target = None
+        # Request being received: its header, then its data for writes.
+        self._header_view = memoryview(bytearray(NBD_REQUEST_LEN))
+        self._request = None
+        self._payload_view = None
+        self._received = 0
+        # Reply data not sent yet.
+        self._output_list = deque()
+        self._flush = None
+        self._readinto = None
+        self._readChunks = None
+        self._structured_reply = False
+
+    def _selectExport(self, name):
+        device = self._export_dict[name]
+        self._export_name = name
+        self._device = device
+        self._flush = getattr(device, 'flush', None)
+        self._readinto = getattr(device, 'readinto', None)
+        self._readChunks = getattr(device, 'readChunks', None)
+
+    def getExportName(self):
+        """
+          Return the name of the export chosen by client during greet.
+        """
+        return self._export_name
 
     def fileno(self):
         return self._sock.fileno()
 
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
     def close(self):
         try:
             self._sock.shutdown(socket.SHUT_RDWR)
-            self._sock.close()
         except OSError as exc:
-            if exc.errno != errno.ENOTCONN:
+            # Already disconnected or closed.
+            if exc.errno not in (errno.ENOTCONN, errno.EBADF):
                 raise
+        finally:
+            self._sock.close()
 
     def _recvall(self, length):
         result = b''
@@ -211,11 +288,14 @@ class NBDServer(object):
             while True:
                 option, value = self._recvOption()
                 if option == NBD_OPT_EXPORT_NAME:
-                    if value is None or value:
+                    if value not in self._export_dict:
                         # NBD_OPT_EXPORT_NAME does not expect a response, so
                         # just close the connection if the name is too long
+                        # or unknown
                         self.close()
                         return False
+                    self._selectExport(value)
+                    # XXX: device size & transmission flags are not sent
                     break
                 elif value is None: # length exceeded
                     self._sendOption(
@@ -236,11 +316,24 @@ class NBDServer(object):
                             status=NBD_REP_ERR_INVALID,
                         )
                         continue
+                    for name in sorted(self._export_dict):
+                        self._sendOption(
+                            option=option,
+                            status=NBD_REP_SERVER,
+                            value=struct.pack('>I', len(name)) + name,
+                        )
                     self._sendOption(
                         option=option,
-                        status=NBD_REP_SERVER,
-                        value=struct.pack('>I', 0), # empty name
+                        status=NBD_REP_ACK,
                     )
+                elif option == NBD_OPT_STRUCTURED_REPLY:
+                    if value:
+                        self._sendOption(
+                            option=option,
+                            status=NBD_REP_ERR_INVALID,
+                        )
+                        continue
+                    self._structured_reply = True
                     self._sendOption(
                         option=option,
                         status=NBD_REP_ACK,
@@ -267,23 +360,40 @@ class NBDServer(object):
                             status=NBD_REP_ERR_INVALID,
                         )
                         continue
-                    if name:
-                        print(repr(name))
+                    try:
+                        device = self._export_dict[name]
+                        size = device.getSize()
+                        page_size = device.getPageSize()
+                    except KeyError:
                         self._sendOption(
                             option=option,
-                            status=NBD_REP_ERR_INVALID,
+                            status=NBD_REP_ERR_UNKNOWN,
+                        )
+                        continue
+                    except Exception:
+                        # Export exists but is not usable currently (ex: no
+                        # card).
+                        _printDeviceError()
+                        self._sendOption(
+                            option=option,
+                            status=NBD_REP_ERR_UNKNOWN,
                         )
                         continue
                     transmission_flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_CAN_MULTI_CONN
                     if self._read_only:
                         transmission_flags |= NBD_FLAG_READ_ONLY
+                    if getattr(device, 'flush', None) is not None:
+                        transmission_flags |= NBD_FLAG_SEND_FLUSH | \
+                            NBD_FLAG_SEND_FUA
+                    if self._structured_reply:
+                        transmission_flags |= NBD_FLAG_SEND_DF
                     self._sendOption(
                         option=option,
                         status=NBD_REP_INFO,
                         value=struct.pack(
                             '>HQH',
                             NBD_INFO_EXPORT,
-                            self._device.getSize(),
+                            size,
                             transmission_flags,
                         ),
                     )
@@ -293,8 +403,7 @@ class NBDServer(object):
                         value=struct.pack(
                             '>H',
                             NBD_INFO_NAME,
-                            # empty name
-                        ),
+                        ) + name,
                     )
                     self._sendOption(
                         option=option,
@@ -303,7 +412,7 @@ class NBDServer(object):
                             '>HIII',
                             NBD_INFO_BLOCK_SIZE,
                             1,
-                            self._device.getPageSize(),
+                            page_size,
                             MAX_BLOCK_SIZE,
                         ),
                     )
@@ -312,6 +421,7 @@ class NBDServer(object):
                         status=NBD_REP_ACK,
                     )
                     if option == NBD_OPT_GO:
+                        self._selectExport(name)
                         break
                 else:
                     self._sendOption(
@@ -321,95 +431,326 @@ class NBDServer(object):
         else:
             option, value = self._recvOption()
             assert option == NBD_OPT_EXPORT_NAME, hex(option)
-            if value:
+            if value not in self._export_dict:
                 self.close()
                 return False
+            self._selectExport(value)
         if handshake_flags & NBD_FLAG_C_NO_ZEROES == 0:
             self._sock.sendall(NBD_GREETING_SUFFIX)
         return True
 
-    def _simpleReply(self, handle, error=0, data=b''):
-        self._sock.sendall(struct.pack(
+    def _packReply(self, handle, error=0):
+        return struct.pack(
             NBD_RESPONSE_FORMAT,
             NBD_RESPONSE_MAGIC,
             error,
             handle,
-        ))
-        if data:
-            self._sock.sendall(data)
+        )
 
-    def handle(self):
+    def _packChunk(self, handle, reply_type, payload=b'',
+            flags=NBD_REPLY_FLAG_DONE):
+        return struct.pack(
+            NBD_STRUCTURED_REPLY_FORMAT,
+            NBD_STRUCTURED_REPLY_MAGIC,
+            flags,
+            reply_type,
+            handle,
+            len(payload),
+        ) + payload
+
+    def _packDataChunk(self, handle, offset, data, flags=NBD_REPLY_FLAG_DONE):
+        # Note: cards have no notion of allocation, so holes are never sent,
+        # even for zeroes.
+        return self._packChunk(
+            handle,
+            NBD_REPLY_TYPE_OFFSET_DATA,
+            struct.pack('>Q', offset) + data,
+            flags,
+        )
+
+    def _packErrorChunk(self, handle, error, exc=None, offset=None):
+        if exc is None:
+            message = b''
+        else:
+            message = ('%s: %s' % (exc.__class__.__name__, exc)).encode(
+                'utf-8',
+                'replace',
+            )[:MAX_ERROR_MESSAGE_SIZE].decode('utf-8', 'ignore').encode(
+                'utf-8',
+            )
+        payload = struct.pack('>IH', error, len(message)) + message
+        if offset is None:
+            reply_type = NBD_REPLY_TYPE_ERROR
+        else:
+            reply_type = NBD_REPLY_TYPE_ERROR_OFFSET
+            payload += struct.pack('>Q', offset)
+        return self._packChunk(handle, reply_type, payload)
+
+    def _structuredRead(self, handle, offset, length, dont_fragment, onData):
+        """
+          Read for a client accepting structured replies.
+          Return the last reply chunks. If <onData> is given, earlier chunks
+          are given to it as soon as their data is available.
+        """
+        if not length:
+            return self._packChunk(handle, NBD_REPLY_TYPE_NONE)
+        readChunks = self._readChunks
+        if dont_fragment or onData is None or readChunks is None:
+            if self._readinto is None:
+                try:
+                    data = self._device.read(offset, length)
+                except Exception as exc:
+                    _printDeviceError()
+                    return self._packErrorChunk(handle, NBD_EIO, exc)
+                if len(data) == length:
+                    return self._packDataChunk(handle, offset, data)
+                # Send what could be read.
+                return self._packDataChunk(handle, offset, data,
+                  flags=0) + self._packErrorChunk(
+                    handle,
+                    NBD_EIO,
+                    ValueError('Short read: %i bytes, expected %i' % (
+                      len(data), length)),
+                    offset + len(data),
+                  )
+            # Read straight after the chunk header, to send both at once.
+            header_length = NBD_STRUCTURED_REPLY_LEN + 8
+            reply = bytearray(header_length + length)
+            try:
+                self._readinto(offset, memoryview(reply)[header_length:])
+            except Exception as exc:
+                _printDeviceError()
+                return self._packErrorChunk(handle, NBD_EIO, exc)
+            struct.pack_into(
+                NBD_STRUCTURED_REPLY_FORMAT + 'Q',
+                reply,
+                0,
+                NBD_STRUCTURED_REPLY_MAGIC,
+                NBD_REPLY_FLAG_DONE,
+                NBD_REPLY_TYPE_OFFSET_DATA,
+                handle,
+                8 + length,
+                offset,
+            )
+            return reply
+        end = offset + length
+        # Data received and not sent yet, and where it starts.
+        pending_list = []
+        pending_offset = offset
+        next_offset = offset
+        def onChunk(chunk_offset, data):
+            nonlocal pending_offset, next_offset
+            pending_list.append(bytes(data))
+            next_offset = chunk_offset + len(data)
+            # Last data is kept for the last chunk, so it can be flagged as
+            # such.
+            if next_offset - pending_offset >= STREAM_CHUNK_SIZE and \
+                    next_offset < end:
+                onData(self._packDataChunk(
+                    handle,
+                    pending_offset,
+                    b''.join(pending_list),
+                    flags=0,
+                ))
+                del pending_list[:]
+                pending_offset = next_offset
+        try:
+            readChunks(offset, length, onChunk)
+        except Exception as exc:
+            _printDeviceError()
+            error_chunk = self._packErrorChunk(handle, NBD_EIO, exc,
+              next_offset)
+            if pending_list:
+                return self._packDataChunk(
+                    handle,
+                    pending_offset,
+                    b''.join(pending_list),
+                    flags=0,
+                ) + error_chunk
+            return error_chunk
+        return self._packDataChunk(
+            handle,
+            pending_offset,
+            b''.join(pending_list),
+        )
+
+    def receive(self):
         """
           To be called upon incomming data on socket.
-          Blocks until an entire command has been received, and response had been
-          sent back.
+          Receives available request data, without blocking if socket is
+          non-blocking.
 
           Return values:
-            True: operation can continue on socket
-            False: error, the socket is now closed
+            list of complete requests (possibly empty), to be given to execute
+            None: error, the socket is now closed
         """
-        received = self._buffer_len
-        print('reading', NBD_REQUEST_LEN - received)
-        received += self._sock.recv_into(
-            self._buffer_view[received:],
-            NBD_REQUEST_LEN - received,
-        )
-        print('... got', received)
-        if received < NBD_REQUEST_LEN:
-            self._buffer_len = received
-            return True
+        request = self._request
+        if request is None:
+            view = self._header_view
         else:
-            assert received == NBD_REQUEST_LEN, received
-            self._buffer_len = 0
-        (magic, flags, command, handle, offset, length) = struct.unpack(
-          NBD_REQUEST_FORMAT,
-          self._buffer_view[:NBD_REQUEST_LEN],
-        )
-        if magic != NBD_REQUEST_MAGIC:
+            view = self._payload_view
+        received = self._received
+        try:
+            length = self._sock.recv_into(view[received:])
+        except BlockingIOError:
+            return []
+        if not length:
             self.close()
-            return False
-        data = b''
+            return None
+        received += length
+        if received < len(view):
+            self._received = received
+            return []
+        self._received = 0
+        if request is None:
+            (magic, flags, command, handle, offset, length) = struct.unpack(
+              NBD_REQUEST_FORMAT,
+              view,
+            )
+            if magic != NBD_REQUEST_MAGIC:
+                self.close()
+                return None
+            request = (flags, command, handle, offset, length, None)
+            if command == NBD_CMD_WRITE and length:
+                if length > MAX_BLOCK_SIZE:
+                    # Payload would have to be received to stay in sync.
+                    self.close()
+                    return None
+                self._request = request
+                self._payload_view = memoryview(bytearray(length))
+                return []
+            return [request]
+        data = self._payload_view
+        self._request = self._payload_view = None
+        return [request[:-1] + (data, )]
+
+    def execute(self, request, onData=None):
+        """
+          Run <request>, as returned by receive, on device.
+          Can be called from another thread than the one using the socket.
+          onData (callable, or None)
+            Called (from the same thread) with the first parts of reply data,
+            to be sent right away, when it is streamed (reads with
+            structured replies).
+
+          Return reply data, and whether operation can continue on socket. If
+          not, socket must be closed once reply data has been sent.
+        """
+        flags, command, handle, offset, length, data = request
+        error = 0
         if flags & ~COMMAND_ALLOWED_FLAG_DICT.get(command, 0):
             error = NBD_ENOTSUP
         elif command == NBD_CMD_READ:
-            if flags & NBD_CMD_FLAG_DF:
+            if flags & NBD_CMD_FLAG_DF and not self._structured_reply:
                 error = NBD_ENOTSUP
             elif length > MAX_BLOCK_SIZE:
                 error = NBD_EINVAL
+            elif self._structured_reply:
+                return self._structuredRead(
+                    handle,
+                    offset,
+                    length,
+                    flags & NBD_CMD_FLAG_DF,
+                    onData,
+                ), True
             elif length:
+                # Read straight after the reply header, to send both at once.
+                reply = bytearray(NBD_RESPONSE_LEN + length)
                 try:
-                    data = self._device.read(offset, length)
+                    if self._readinto is None:
+                        data = self._device.read(offset, length)
+                        if len(data) != length:
+                            # Simple replies cannot carry partial data.
+                            raise ValueError('Short read: %i bytes, '
+                              'expected %i' % (len(data), length))
+                        reply[NBD_RESPONSE_LEN:] = data
+                    else:
+                        self._readinto(
+                            offset,
+                            memoryview(reply)[NBD_RESPONSE_LEN:],
+                        )
                 except Exception:
-                    print_exc()
+                    _printDeviceError()
                     error = NBD_EIO
                 else:
-                    if len(data) != length:
-                        error = NBD_EIO
-                        # XXX: no structured reply support
-                        data = b''
-                    else:
-                        error = 0
+                    struct.pack_into(
+                        NBD_RESPONSE_FORMAT,
+                        reply,
+                        0,
+                        NBD_RESPONSE_MAGIC,
+                        0,
+                        handle,
+                    )
+                    return reply, True
         elif command == NBD_CMD_WRITE:
             if self._read_only:
                 error = NBD_EPERM
-            elif length > MAX_BLOCK_SIZE:
-                error = NBD_EINVAL
             elif length:
-                recv_data = self._recvall(length)
-                if len(recv_data) != length:
-                    self.close()
-                    return False
                 try:
-                    self._device.write(offset, recv_data)
+                    self._device.write(offset, data)
+                    if flags & NBD_CMD_FLAG_FUA and self._flush is not None:
+                        self._flush()
                 except Exception:
-                    print_exc()
+                    _printDeviceError()
                     error = NBD_EIO
+        elif command == NBD_CMD_FLUSH and self._flush is not None:
+            try:
+                self._flush()
+            except Exception:
+                _printDeviceError()
+                error = NBD_EIO
         elif command == NBD_CMD_DISC:
-            self.close()
-            return False
+            if self._flush is not None:
+                try:
+                    self._flush()
+                except Exception:
+                    _printDeviceError()
+            return b'', False
         else:
-            self._simpleReply(handle, error=NBD_ENOTSUP)
-            self.close()
+            return self._packReply(handle, error=NBD_ENOTSUP), False
+        if command == NBD_CMD_READ and self._structured_reply:
+            # Reads must get a structured reply, even for errors.
+            return self._packErrorChunk(handle, error), True
+        return self._packReply(handle, error=error), True
+
+    def send(self, data=b''):
+        """
+          Queue <data> for sending, and send as much pending data as socket
+          accepts without blocking (if it is non-blocking).
+          Return whether all pending data was sent.
+        """
+        output_list = self._output_list
+        if data:
+            output_list.append(memoryview(data))
+        while output_list:
+            try:
+                sent = self._sock.send(output_list[0])
+            except BlockingIOError:
+                return False
+            if sent == len(output_list[0]):
+                output_list.popleft()
+            else:
+                output_list[0] = output_list[0][sent:]
+        return True
+
+    def handle(self):
+        """
+          To be called upon incomming data on socket, when using a blocking
+          socket and executing requests in the same thread.
+          Blocks until available data has been received and, if it completed
+          a command, the response has been sent back.
+
+          Return values:
+            True: operation can continue on socket
+            False: error, the socket is now closed
+        """
+        request_list = self.receive()
+        if request_list is None:
             return False
-        self._simpleReply(handle, error=error, data=data)
+        for request in request_list:
+            reply, keep_open = self.execute(request, self.send)
+            self.send(reply)
+            if not keep_open:
+                self.close()
+                return False
         return True
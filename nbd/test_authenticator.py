@@ -0,0 +1,54 @@
+import threading
+import time
+import unittest
+from auth_daemon import FakeAuthenticationDaemon, deriveAnswers
+from authenticator import SockAuthenticator
+
+class SockAuthenticatorTests(unittest.TestCase):
+    def startDaemon(self, **kw):
+        daemon = FakeAuthenticationDaemon(**kw)
+        address = daemon.start()
+        self.addCleanup(daemon.stop)
+        return address
+
+    def testDroppedConnections(self):
+        # A single daemon, backing off after each dropped connection: requests
+        # must wait for it to be usable again instead of failing.
+        authenticator = SockAuthenticator(
+            [self.startDaemon(close_rate=.2, random_seed=1)],
+            timeout=30,
+        )
+        for index in range(30):
+            seed = bytes([index]) * 9
+            self.assertEqual(
+                authenticator.authenticate(seed),
+                deriveAnswers(seed),
+            )
+
+    def testCachedWhileWaiting(self):
+        # A thread waiting for a slow daemon must not hold back cache hits.
+        cached_seed = b'\x01' * 9
+        slow_seed = b'\x02' * 9
+        authenticator = SockAuthenticator(
+            [self.startDaemon(latency=.5)],
+            {cached_seed: deriveAnswers(cached_seed)},
+        )
+        result_list = []
+        thread = threading.Thread(
+            target=lambda: result_list.append(
+                authenticator.authenticate(slow_seed),
+            ),
+        )
+        thread.start()
+        time.sleep(.1)
+        begin = time.monotonic()
+        self.assertEqual(
+            authenticator.authenticate(cached_seed),
+            deriveAnswers(cached_seed),
+        )
+        self.assertLess(time.monotonic() - begin, .2)
+        thread.join()
+        self.assertEqual(result_list, [deriveAnswers(slow_seed)])
+
+if __name__ == '__main__':
+    unittest.main()
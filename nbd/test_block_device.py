@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from block_device import WriteBackBlockDevice
+from emulator import EmulatedAuthenticator, EmulatedMemoryCardAdapter
+from memory_card_reader import PlayStationMemoryCardReader, PS1_CARD_SIZE
+
+class WriteBackBlockDeviceTests(unittest.TestCase):
+    def setUp(self):
+        self.image = bytearray(os.urandom(PS1_CARD_SIZE))
+        image_file = tempfile.NamedTemporaryFile(suffix='.img')
+        self.addCleanup(image_file.close)
+        image_file.write(self.image)
+        image_file.flush()
+        adapter = EmulatedMemoryCardAdapter(image_file.name)
+        self.addCleanup(adapter.close)
+        # Pipelined reads give blocks in reused transfer buffers.
+        self.device = WriteBackBlockDevice(
+            PlayStationMemoryCardReader(
+                adapter,
+                EmulatedAuthenticator(),
+                usb_context=adapter,
+                pipeline_depth=8,
+            ),
+            max_dirty_count=100,
+            max_dirty_age=100,
+        )
+
+    def testReadAcrossDirtyAndCleanBlocks(self):
+        device = self.device
+        block_length = device.getPageSize()
+        for offset, data in (
+                    (block_length * 4 + 10, b'a' * 20),
+                    (block_length * 30 - 5, b'b' * 10),
+                ):
+            device.write(offset, data)
+            self.image[offset:offset + len(data)] = data
+        self.assertTrue(device.getDirtyCount())
+        for offset, length in (
+                    (0, block_length * 40),
+                    (66, 48683),
+                    (block_length * 5, block_length * 20),
+                ):
+            self.assertEqual(
+                device.read(offset, length),
+                self.image[offset:offset + length],
+            )
+            self.assertEqual(
+                b''.join(device.readBlocks(
+                    offset // block_length,
+                    -(-length // block_length),
+                ))[offset % block_length:][:length],
+                self.image[offset:offset + length],
+            )
+
+if __name__ == '__main__':
+    unittest.main()
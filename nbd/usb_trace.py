@@ -0,0 +1,452 @@
+"""
+Record bulk transfers between PlayStationMemoryCardReader and an adapter to a
+trace file, and replay them without the adapter.
+
+A trace file starts with TRACE_MAGIC, followed by one record per finished
+transfer, in completion order: RECORD header (submission and
+completion times, in seconds since recording started, endpoint, libusb
+transfer status and data length), then data (command sent, or response
+received).
+
+Replay pairs responses with the commands they answer (in order, a response
+ending on a short packet), and answers each command the reader sends with the
+recorded response, after the time the device took to produce it (divided by
+speed). Commands must come in the same order as when recording, so the
+workload must be the same, but other reader parameters (pipelining,
+timeouts...) may differ.
+
+  with open('card.trace', 'wb') as trace_file:
+    reader = PlayStationMemoryCardReader(
+      RecordingUSBDevice(usb_device, trace_file), authenticator,
+      usb_context=usb_context)
+    ...
+  device = ReplayUSBDevice('card.trace', speed=10)
+  reader = PlayStationMemoryCardReader(device, EmulatedAuthenticator(),
+    usb_context=device)
+"""
+from collections import deque
+from struct import Struct
+import sys
+from time import monotonic, sleep
+from command_trace import getOpcode
+from emulator import (
+    EmulatedTransfer,
+    EmulatorError,
+    TRANSFER_CANCELLED,
+    TRANSFER_OVERFLOW,
+)
+from memory_card_reader import (
+    BULK_READ_LENGTH,
+    TRANSFER_COMPLETED,
+    TRANSFER_TIMED_OUT,
+)
+
+TRACE_MAGIC = b'PSMCTRC\x01'
+RECORD = Struct('<ddBBH')
+# libusb_transfer_status value recorded for failed synchronous transfers.
+TRANSFER_ERROR = 1
+# Commands the reader sends depending on elapsed time (card type queries),
+# which replay answers as recorded last when they come at a different point
+# than when recording.
+POLL_OPCODE_SET = ('40', )
+
+class ReplayError(EmulatorError):
+    """
+      Reader did not send the commands found in the trace.
+    """
+
+class _RecordingTransfer(object):
+    """
+      Wrapper around an usb1.USBTransfer, recording it when it finishes.
+    """
+    def __init__(self, recorder, transfer):
+        self._recorder = recorder
+        self._transfer = transfer
+        self._endpoint = None
+        self._callback = None
+        self._submit_time = None
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None,
+            timeout=0):
+        self._endpoint = endpoint
+        self._callback = callback
+        self._transfer.setBulk(
+            endpoint,
+            buffer_or_len,
+            callback=self._onComplete,
+            user_data=user_data,
+            timeout=timeout,
+        )
+
+    def submit(self):
+        self._submit_time = monotonic()
+        self._transfer.submit()
+
+    def _onComplete(self, transfer):
+        data = transfer.getBuffer()
+        if self._endpoint & 0x80:
+            data = data[:transfer.getActualLength()]
+        self._recorder._record(
+            self._submit_time,
+            self._endpoint,
+            transfer.getStatus(),
+            data,
+        )
+        if self._callback is not None:
+            self._callback(self)
+
+    def __getattr__(self, name):
+        return getattr(self._transfer, name)
+
+class RecordingUSBDevice(object):
+    """
+      Wrapper around an usb1.USBDeviceHandle, recording bulk transfers to a
+      trace file.
+    """
+    def __init__(self, usb_device, trace_file):
+        """
+          usb_device (usb1.USBDeviceHandle, or compatible)
+            Device to record transfers of.
+          trace_file (binary file opened for writing)
+            Where to write the trace. Caller is responsible for closing it,
+            once device is not used anymore.
+        """
+        self._usb_device = usb_device
+        self._trace_file = trace_file
+        self._start = monotonic()
+        trace_file.write(TRACE_MAGIC)
+
+    def _record(self, submit_time, endpoint, status, data):
+        self._trace_file.write(RECORD.pack(
+            submit_time - self._start,
+            monotonic() - self._start,
+            endpoint,
+            status,
+            len(data),
+        ) + bytes(data))
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        submit_time = monotonic()
+        try:
+            result = self._usb_device.bulkWrite(endpoint, data,
+              timeout=timeout)
+        except Exception:
+            self._record(submit_time, endpoint, TRANSFER_ERROR, b'')
+            raise
+        self._record(submit_time, endpoint, TRANSFER_COMPLETED, data)
+        return result
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        submit_time = monotonic()
+        try:
+            result = self._usb_device.bulkRead(endpoint, length,
+              timeout=timeout)
+        except Exception:
+            self._record(submit_time, endpoint | 0x80, TRANSFER_ERROR, b'')
+            raise
+        self._record(submit_time, endpoint | 0x80, TRANSFER_COMPLETED, result)
+        return result
+
+    def getTransfer(self, *args, **kw):
+        return _RecordingTransfer(
+            self,
+            self._usb_device.getTransfer(*args, **kw),
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._usb_device, name)
+
+def readTrace(trace_file):
+    """
+      Yield records from trace file, as (submit_time, completion_time,
+      endpoint, status, data) tuples.
+    """
+    if trace_file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError('Not a trace file')
+    while True:
+        header = trace_file.read(RECORD.size)
+        if not header:
+            break
+        if len(header) != RECORD.size:
+            # Recording was interrupted.
+            break
+        submit_time, completion_time, endpoint, status, length = \
+          RECORD.unpack(header)
+        data = trace_file.read(length)
+        if len(data) != length:
+            break
+        yield submit_time, completion_time, endpoint, status, data
+
+def loadExchangeList(trace_file):
+    """
+      Pair commands from trace file with their responses.
+      Return a list of (command, response packet list, command duration,
+      response delay) tuples, where response delay is the time device took to
+      respond, not counting time spent waiting for the host to ask for the
+      response, nor for the device to respond to previous commands.
+      A command whose response never came gets an empty packet list.
+    """
+    result = []
+    # Indexes in result of commands still waiting for (the end of) their
+    # response, and when they were sent.
+    pending_deque = deque()
+    last_completion = 0
+    for submit_time, completion_time, endpoint, status, data in readTrace(
+                trace_file,
+            ):
+        if status != TRANSFER_COMPLETED:
+            if endpoint & 0x80:
+                # Reader gave up on commands waiting for a response.
+                pending_deque.clear()
+            continue
+        if not endpoint & 0x80:
+            pending_deque.append((len(result), completion_time))
+            result.append((data, [], completion_time - submit_time, 0))
+            continue
+        if not pending_deque:
+            # Stale response, drained by reader after a failure.
+            continue
+        index, sent_time = pending_deque[0]
+        command, packet_list, command_duration, delay = result[index]
+        packet_list.extend(
+            data[x:x + BULK_READ_LENGTH]
+            for x in range(0, len(data), BULK_READ_LENGTH)
+        )
+        delay += max(0, completion_time - max(submit_time, sent_time,
+          last_completion))
+        last_completion = completion_time
+        result[index] = (command, packet_list, command_duration, delay)
+        if len(data) % BULK_READ_LENGTH:
+            # Short packet: response is complete.
+            pending_deque.popleft()
+    return result
+
+class ReplayUSBDevice(object):
+    """
+      Device answering commands with responses from a trace file.
+      Implements the same subset of usb1 API as EmulatedMemoryCardAdapter,
+      and can also be used as USB context.
+    """
+    def __init__(self, trace_path, speed=1):
+        """
+          trace_path (string)
+            Trace file, as produced by RecordingUSBDevice.
+          speed (float)
+            How much faster than recorded the device responds. 0 to respond
+            immediately.
+        """
+        with open(trace_path, 'rb') as trace_file:
+            self._exchange_list = loadExchangeList(trace_file)
+        self._speed = speed
+        self._next_exchange = 0
+        # (packet, ready time, last packet of a response)
+        self._response_packet_deque = deque()
+        self._ready_time = 0
+        self._poll_exchange = None
+        self._submitted_list = []
+        self.transfer_count = 0
+        # Commands whose content differs from recording.
+        self.mismatch_count = 0
+
+    def _scale(self, duration):
+        if self._speed:
+            return duration / self._speed
+        return 0
+
+    def getStatistics(self):
+        """
+          Return a dict of replay counters.
+        """
+        return {
+            'command': self._next_exchange,
+            'remaining_command': len(self._exchange_list) - self._next_exchange,
+            'mismatch': self.mismatch_count,
+            'transfer': self.transfer_count,
+        }
+
+    # usb1.USBDeviceHandle API
+    def bulkWrite(self, endpoint, data, timeout=0):
+        transfer = EmulatedTransfer(self)
+        transfer.setBulk(endpoint & 0x7f, data, timeout=timeout)
+        self._runSynchronously(transfer)
+        return transfer.getActualLength()
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        transfer = EmulatedTransfer(self)
+        transfer.setBulk(endpoint | 0x80, length, timeout=timeout)
+        self._runSynchronously(transfer)
+        return transfer.getBuffer()[:transfer.getActualLength()]
+
+    def getTransfer(self, iso_packets=0, short_is_error=False,
+            add_zero_packet=False):
+        return EmulatedTransfer(self)
+
+    def claimInterface(self, interface):
+        pass
+
+    def close(self):
+        pass
+
+    # usb1.USBContext API
+    def handleEvents(self):
+        """
+          Wait for the next transfer to complete, and complete all transfers
+          which are done by then.
+        """
+        submitted_list = self._submitted_list
+        if not submitted_list:
+            return
+        scheduled_list = [
+            x for x in submitted_list if x.completion_time is not None
+        ]
+        if not scheduled_list:
+            raise ReplayError('Waiting for a response to no command')
+        self._sleepUntil(min(x.completion_time for x in scheduled_list))
+        now = monotonic()
+        for transfer in scheduled_list:
+            if transfer.completion_time <= now:
+                submitted_list.remove(transfer)
+                transfer._complete(*transfer.result)
+
+    # Transfer scheduling
+    def _runSynchronously(self, transfer):
+        transfer.submit()
+        if transfer.completion_time is None:
+            self._submitted_list.remove(transfer)
+            raise ReplayError('Waiting for a response to no command')
+        self._sleepUntil(transfer.completion_time)
+        self._submitted_list.remove(transfer)
+        transfer._complete(*transfer.result)
+        if transfer.getStatus() != TRANSFER_COMPLETED:
+            raise EmulatorError('Transfer failed with status %i' % (
+              transfer.getStatus(), ))
+
+    @staticmethod
+    def _sleepUntil(deadline):
+        delay = deadline - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def _submit(self, transfer):
+        self._submitted_list.append(transfer)
+        transfer.submit_time = monotonic()
+        self.transfer_count += 1
+        if not transfer.isIn():
+            self._handleCommand(transfer)
+        self._schedule()
+
+    def _cancel(self, transfer):
+        self._submitted_list.remove(transfer)
+        transfer._complete(TRANSFER_CANCELLED, 0)
+
+    def _handleCommand(self, transfer):
+        command = bytes(transfer.getBuffer())
+        opcode = getOpcode(command)
+        exchange_list = self._exchange_list
+        if opcode in POLL_OPCODE_SET:
+            exchange = self._poll_exchange
+            if self._next_exchange < len(exchange_list) and getOpcode(
+                        exchange_list[self._next_exchange][0],
+                    ) == opcode:
+                exchange = self._poll_exchange = \
+                  exchange_list[self._next_exchange]
+                self._next_exchange += 1
+            elif exchange is None:
+                raise ReplayError('No %s command in trace' % (opcode, ))
+        else:
+            # Reader did not poll as much as when recording.
+            while self._next_exchange < len(exchange_list) and getOpcode(
+                        exchange_list[self._next_exchange][0],
+                    ) in POLL_OPCODE_SET:
+                self._poll_exchange = exchange_list[self._next_exchange]
+                self._next_exchange += 1
+            if self._next_exchange >= len(exchange_list):
+                raise ReplayError('Trace exhausted, got command %s' % (
+                  opcode, ))
+            exchange = exchange_list[self._next_exchange]
+            # Command content (ex: authentication answers, written data) may
+            # differ from recording, but not its nature.
+            if opcode != getOpcode(exchange[0]) or \
+                    len(command) != len(exchange[0]):
+                raise ReplayError('Command %i differs from trace: %s, '
+                  'expected %s' % (
+                    self._next_exchange,
+                    opcode,
+                    getOpcode(exchange[0]),
+                ))
+            self._next_exchange += 1
+        recorded_command, packet_list, command_duration, delay = exchange
+        if command != recorded_command:
+            self.mismatch_count += 1
+        transfer.completion_time = sent_time = transfer.submit_time + \
+          self._scale(command_duration)
+        transfer.result = (TRANSFER_COMPLETED, len(command))
+        # Device responds to commands one after the other.
+        self._ready_time = ready_time = max(sent_time, self._ready_time) + \
+          self._scale(delay)
+        self._response_packet_deque.extend(
+            (packet, ready_time, index == len(packet_list) - 1)
+            for index, packet in enumerate(packet_list)
+        )
+
+    def _schedule(self):
+        """
+          Give available response packets to submitted response transfers, in
+          submission order, and decide when they complete.
+        """
+        packet_deque = self._response_packet_deque
+        for transfer in self._submitted_list:
+            if transfer.completion_time is not None or not transfer.isIn():
+                continue
+            if not packet_deque:
+                if transfer._timeout:
+                    # No response can arrive before this times out.
+                    transfer.result = (TRANSFER_TIMED_OUT, 0)
+                    transfer.completion_time = transfer.submit_time + \
+                      transfer._timeout / 1000.
+                # Otherwise, wait for a command (maybe on a later transfer).
+                continue
+            buf = transfer.getBuffer()
+            length = 0
+            ready_time = transfer.submit_time
+            status = TRANSFER_COMPLETED
+            while packet_deque:
+                packet, packet_ready_time, last = packet_deque[0]
+                packet_length = len(packet)
+                if length + packet_length > len(buf):
+                    if not length:
+                        status = TRANSFER_OVERFLOW
+                    break
+                packet_deque.popleft()
+                buf[length:length + packet_length] = packet
+                length += packet_length
+                ready_time = max(ready_time, packet_ready_time)
+                if last or packet_length < BULK_READ_LENGTH:
+                    break
+            transfer.result = (status, length)
+            transfer.completion_time = ready_time
+
+def main(trace_path):
+    """
+      Print a summary of trace file content.
+    """
+    with open(trace_path, 'rb') as trace_file:
+        exchange_list = loadExchangeList(trace_file)
+    stat_dict = {}
+    for command, packet_list, command_duration, delay in exchange_list:
+        stat = stat_dict.setdefault(getOpcode(command), [0, 0, 0])
+        stat[0] += 1
+        stat[1] += len(command) + sum(len(x) for x in packet_list)
+        stat[2] += command_duration + delay
+    for opcode, (count, byte_count, duration) in sorted(
+                stat_dict.items(),
+                key=lambda x: x[1][2],
+                reverse=True,
+            ):
+        print('%-8s %8i commands %10i bytes %10.3fs device time' % (
+          opcode, count, byte_count, duration))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('Usage: %s TRACE' % (sys.argv[0], ))
+    main(sys.argv[1])